@@ -79,6 +79,8 @@ CREATE TABLE IF NOT EXISTS `gapps_queue` (
   p_status ENUM('idle', 'active', 'success', 'hardfail', 'softfail') DEFAULT 'idle' NOT NULL,
   p_priority ENUM('immediate', 'normal', 'offline') DEFAULT 'offline' NOT NULL,
   p_admin_request BOOLEAN DEFAULT false NOT NULL,
+  p_claim_token CHAR(32) DEFAULT NULL,
+  p_lease_expiry DATETIME DEFAULT NULL,
 
   -- Job content fields.
   j_type ENUM('r_activity', 'r_accounts', 'u_create', 'u_delete', 'u_update', 'u_sync') NOT NULL,
@@ -94,7 +96,29 @@ CREATE TABLE IF NOT EXISTS `gapps_queue` (
   INDEX q_owner_id(q_owner_id),
   INDEX q_recipient_id(q_recipient_id),
   INDEX p_status(p_status),
-  INDEX p_priority(p_priority)
+  INDEX p_priority(p_priority),
+  INDEX p_runnable(p_admin_request, p_status, p_priority, p_notbefore_date, q_id),
+  INDEX p_claim_token(p_claim_token)
+) CHARSET=utf8;
+
+-- Table `gapps_queue_sequence`.
+-- Single-row change marker of the queue: writers bump it after adding jobs to
+-- `gapps_queue`, which wakes up the idle gappsd immediately (new jobs are also
+-- noticed without it, from the highest q_id of the queue).
+CREATE TABLE IF NOT EXISTS `gapps_queue_sequence` (
+  id TINYINT UNSIGNED NOT NULL,
+  seq BIGINT UNSIGNED DEFAULT 0 NOT NULL,
+  PRIMARY KEY(id)
+) CHARSET=utf8;
+INSERT IGNORE INTO `gapps_queue_sequence` (id, seq) VALUES (1, 0);
+
+-- Table `gapps_schema_version`.
+-- Schema upgrades applied by tools/migrate-schema.py.
+CREATE TABLE IF NOT EXISTS `gapps_schema_version` (
+  version SMALLINT UNSIGNED NOT NULL,
+  description VARCHAR(256) NOT NULL,
+  applied_date DATETIME NOT NULL,
+  PRIMARY KEY(version)
 ) CHARSET=utf8;
 
 -- vim:set syntax=mysql:
\ No newline at end of file
@@ -18,6 +18,8 @@
 """Implements a python representation of the SQL version of the Google Apps
 user accounts. It enables easy manipulation of the different informations"""
 
+import database
+
 class AccountContentError(Exception):
   """Indicates that an invalid content was found in an Account. For example,
   an account not indexed by its account_name will raise this exception."""
@@ -35,12 +37,40 @@ def LoadAccountFromDatabase(sql, account_name):
   a returns the corresponding Account object."""
 
   result = sql.Query("SELECT * FROM gapps_accounts WHERE g_account_name = %s",
-                     (account_name,))
+                     (account_name,), row_factory=database.RecordRowFactory)
   if result is None or not len(result):
     return None
   return Account(account_name, result[0])
 
 
+def UpsertAccounts(sql, accounts, chunk_size=100):
+  """Writes the changes of the @p accounts (cf. Account.GetUpsertRow) to the
+  database, with one multi-row upsert per set of changed fields."""
+
+  groups = {}
+  for account in accounts:
+    (row, update_columns) = account.GetUpsertRow()
+    if update_columns:
+      groups.setdefault((tuple(sorted(row)), update_columns), []).append(row)
+
+  for ((columns, update_columns), rows) in sorted(groups.items()):
+    sql.UpsertMany("gapps_accounts", rows, update_columns, chunk_size)
+
+
+def UpdateAccounts(sql, accounts, chunk_size=100):
+  """Writes the changes of the existing @p accounts (cf. Account.Update) to
+  the database, with multi-row updates. Accounts which no longer exist in the
+  database are left alone (unlike with UpsertAccounts)."""
+
+  rows = {}
+  for account in accounts:
+    changed_data = account.GetChangedData()
+    if changed_data:
+      rows[account.get("g_account_name")] = changed_data
+  if rows:
+    sql.UpdateMany("gapps_accounts", "g_account_name", rows, chunk_size)
+
+
 class Account(object):
   """Represents an account as in the database.
 
@@ -53,6 +83,11 @@ class Account(object):
     account.set("last_name", "Foo")
     ...
     account.Create(sql_object)
+
+    account = Account("<account name>")
+    account.set("last_name", "Foo")
+    ...
+    account.Upsert(sql_object)
   """
 
   # Accounts statuses.
@@ -132,15 +167,42 @@ class Account(object):
 
     sql.Insert("gapps_accounts", data)
 
-  def Update(self, sql):
-    """Updates the SQL version of the account, using values updated through the
-    set() method of the object."""
+  def GetUpsertRow(self):
+    """Returns the (row, update columns) of the upsert of the account: the row
+    contains the mandatory fields and the fields changed through set(), and
+    only the changed fields are updated on an existing account."""
+
+    row = {}
+    update_columns = []
+    for (key, (modifier, mandatory, ro)) in sorted(self._DATA_FIELDS.items()):
+      if mandatory and not key in self._data:
+        raise AccountActionError("Missing field '%s' for upsert." % key)
+      if key in self._data_changed and self._data_changed[key]:
+        update_columns.append(key)
+      if mandatory or key in update_columns:
+        row[key] = self._data[key]
+    return (row, tuple(update_columns))
+
+  def Upsert(self, sql):
+    """Commits the account to the database in a single query: the account is
+    created if needed, otherwise its changed fields are updated."""
+
+    UpsertAccounts(sql, [self])
+
+  def GetChangedData(self):
+    """Returns the dictionary of the fields changed through set()."""
 
     changed_data = {}
     for (key, (modifier, mandatory, ro)) in list(self._DATA_FIELDS.items()):
       if key in self._data_changed and self._data_changed[key]:
         changed_data[key] = self._data[key]
+    return changed_data
+
+  def Update(self, sql):
+    """Updates the SQL version of the account, using values updated through the
+    set() method of the object."""
 
+    changed_data = self.GetChangedData()
     if len(changed_data):
       sql.Update("gapps_accounts",
                  changed_data,
@@ -17,25 +17,411 @@
 
 """Providers for the various authenticated endpoints of the Google Admin API."""
 
+import copy
+import datetime
+import fcntl
 import httplib2
+import os
+import simplejson
+import socket
+import threading
+import time
+import weakref
 
 from . import logger
 from .logger import PermanentError, TransientError
 
-from google.apiclient.discovery import build
+from google.apiclient.discovery import build, build_from_document
+from google.apiclient.discovery import DISCOVERY_URI
 from google.apiclient.errors import HttpError
-from google.oauth2client.client import SignedJwtAssertionCredentials
+from google.oauth2client import crypt
+from google.oauth2client.client import SignedJwtAssertionCredentials, Storage
+
+class ServiceRegistry(object):
+  """Holds the process-wide cache of authorized API services. Each service is
+  built once per (service, scope) pair and per thread (httplib2.Http objects
+  cannot be shared between threads), with its own credentials and authorized
+  Http object, and is then shared by all jobs of the thread. See the global
+  variable "service_registry" below.
+
+  Example usage:
+    service = api.service_registry.Get(config, "directory_v1", scope)
+    stats = api.service_registry.Stats()
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._builds = 0
+    self._reuses = 0
+
+  def Get(self, config, service, scope):
+    """Returns the @p service authorized for @p scope, building it on first
+    use only."""
+
+    services = self._local.__dict__.setdefault("services", {})
+    key = (service, scope)
+    if key in services:
+      with self._lock:
+        self._reuses += 1
+    else:
+      services[key] = _BuildApiService(config, service, scope)
+      with self._lock:
+        self._builds += 1
+    return services[key]
+
+  def Stats(self):
+    """Returns the number of service builds and service reuses."""
+
+    with self._lock:
+      return {"builds": self._builds, "reuses": self._reuses}
+
+  def Reset(self):
+    """Drops all cached services (they will be rebuilt on next use)."""
+
+    with self._lock:
+      self._local = threading.local()
+
+class DiscoveryCache(object):
+  """On-disk cache of the API discovery documents. Documents younger than
+  @p ttl seconds are served without any network access; older ones are
+  revalidated using their ETag, and the cached copy is used as a fallback when
+  the discovery endpoint is unavailable.
+
+  Example usage:
+    cache = DiscoveryCache("/var/cache/gappsd", 86400)
+    service = build_from_document(cache.Get("admin", "directory_v1"), ...)
+  """
+
+  _FETCH_TIMEOUT = 10
+
+  def __init__(self, directory, ttl):
+    self._directory = directory
+    self._ttl = ttl
+
+  def _GetPath(self, api_name, version):
+    return os.path.join(self._directory, "%s.%s.json" % (api_name, version))
+
+  def _Load(self, path):
+    """Returns the cached (document, metadata) pair, or (None, None) if no
+    valid copy was found."""
+
+    try:
+      document = open(path).read()
+      metadata = simplejson.loads(open(path + ".meta").read())
+    except (IOError, ValueError):
+      return (None, None)
+    if not isinstance(metadata, dict) or \
+       not isinstance(metadata.get("fetched"), (int, long, float)):
+      return (None, None)
+    return (document, metadata)
+
+  def _Store(self, path, document, metadata):
+    """Atomically replaces the cached copy of the document (write errors are
+    logged but not fatal, the cache being only an optimization)."""
+
+    try:
+      if not os.path.isdir(self._directory):
+        os.makedirs(self._directory)
+      for (filename, content) in ((path, document),
+                                  (path + ".meta", simplejson.dumps(metadata))):
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        tmp_file = open(tmp_filename, "w")
+        tmp_file.write(content)
+        tmp_file.close()
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError), message:
+      logger.warning("Unable to store discovery document %s: %s" % \
+        (path, message))
+
+  def Get(self, api_name, version, http=None):
+    """Returns the discovery document of the @p api_name / @p version API,
+    from the cache if possible. Raises a TransientError when the document is
+    neither available from the network nor from the cache."""
+
+    path = self._GetPath(api_name, version)
+    (document, metadata) = self._Load(path)
+    if document is not None and metadata["fetched"] + self._ttl > time.time():
+      return document
+
+    headers = {}
+    if document is not None and metadata.get("etag"):
+      headers["if-none-match"] = metadata["etag"]
+    if http is None:
+      http = httplib2.Http(timeout=self._FETCH_TIMEOUT)
+
+    url = DISCOVERY_URI.format(api=api_name, apiVersion=version)
+    try:
+      (response, content) = http.request(url, headers=headers)
+    except (httplib2.HttpLib2Error, socket.error), message:
+      response, content = None, message
+
+    if response is not None and response.status == 304 and document:
+      metadata["fetched"] = time.time()
+      self._Store(path, document, metadata)
+      return document
+    if response is not None and response.status == 200:
+      try:
+        simplejson.loads(content)
+      except ValueError, message:
+        logger.warning("Invalid discovery document for %s/%s: %s" % \
+          (api_name, version, message))
+        response, content = None, message
+      else:
+        metadata = {"fetched": time.time(), "etag": response.get("etag")}
+        self._Store(path, content, metadata)
+        return content
+
+    if document is None:
+      raise TransientError("Unable to fetch discovery document for %s/%s: %s" \
+        % (api_name, version, response.status if response else content))
+    logger.warning("Using stale discovery document for %s/%s" % \
+      (api_name, version))
+    return document
+
+class TokenStorage(Storage):
+  """File-backed Storage of the OAuth access tokens, shared by all the jobs,
+  threads and successive instances of the daemon. Only the access token and
+  its expiry date are stored (the private key never leaves the key file);
+  tokens are indexed by client, impersonated user and scope, so several
+  credentials can share the same file.
+
+  Example usage:
+    storage = TokenStorage("/var/lib/gappsd/tokens", credentials)
+    credentials.set_store(storage)
+  """
+
+  _DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+  def __init__(self, filename, credentials):
+    self._filename = filename
+    self._credentials = credentials
+    self._key = "%s %s %s" % (credentials.service_account_name,
+                              credentials.kwargs.get("sub", ""),
+                              credentials.scope)
+    self._lock_file = None
+
+  def acquire_lock(self):
+    """Acquires the in-process lock (file locks do not exclude threads of the
+    same process), then the inter-process file lock."""
+
+    _token_storage_lock.acquire()
+    try:
+      self._lock_file = open(self._filename + ".lock", "a")
+      fcntl.lockf(self._lock_file, fcntl.LOCK_EX)
+    except IOError:
+      _token_storage_lock.release()
+      raise
+
+  def release_lock(self):
+    fcntl.lockf(self._lock_file, fcntl.LOCK_UN)
+    self._lock_file.close()
+    self._lock_file = None
+    _token_storage_lock.release()
+
+  def _ReadTokens(self):
+    try:
+      return simplejson.loads(open(self._filename).read())
+    except (IOError, ValueError):
+      return {}
+
+  def locked_get(self):
+    """Returns a copy of the credentials holding the stored token, or None when
+    no token was stored for these credentials."""
+
+    token = self._ReadTokens().get(self._key)
+    if not token:
+      return None
+
+    credentials = copy.copy(self._credentials)
+    credentials.access_token = token["access_token"]
+    credentials.token_expiry = datetime.datetime.strptime(
+      token["token_expiry"], self._DATE_FORMAT)
+    credentials.invalid = False
+    return credentials
+
+  def _WriteTokens(self, tokens):
+    """Atomically replaces the token file; the file is only readable by the
+    daemon user."""
+
+    tmp_filename = "%s.%d.tmp" % (self._filename, os.getpid())
+    tmp_fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    tmp_file = os.fdopen(tmp_fd, "w")
+    tmp_file.write(simplejson.dumps(tokens))
+    tmp_file.close()
+    os.rename(tmp_filename, self._filename)
+
+  def locked_put(self, credentials):
+    """Stores the token of @p credentials (invalid credentials are dropped
+    from the store)."""
+
+    tokens = self._ReadTokens()
+    if credentials.invalid or not credentials.token_expiry:
+      tokens.pop(self._key, None)
+    else:
+      tokens[self._key] = {
+        "access_token": credentials.access_token,
+        "token_expiry": credentials.token_expiry.strftime(self._DATE_FORMAT),
+      }
+    self._WriteTokens(tokens)
+
+  def locked_delete(self):
+    tokens = self._ReadTokens()
+    if self._key in tokens:
+      del tokens[self._key]
+      self._WriteTokens(tokens)
+
+
+class TokenRefresher(threading.Thread):
+  """Background thread refreshing the access tokens of the watched credentials
+  @p margin seconds ahead of their expiry, so that API requests never wait
+  for a token exchange. Credentials are only weakly referenced: they are no
+  longer refreshed once their service is dropped (eg. ServiceRegistry.Reset,
+  or end of the thread owning the service).
+
+  Example usage:
+    refresher = TokenRefresher(300)
+    refresher.Watch(credentials)
+    refresher.start()
+  """
+
+  def __init__(self, margin):
+    threading.Thread.__init__(self, name="TokenRefresher")
+    self.daemon = True
+    self._margin = margin
+    self._credentials = []
+    self._lock = threading.Lock()
+
+  def Watch(self, credentials):
+    with self._lock:
+      self._credentials.append(weakref.ref(credentials))
+
+  def NeedsRefresh(self, credentials):
+    """Returns True iff the token of @p credentials is missing or about to
+    expire."""
+
+    if not credentials.access_token or credentials.invalid:
+      return True
+    expires_in = credentials._expires_in()
+    return expires_in is not None and expires_in < self._margin
+
+  def RefreshAll(self):
+    """Refreshes the tokens which are close to their expiry date. Errors are
+    only logged, as the token will anyway be refreshed on next use."""
+
+    with self._lock:
+      credentials_list = [ref() for ref in self._credentials]
+      self._credentials = [ref for ref in self._credentials
+                           if ref() is not None]
+    for credentials in credentials_list:
+      if credentials is not None and self.NeedsRefresh(credentials):
+        try:
+          credentials.refresh(httplib2.Http())
+        except Exception, error:
+          logger.info("Background token refresh failed: %s" % error)
+
+  def run(self):
+    while True:
+      self.RefreshAll()
+      time.sleep(max(self._margin / 4, 1))
+
+def _GetTokenRefresher(config):
+  """Returns the process-wide TokenRefresher, starting it on first use. Returns
+  None when background refresh is disabled."""
+
+  global _token_refresher
+  margin = config.get_int("gappsd.token-refresh-margin")
+  if margin <= 0:
+    return None
+  with _token_refresher_lock:
+    if _token_refresher is None:
+      _token_refresher = TokenRefresher(margin)
+      _token_refresher.start()
+  return _token_refresher
+
+def _BuildApiService(config, service, scope):
+  credentials = _GetCredentials(config, scope)
+  http = credentials.authorize(httplib2.Http())
+  refresher = _GetTokenRefresher(config)
+  if refresher:
+    refresher.Watch(credentials)
+
+  cache_directory = config.get_string("gappsd.discovery-cache-dir")
+  if not cache_directory:
+    return build('admin', service, http=http)
+  cache = DiscoveryCache(cache_directory,
+                         config.get_int("gappsd.discovery-cache-ttl"))
+  return build_from_document(cache.Get('admin', service), http=http)
 
 def _GetApiService(config, service, scope):
-  return build('admin', service, credentials=_GetCredentials(config, scope))
+  return service_registry.Get(config, service, scope)
+
+class ServiceAccountCredentials(SignedJwtAssertionCredentials):
+  """SignedJwtAssertionCredentials reading its private key from @p key_file,
+  and signing its assertions with the process-wide cached signer (instead of
+  parsing the private key for every assertion)."""
+
+  def __init__(self, key_file, **kwargs):
+    self._key_file = key_file
+    SignedJwtAssertionCredentials.__init__(
+      self, private_key=_GetPrivateKey(key_file)[1], **kwargs)
+
+  def _generate_assertion(self):
+    now = int(time.time())
+    payload = {
+      'aud': self.token_uri,
+      'scope': self.scope,
+      'iat': now,
+      'exp': now + self.MAX_TOKEN_LIFETIME_SECS,
+      'iss': self.service_account_name,
+    }
+    payload.update(self.kwargs)
+    signer = _GetSigner(self._key_file, self.private_key_password)
+    return crypt.make_signed_jwt(signer, payload)
+
+def _GetPrivateKey(key_file):
+  """Returns the (mtime, content) of the @p key_file, reading it from disk only
+  when it was modified since the last call."""
+
+  mtime = os.stat(key_file).st_mtime
+  with _signer_cache_lock:
+    cached_key = _private_key_cache.get(key_file)
+    if cached_key is None or cached_key[0] != mtime:
+      cached_key = (mtime, open(key_file, "rb").read())
+      _private_key_cache[key_file] = cached_key
+    return cached_key
+
+def _GetSigner(key_file, password):
+  """Returns the crypt.Signer for the @p key_file. Signers are cached by key
+  file path and mtime, so that the key is only parsed once per process."""
+
+  (mtime, private_key) = _GetPrivateKey(key_file)
+  with _signer_cache_lock:
+    cached_signer = _signer_cache.get(key_file)
+    if cached_signer is None or cached_signer[0] != mtime:
+      cached_signer = (mtime, crypt.Signer.from_string(private_key, password))
+      _signer_cache[key_file] = cached_signer
+    return cached_signer[1]
 
 def _GetCredentials(config, scope):
-  return SignedJwtAssertionCredentials(
+  credentials = ServiceAccountCredentials(
+      key_file=config.get_string("gapps.oauth2-secret"),
       service_account_name=config.get_string("gapps.oauth2-client"),
-      private_key= open(config.get_string("gapps.oauth2-secret")).read(),
       scope=scope,
       sub=config.get_string("gapps.oauth2-user"))
 
+  # Reuses the stored token, unless it is about to expire.
+  token_store = config.get_string("gappsd.token-store")
+  if token_store:
+    storage = TokenStorage(token_store, credentials)
+    credentials.set_store(storage)
+    stored_credentials = storage.get()
+    if stored_credentials and stored_credentials._expires_in() > \
+        config.get_int("gappsd.token-refresh-margin"):
+      credentials.access_token = stored_credentials.access_token
+      credentials.token_expiry = stored_credentials.token_expiry
+  return credentials
+
 def GetDirectoryService(config):
   return _GetApiService(
       config, service="directory_v1",
@@ -65,3 +451,16 @@ def HandleErrorAllowMissing(error):
   if isinstance(error, HttpError) and error.resp.status == 404:
     return None
   HandleError(error)
+
+# Service registry shared by all the jobs of the process.
+service_registry = ServiceRegistry()
+
+# Background token refresher, started with the first service build.
+_token_refresher = None
+_token_refresher_lock = threading.Lock()
+_token_storage_lock = threading.Lock()
+
+# Private keys and signers, indexed by key file path.
+_private_key_cache = {}
+_signer_cache = {}
+_signer_cache_lock = threading.Lock()
@@ -46,10 +46,11 @@ class CliQueue(object):
   def Update(self):
     """Updates the local mirror of pending jobs."""
 
+    (where_clause, where_args) = \
+      queue.Queue._GetActiveJobsCondition(admin=True)
     sql_query = "SELECT %s FROM gapps_queue WHERE %s ORDER BY q_id LIMIT 1" % \
-      (queue.Queue._JOB_SELECT_CLAUSE,
-       queue.Queue._ACTIVE_JOBS_WHERE_CLAUSE_ADMIN)
-    result = self._sql.Query(sql_query)
+      (queue.Queue._JOB_SELECT_CLAUSE, where_clause)
+    result = self._sql.Query(sql_query, tuple(where_args))
 
     self._jobs = {}
     for row in result:
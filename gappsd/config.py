@@ -41,6 +41,20 @@ class Config(object):
       'mysql.username': None,
       'mysql.password': "",
       'mysql.database': None,
+      'mysql.backend': 'mysql',
+      'mysql.deadlock-retries': 3,
+      'mysql.idle-timeout': 300,
+      'mysql.ping-interval': 30,
+      'mysql.pool-max-lifetime': 3600,
+      'mysql.pool-max-size': 4,
+      'mysql.pool-min-size': 0,
+      'mysql.pool-timeout': 30,
+      'mysql.query-retries': 2,
+      'mysql.query-retry-delay': 1,
+      'mysql.replica-check-interval': 10,
+      'mysql.replica-hostname': '',
+      'mysql.replica-max-lag': 30,
+      'mysql.slow-query-threshold': 1000,
 
       'gapps.customer': None,
       'gapps.domain': None,
@@ -51,8 +65,12 @@ class Config(object):
 
       'gappsd.activity-backlog': 30,
       'gappsd.admin-only-jobs': False,
+      'gappsd.discovery-cache-dir': '',
+      'gappsd.discovery-cache-ttl': 86400,
       'gappsd.job-softfail-delay': 300,
       'gappsd.job-softfail-threshold': 4,
+      'gappsd.lease-duration': 90,
+      'gappsd.lease-duration-per-type': '',
       'gappsd.logfile-backlog': 90,
       'gappsd.logfile-name': '',
       'gappsd.logfile-rotation': 1,
@@ -61,12 +79,23 @@ class Config(object):
       'gappsd.logmail-domain-in-subject': False,
       'gappsd.logmail-smtp': '',
       'gappsd.max-run-time': 86400,
+      'gappsd.queue-max-idle': 60,
+      'gappsd.queue-prefetch': 0,
+      'gappsd.queue-recount-interval': 300,
+      'gappsd.submit-socket': '',
+      'gappsd.submit-socket-mode': '0660',
       'gappsd.queue-min-delay': 2,
       'gappsd.queue-delay-normal': 10,
       'gappsd.queue-delay-offline': 30,
       'gappsd.queue-warn-overflow': True,
+      'gappsd.queue-workers': 0,
+      'gappsd.queue-workers-per-priority': '',
+      'gappsd.queue-workers-per-type': '',
       'gappsd.read-only': False,
+      'gappsd.status-flush-interval': 0,
       'gappsd.token-expiration': 86400,
+      'gappsd.token-refresh-margin': 300,
+      'gappsd.token-store': '',
     }
 
     self.__Load(config_file)
@@ -107,6 +136,16 @@ class Config(object):
     """ Returns the integer config value for @p key."""
     return int(self._data[key])
 
+  def get_int_dict(self, key):
+    """ Returns the "name:integer" comma-separated config value for @p key, as
+    a dictionary (eg. "foo:1, bar:2" gives {"foo": 1, "bar": 2})."""
+    result = {}
+    for item in str(self._data[key]).split(","):
+      if item.strip():
+        (name, value) = item.split(":", 1)
+        result[name.strip()] = int(value)
+    return result
+
   def set(self, key, value):
     """Updates the local configuration with the new (key, value) pair."""
     self._data[key] = value
@@ -20,14 +20,174 @@
 import datetime
 import os
 import pprint
+import simplejson
+import socket
 import sys
+import threading
 import time
 import traceback
 
 import config, database, queue
 import job, provisioning, reporting
 from . import logger
-from .logger import CredentialError, TransientError
+from .logger import CredentialError, PermanentError, TransientError
+
+def SubmitJob(socket_path, j_type, j_parameters={}, p_priority="normal",
+              timeout=5):
+  """Submits a new queue job through the submission socket of a running gappsd
+  (cf. SubmissionServer). Raises a PermanentError when the job is rejected,
+  and a socket.error when the daemon can't be reached (callers may then fall
+  back to a direct insertion in gapps_queue).
+
+  Example usage:
+    SubmitJob("/var/run/gappsd/submit.sock", "u_update",
+              {"username": "foo.bar", "password": "..."}, "immediate")
+  """
+
+  request = {
+    "j_type": j_type,
+    "j_parameters": j_parameters,
+    "p_priority": p_priority,
+  }
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.settimeout(timeout)
+    client.connect(socket_path)
+    client.sendall(simplejson.dumps(request) + "\n")
+    response = simplejson.loads(_ReadLine(client))
+  finally:
+    client.close()
+
+  if response.get("status") != "ok":
+    raise PermanentError("Job rejected: %s" % response.get("message"))
+
+def _ReadLine(connection, max_length=65536):
+  """Reads a newline-terminated message from @p connection."""
+
+  data = ""
+  while not "\n" in data:
+    chunk = connection.recv(4096)
+    if not chunk:
+      break
+    data += chunk
+    if len(data) > max_length:
+      raise ValueError("Message too long")
+  return data.split("\n", 1)[0]
+
+class SubmissionServer(threading.Thread):
+  """Low-latency job submission endpoint: listens on a local UNIX socket for
+  newline-terminated JSON requests {"j_type", "j_parameters", "p_priority"},
+  validates them and writes them to gapps_queue (cf. queue.CreateQueueJob),
+  then calls @p on_submit so that the scheduler dispatches them right away.
+  Each request gets a JSON response, {"status": "ok"} or {"status": "error",
+  "message": ...}.
+
+  Example usage:
+    server = SubmissionServer(config, queue.Wakeup)
+    server.start()
+    ...
+    server.Stop()
+  """
+
+  _CONNECTION_TIMEOUT = 5
+
+  def __init__(self, config, on_submit, sql=None):
+    threading.Thread.__init__(self, name="SubmissionServer")
+    self.daemon = True
+    self._socket_path = config.get_string("gappsd.submit-socket")
+    self._socket_mode = int(config.get_string("gappsd.submit-socket-mode"), 8)
+    self._on_submit = on_submit
+    self._sql = sql or database.SQL(config)
+    self._socket = None
+    self._stopped = False
+
+  def Listen(self):
+    """Binds the submission socket, replacing any stale socket file."""
+
+    if os.path.exists(self._socket_path):
+      os.unlink(self._socket_path)
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The socket file is created with the configured permissions, so that it is
+    # never accessible to other users, even briefly.
+    umask = os.umask(0777 & ~self._socket_mode)
+    try:
+      self._socket.bind(self._socket_path)
+    finally:
+      os.umask(umask)
+    os.chmod(self._socket_path, self._socket_mode)
+    self._socket.listen(16)
+
+  def HandleRequest(self, line):
+    """Validates and enqueues the job described by the JSON @p line, and
+    returns the response dictionary."""
+
+    try:
+      request = simplejson.loads(line)
+      queue.CreateQueueJob(self._sql,
+                           request["j_type"],
+                           request.get("j_parameters", {}),
+                           request.get("p_priority", "normal"))
+    except (ValueError, KeyError, TypeError, AttributeError,
+            job.JobError), message:
+      return {"status": "error", "message": str(message)}
+    except database.SQLTransientError, message:
+      logger.info("Job submission failed: %s" % message)
+      return {"status": "error", "message": "temporary database error"}
+    except database.SQLPermanentError, message:
+      logger.info("Job submission failed: %s" % message)
+      return {"status": "error", "message": str(message)}
+
+    self._on_submit()
+    return {"status": "ok"}
+
+  def _HandleConnection(self, connection):
+    connection.settimeout(self._CONNECTION_TIMEOUT)
+    try:
+      try:
+        response = self.HandleRequest(_ReadLine(connection))
+      except ValueError, message:
+        response = {"status": "error", "message": str(message)}
+      connection.sendall(simplejson.dumps(response) + "\n")
+    except socket.error, message:
+      logger.info("Job submission connection failed: %s" % message)
+    finally:
+      connection.close()
+
+  def run(self):
+    try:
+      while not self._stopped:
+        try:
+          (connection, address) = self._socket.accept()
+        except socket.error:
+          if self._stopped:
+            return
+          logger.info("Job submission accept failed\n" + traceback.format_exc())
+          time.sleep(1)
+          continue
+        try:
+          self._HandleConnection(connection)
+        except Exception:
+          logger.critical("Unexpected error in submission server\n" + \
+            traceback.format_exc())
+    finally:
+      self._sql.Close()
+
+  def Stop(self):
+    """Stops listening, waits for the server thread, and removes the socket
+    file."""
+
+    self._stopped = True
+    if self._socket:
+      try:
+        self._socket.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+      self._socket.close()
+      self._socket = None
+    if self.is_alive():
+      self.join()
+    if os.path.exists(self._socket_path):
+      os.unlink(self._socket_path)
 
 class Daemon(object):
   """The GApps daemon runner: initializes the database, configuration and
@@ -50,6 +210,8 @@ class Daemon(object):
     logger.InitializeLogging(self._config, log_to_stderr)
     self._sql = database.SQL(self._config)
     self._transient_errors = []
+    self._queue = None
+    self._submission_server = None
 
     max_run_time = self._config.get_int("gappsd.max-run-time")
     self._deadline = datetime.datetime.now() + \
@@ -137,6 +299,27 @@ class Daemon(object):
 
     return len(self._transient_errors) >= self._TRANSIENT_ERRORS_THRESHOLD
 
+  def _StartSubmissionServer(self):
+    """Starts the job submission socket, if one is configured."""
+
+    if not self._config.get_string("gappsd.submit-socket"):
+      return
+    self._submission_server = SubmissionServer(self._config, self._WakeupQueue)
+    self._submission_server.Listen()
+    self._submission_server.start()
+
+  def _StopSubmissionServer(self):
+    if self._submission_server:
+      self._submission_server.Stop()
+      self._submission_server = None
+
+  def _WakeupQueue(self):
+    """Wakes up the running queue, if any (called on job submissions)."""
+
+    current_queue = self._queue
+    if current_queue:
+      current_queue.Wakeup()
+
   def _RestartDaemon(self):
     """Restarts the Python daemon, using the execl command. This wipe out the
     current process, and replaces it by a new version."""
@@ -144,6 +327,7 @@ class Daemon(object):
     # Wait for a safety interval to avoid execvp flooding.
     time.sleep(self._SAFETY_RESTART_DELAY)
 
+    self._StopSubmissionServer()
     self._ClosePidFile()
     os.execvp(sys.argv[0], sys.argv)
 
@@ -155,13 +339,15 @@ class Daemon(object):
     logger.info("gappsd is starting ...")
     self._UpdatePidFile()
     self._Daemonize()
+    self._StartSubmissionServer()
 
     while True:
       try:
-        q = queue.Queue(self._config, self._sql, self._deadline)
-        q.Run()
+        self._queue = queue.Queue(self._config, self._sql, self._deadline)
+        self._queue.Run()
       except KeyboardInterrupt, error:
         logger.warning("Received keyboard interruption, aborting gracefully...")
+        self._StopSubmissionServer()
         self._ClosePidFile()
         sys.exit(0)
       except CredentialError, error:
@@ -21,125 +21,1067 @@ for insertion, data update, and generic data retrieving."""
 
 import MySQLdb
 import MySQLdb.cursors as cursors
+import collections
+import contextlib
+import itertools
+import re
+import threading
+import time
 import warnings
 
-from . import logger
+from . import logger, sqlite
 from .logger import PermanentError, TransientError
 
 class SQLTransientError(TransientError):
-  """Generic exception for transient errors (eg. connection lost)"""
-  pass
+  """Generic exception for transient errors (eg. connection lost); the MySQL
+  error code is available in the errno attribute, when known."""
+  errno = None
 
 class SQLPermanentError(PermanentError):
   """Generic exception for permanent errors (eg. SQL syntax error)"""
   pass
 
+class SQLDeadlockError(SQLTransientError):
+  """Indicates that the transaction was rolled back by the server because of a
+  deadlock or a lock wait timeout; it can be retried (cf. RunInTransaction)."""
+  pass
+
+# MySQL error codes of rolled back transactions (ER_LOCK_WAIT_TIMEOUT and
+# ER_LOCK_DEADLOCK).
+_DEADLOCK_ERRORS = (1205, 1213)
+
+# MySQL error codes of connection failures which happen before the statement
+# reaches the server (CR_CONNECTION_ERROR, CR_CONN_HOST_ERROR, and
+# CR_SERVER_GONE_ERROR), and which happen while it is being run
+# (ER_SERVER_SHUTDOWN, CR_SERVER_LOST, and CR_SERVER_LOST_EXTENDED).
+_CONNECTION_ERRORS_BEFORE_QUERY = (2002, 2003, 2006)
+_CONNECTION_ERRORS_DURING_QUERY = (1053, 2013, 2055)
+
+def _GetErrorCode(error):
+  """Returns the MySQL error code of the MySQLdb @p error, or None."""
+
+  if error.args and isinstance(error.args[0], int):
+    return error.args[0]
+  return None
+
+def _IsIdempotent(query):
+  """Returns True iff the @p query can safely be run twice (read queries)."""
+
+  words = query.split(None, 1)
+  return bool(words) and words[0].upper() in ("SELECT", "SHOW")
+
+# Normalization rules of the statement fingerprints (cf. Fingerprint).
+_FINGERPRINT_RULES = [
+  (re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\""), "?"),
+  (re.compile(r"%s|\b\d+(?:\.\d+)?\b"), "?"),
+  (re.compile(r"\s+"), " "),
+  (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?+)"),
+  (re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+"), "(?+)"),
+]
+
+def Fingerprint(query):
+  """Returns the normalized form of the @p query, shared by all the runs of a
+  statement: literals and placeholders are replaced with "?", lists of values
+  with "(?+)", and whitespace is collapsed.
+
+  Example usage:
+    Fingerprint("SELECT * FROM foo WHERE bar IN (%s, %s) LIMIT 10")
+    -> "SELECT * FROM foo WHERE bar IN (?+) LIMIT ?"
+  """
+
+  fingerprint = _fingerprint_cache.Get(query)
+  if fingerprint is None:
+    fingerprint = query
+    for (pattern, replacement) in _FINGERPRINT_RULES:
+      fingerprint = pattern.sub(replacement, fingerprint)
+    fingerprint = _fingerprint_cache.Put(query, fingerprint.strip())
+  return fingerprint
+
+
+class Record(object):
+  """Base class of the compact rows returned by RecordRowFactory: records are
+  namedtuples (one tuple per row, instead of one dictionary), which also
+  support the read-only dictionary interface used on query results (item
+  access and "in" by column name, get, and keys). As with tuples, iterating
+  over a record yields its values.
+
+  Example usage:
+    rows = sql.Query("SELECT foo, bar FROM qux",
+                     row_factory=database.RecordRowFactory)
+    rows[0]["foo"], rows[0].bar
+  """
+
+  __slots__ = ()
+
+  def __getitem__(self, key):
+    if isinstance(key, basestring):
+      try:
+        key = self._column_index[key]
+      except KeyError:
+        raise KeyError(key)
+    return tuple.__getitem__(self, key)
+
+  def __contains__(self, key):
+    return key in self._column_index
+
+  def get(self, key, default=None):
+    if key in self._column_index:
+      return tuple.__getitem__(self, self._column_index[key])
+    return default
+
+  def keys(self):
+    return list(self._column_names)
+
+
+# Record classes, indexed by their column names.
+_record_classes = {}
+
+def RecordRowFactory(columns):
+  """Row factory of SQL.Query and SQL.Iterate returning Record objects: returns
+  the function building the record of a row from its tuple of values."""
+
+  record_class = _record_classes.get(columns)
+  if record_class is None:
+    namedtuple = collections.namedtuple("Row", columns, rename=True)
+    record_class = _record_classes.setdefault(columns, type(
+      "Record", (Record, namedtuple), {
+        "__slots__": (),
+        "_column_names": columns,
+        "_column_index": dict((name, index)
+                              for (index, name) in enumerate(columns)),
+      }))
+  return record_class._make
+
+
+class StatementCache(object):
+  """Bounded LRU cache of generated SQL statement templates, keyed by the
+  statement kind, table, and column names. Cf. the global instance
+  "statement_cache" below, used by SQL.Update and SQL.Insert.
+
+  Lookups don't take the lock (dictionary reads are atomic), and only record
+  the use time of the entry; the least recently used entry is evicted when a
+  new statement is added to a full cache. Hit/miss counters are approximate.
+
+  Example usage:
+    query = statement_cache.Get(("insert", "foo", ("bar",)))
+    if query is None:
+      query = statement_cache.Put(("insert", "foo", ("bar",)),
+                                  "INSERT INTO foo SET bar = %s")
+  """
+
+  def __init__(self, size):
+    self._size = size
+    self._lock = threading.Lock()
+    self._clock = itertools.count()
+    self._statements = {}
+    self._hits = 0
+    self._misses = 0
+
+  def Get(self, key):
+    """Returns the statement of @p key, or None if it is not cached."""
+
+    entry = self._statements.get(key)
+    if entry is None:
+      self._misses += 1
+      return None
+    self._hits += 1
+    entry[1] = next(self._clock)
+    return entry[0]
+
+  def Put(self, key, statement):
+    """Adds the @p statement of @p key to the cache, and returns it."""
+
+    with self._lock:
+      self._statements[key] = [statement, next(self._clock)]
+      if len(self._statements) > self._size:
+        oldest = min(self._statements,
+                     key=lambda k: self._statements[k][1])
+        del self._statements[oldest]
+    return statement
+
+  def Clear(self):
+    with self._lock:
+      self._statements.clear()
+      self._hits = 0
+      self._misses = 0
+
+  def Stats(self):
+    return {
+      "size": len(self._statements),
+      "hits": self._hits,
+      "misses": self._misses,
+    }
+
+
+class ConnectionStats(object):
+  """Process-wide statistics of the MySQL connections: number and latency of
+  connects, and outcome of the liveness checks. Cf. the global instance
+  "connection_stats" below.
+
+  Example usage:
+    stats = database.connection_stats.Stats()
+    print "%d connects, %.1f ms each" % \
+      (stats["connects"], stats["connect_latency"] * 1000)
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.Reset()
+
+  def Reset(self):
+    with self._lock:
+      self._connects = 0
+      self._connect_time = 0.0
+      self._pings = 0
+      self._dead_connections = 0
+      self._retries = 0
+
+  def RecordConnect(self, latency):
+    with self._lock:
+      self._connects += 1
+      self._connect_time += latency
+
+  def RecordPing(self, alive):
+    with self._lock:
+      self._pings += 1
+      if not alive:
+        self._dead_connections += 1
+
+  def RecordRetry(self):
+    with self._lock:
+      self._retries += 1
+
+  def Stats(self):
+    """Returns the connection statistics; the connect latency is the average
+    latency, in seconds."""
+
+    with self._lock:
+      return {
+        "connects": self._connects,
+        "connect_latency":
+          self._connect_time / self._connects if self._connects else 0.0,
+        "pings": self._pings,
+        "dead_connections": self._dead_connections,
+        "retries": self._retries,
+      }
+
+
+class StatementStats(object):
+  """Process-wide statistics of the SQL statements, by fingerprint (cf.
+  Fingerprint): number of runs, total and maximum latency, and rows returned
+  or affected. Cf. the global instance "statement_stats" below.
+
+  Example usage:
+    for stats in database.statement_stats.Top(5):
+      print "%s: %d runs, %.1f ms" % \
+        (stats["statement"], stats["count"], stats["time"] * 1000)
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.Reset()
+
+  def Reset(self):
+    with self._lock:
+      self._statements = {}
+
+  def Record(self, fingerprint, latency, rows):
+    with self._lock:
+      stats = self._statements.get(fingerprint)
+      if stats is None:
+        stats = self._statements[fingerprint] = [0, 0.0, 0.0, 0]
+      stats[0] += 1
+      stats[1] += latency
+      stats[2] = max(stats[2], latency)
+      stats[3] += rows
+
+  def Top(self, count):
+    """Returns the statistics of the @p count statements with the highest total
+    latency, in seconds."""
+
+    with self._lock:
+      statements = sorted(self._statements.items(),
+                          key=lambda item: item[1][1], reverse=True)[:count]
+    return [{
+      "statement": fingerprint,
+      "count": stats[0],
+      "time": stats[1],
+      "max_time": stats[2],
+      "rows": stats[3],
+    } for (fingerprint, stats) in statements]
+
+
+class ThreadStats(threading.local):
+  """Per-thread SQL totals (number of statements, latency, and rows), used to
+  account for the SQL usage of the job run by the thread. Cf. the global
+  instance "thread_stats" below.
+
+  Example usage:
+    database.thread_stats.Reset()
+    job.Run()
+    print "%(queries)d queries, %(time).3f s" % database.thread_stats.Totals()
+  """
+
+  def __init__(self):
+    self.Reset()
+
+  def Reset(self):
+    self._queries = 0
+    self._time = 0.0
+    self._rows = 0
+
+  def Record(self, latency, rows):
+    self._queries += 1
+    self._time += latency
+    self._rows += rows
+
+  def Totals(self):
+    return {
+      "queries": self._queries,
+      "time": self._time,
+      "rows": self._rows,
+    }
+
 
 class SQL(object):
   """Offers a simplified interface to the MySQL database.
   SQL queries offered are: UPDATE (Update), INSERT (Insert), and any other query
-  that fit in the model Query (returns the resulting data) or Execute (returns
-  the number of line of the result).
+  that fit in the model Query (returns the resulting data), Iterate (streams
+  the resulting data) or Execute (returns the number of line of the result).
+
+  The connection is kept open across queries: it is pinged after
+  mysql.ping-interval seconds of inactivity, and reopened after
+  mysql.idle-timeout seconds of inactivity. Queries failing on a lost
+  connection or a deadlock are retried up to mysql.query-retries times (cf.
+  __Query).
+
+  Queries run in autocommit mode, unless they are run in a Transaction (or with
+  RunInTransaction, which also retries deadlocked transactions).
+
+  When mysql.replica-hostname is set, the reads marked as lag-tolerant are sent
+  to the replica, as long as its replication lag (checked every
+  mysql.replica-check-interval seconds) stays under mysql.replica-max-lag
+  seconds; they are sent to the primary server otherwise.
+
+  The latency and rows of each statement are recorded in statement_stats and
+  thread_stats, and statements slower than mysql.slow-query-threshold
+  milliseconds are logged.
 
   Example usage:
     sql = SQL(config)
     sql.Query("SELECT * FROM foo WHERE bar = %s", (qux,))
+    with sql.Transaction():
+      sql.Update("foo", {"bar": qux}, {"id": 42})
+      sql.Insert("qux", {"foo": 42})
     sql.Close()
   """
 
-  def __init__(self, config):
-    """Initializes the SQL object, and opens a connection to the database."""
+  def __init__(self, config, hostname=None):
+    """Initializes the SQL object, and opens a connection to the database. The
+    @p hostname is only used for the connection to the replica server."""
 
-    self._host = config.get_string("mysql.hostname")
+    self._backend = config.get_string("mysql.backend")
+    self._host = hostname or config.get_string("mysql.hostname")
     self._user = config.get_string("mysql.username")
     self._pass = config.get_string("mysql.password")
     self._db = config.get_string("mysql.database")
+    self._idle_timeout = config.get_int("mysql.idle-timeout")
+    self._ping_interval = config.get_int("mysql.ping-interval")
+    self._deadlock_retries = config.get_int("mysql.deadlock-retries")
+    self._query_retries = config.get_int("mysql.query-retries")
+    self._query_retry_delay = config.get_int("mysql.query-retry-delay")
+    self._slow_query_threshold = config.get_int("mysql.slow-query-threshold")
 
     self._connection = None
+    self._last_used = time.time()
+    self._transaction_depth = 0
+    self._transaction_callbacks = []
+
+    self._replica = None
+    self._replica_usable = False
+    self._replica_checked = None
+    self._replica_max_lag = config.get_int("mysql.replica-max-lag")
+    self._replica_check_interval = \
+      config.get_int("mysql.replica-check-interval")
+    if hostname is None and config.get_string("mysql.replica-hostname"):
+      self._replica = SQL(config, config.get_string("mysql.replica-hostname"))
 
   # Operations on underlying connection.
+  def _CheckConnection(self):
+    """Drops the current connection if it has been idle for too long, or if it
+    doesn't answer to a ping after mysql.ping-interval seconds of inactivity."""
+
+    idle_time = time.time() - self._last_used
+    if idle_time >= self._idle_timeout:
+      self._Discard()
+    elif idle_time >= self._ping_interval:
+      try:
+        self._connection.ping()
+        connection_stats.RecordPing(True)
+      except MySQLdb.Error, message:
+        connection_stats.RecordPing(False)
+        logger.info("Dropping dead MySQL connection: %s" % message)
+        self._Discard()
+
+  def _Discard(self):
+    """Closes the current connection, ignoring errors (it may be dead)."""
+
+    try:
+      if not self._connection == None:
+        self._connection.close()
+    except MySQLdb.Error:
+      pass
+    self._connection = None
+
   def Open(self):
     """Opens the connection to the database. If there is already an opened
-    connection, does nothing."""
+    connection, only checks that it is still usable."""
+
+    if self._transaction_depth:
+      # The connection can't be replaced in the middle of a transaction.
+      if self._connection is None:
+        raise SQLTransientError("Error: connection lost during transaction.")
+      self._last_used = time.time()
+      return
+
+    if not self._connection == None:
+      self._CheckConnection()
 
     if self._connection == None:
+      start = time.time()
       try:
-        self._connection = MySQLdb.connect(
-          host=self._host, user=self._user, passwd=self._pass, db=self._db,
-          charset='utf8', use_unicode=True)
+        if self._backend == "sqlite":
+          self._connection = sqlite.Connect(self._db)
+        else:
+          self._connection = MySQLdb.connect(
+            host=self._host, user=self._user, passwd=self._pass, db=self._db,
+            charset='utf8', use_unicode=True)
         self._connection.autocommit(True)
       except MySQLdb.Error, message:
-        raise SQLTransientError("Error: %s" % message)
+        error = SQLTransientError("Error: %s" % message)
+        error.errno = _GetErrorCode(message)
+        raise error
+      connection_stats.RecordConnect(time.time() - start)
+    self._last_used = time.time()
 
   def Close(self):
     """Closes the connection to the database, if one is opened."""
+    if self._replica is not None:
+      self._replica.Close()
     if not self._connection == None:
       self._connection.close()
       self._connection = None
 
+  # Replica routing.
+  def GetReplicationLag(self):
+    """Returns the replication lag of the server, in seconds, or None if the
+    replication is not running."""
+
+    status = self.Query("SHOW SLAVE STATUS")
+    if not status:
+      return None
+    return status[0]["Seconds_Behind_Master"]
+
+  def _GetReadServer(self, lag_tolerant):
+    """Returns the SQL object lag-tolerant reads are sent to: the replica if it
+    is configured and not lagging, the primary otherwise (and in transactions).
+    """
+
+    if not lag_tolerant or self._replica is None or self._transaction_depth:
+      return self
+
+    now = time.time()
+    if self._replica_checked is None or \
+       now - self._replica_checked >= self._replica_check_interval:
+      self._replica_checked = now
+      try:
+        lag = self._replica.GetReplicationLag()
+      except (SQLTransientError, SQLPermanentError), message:
+        logger.info("Replica status check failed: %s" % message)
+        lag = None
+      usable = lag is not None and lag <= self._replica_max_lag
+      if usable != self._replica_usable:
+        logger.info("Sending lag-tolerant reads to the %s (replication lag: "
+                    "%s)" % ("replica" if usable else "primary", lag))
+      self._replica_usable = usable
+    return self._replica if self._replica_usable else self
+
   # Internal SQL query interface.
-  def __Query(self, cursor_class, query, args, fetch=False):
+  def __Query(self, cursor_class, query, args, fetch=False, row_factory=None):
     """Executes the query using the @p args, and resulting in a cursor of the
-    @p class. It also catches MySQL exception, and re-raise them in two forms:
+    @p class. When set, the @p row_factory is called with the tuple of column
+    names, and the resulting function is applied to each (tuple) row.
+    It also catches MySQL exception, and re-raise them in two forms:
 
     * SQLTransientError for potentially transient errors (eg. connection lost).
       In this case, the query should be retried.
     * SQLPermanentError for non-transient errors and warnings (eg. syntax error,
       data error, ...).
+
+    Outside of transactions, transient errors are first retried in place, with
+    a reconnection and an exponential backoff, when the query is known not to
+    have been applied (connection lost before the query, deadlock), or when it
+    is a read query (connection lost while the query was running).
     """
 
-    if self._connection == None:
-      self.Open()
+    attempt = 0
+    start = time.time()
+    (results, data) = (None, None)
+    try:
+      while True:
+        try:
+          (results, data) = \
+            self.__QueryOnce(cursor_class, query, args, fetch, row_factory)
+          return (results, data)
+        except SQLTransientError, message:
+          if not self.__CanRetry(message, query, attempt):
+            raise
+          delay = self._query_retry_delay * 2 ** attempt
+          attempt += 1
+          connection_stats.RecordRetry()
+          logger.info("Retrying SQL query in %d seconds (attempt %d): %s" % \
+            (delay, attempt, message))
+          time.sleep(delay)
+    finally:
+      self.__RecordStatement(query, time.time() - start,
+                             len(data) if data is not None else results or 0)
+
+  def __RecordStatement(self, query, latency, rows):
+    """Records the @p latency (in seconds) and number of @p rows of a statement
+    in the statistics, and logs it if it is slow."""
+
+    fingerprint = Fingerprint(query)
+    statement_stats.Record(fingerprint, latency, rows)
+    thread_stats.Record(latency, rows)
+    if self._slow_query_threshold and \
+       latency * 1000 >= self._slow_query_threshold:
+      logger.warning("Slow SQL query (%.3f s, %d rows): %s" % \
+        (latency, rows, fingerprint))
+
+  def __CanRetry(self, error, query, attempt):
+    """Returns True iff the @p query can be retried after the transient
+    @p error of its @p attempt-th retry (cf. __Query)."""
+
+    if self._transaction_depth or attempt >= self._query_retries:
+      return False
+    if error.errno in _DEADLOCK_ERRORS + _CONNECTION_ERRORS_BEFORE_QUERY:
+      return True
+    if error.errno in _CONNECTION_ERRORS_DURING_QUERY:
+      return _IsIdempotent(query)
+    return False
+
+  def __QueryOnce(self, cursor_class, query, args, fetch, row_factory):
+    """Executes the query once (cf. __Query)."""
+
+    self.Open()
     cursor = self._connection.cursor(cursor_class)
 
     try:
       results = cursor.execute(query, args)
       data = None if not fetch else cursor.fetchall()
-    except MySQLdb.DataError, message:
-      raise SQLPermanentError("DataError: %s" % message)
-    except MySQLdb.IntegrityError, message:
-      raise SQLPermanentError("IntegrityError: %s" % message)
-    except MySQLdb.ProgrammingError, message:
-      raise SQLPermanentError("ProgrammingError: %s" % message)
+      if fetch and row_factory is not None:
+        data = tuple(map(row_factory(self.__GetColumns(cursor)), data))
     except MySQLdb.Warning, message:
       logger.critical("SQL Warning: %s" % message)
       return (False, None)
     except MySQLdb.Error, message:
-      raise SQLTransientError("Error: %s" % message)
+      self.__RaiseError(message)
 
     return (results, data)
 
+  @staticmethod
+  def __GetColumns(cursor):
+    """Returns the tuple of column names of the results of @p cursor."""
+    return tuple([column[0] for column in cursor.description])
+
+  def __RaiseError(self, error):
+    """Re-raises the MySQL @p error as SQLPermanentError or SQLTransientError
+    (cf. __Query)."""
+
+    if isinstance(error, MySQLdb.DataError):
+      raise SQLPermanentError("DataError: %s" % error)
+    if isinstance(error, MySQLdb.IntegrityError):
+      raise SQLPermanentError("IntegrityError: %s" % error)
+    if isinstance(error, MySQLdb.ProgrammingError):
+      raise SQLPermanentError("ProgrammingError: %s" % error)
+    if _GetErrorCode(error) in _DEADLOCK_ERRORS:
+      transient_error = SQLDeadlockError("Deadlock: %s" % error)
+    else:
+      # The connection may be broken; a new one will be opened on next query.
+      self._Discard()
+      transient_error = SQLTransientError("Error: %s" % error)
+    transient_error.errno = _GetErrorCode(error)
+    raise transient_error
+
   # Data manipulations.
   def Update(self, table, values, where):
     """Updates the @p table by setting new values for keys contained in @p
     values, and using the @p where dictionary to select entries.
     Cf. __Query for information on raised exceptions."""
     args = list(values.values()) + list(where.values())
-    query = "UPDATE %s SET " % table + \
-      ", ".join(["%s = %%s" % field for field in values]) + " WHERE " + \
-      " AND ".join(["%s = %%s" % field for field in where])
+    key = ("update", table, tuple(values), tuple(where))
+    query = statement_cache.Get(key)
+    if query is None:
+      query = statement_cache.Put(key, "UPDATE %s SET " % table + \
+        ", ".join(["%s = %%s" % field for field in values]) + " WHERE " + \
+        " AND ".join(["%s = %%s" % field for field in where]))
     return self.Execute(query, args)
 
+  def UpdateMany(self, table, key, rows, chunk_size=100):
+    """Updates several records of the @p table with multi-row UPDATE statements
+    of at most @p chunk_size records: @p rows maps the @p key column values of
+    the records to the dictionaries of their new values, which may set
+    different columns (each column is set with a CASE on the @p key). Returns
+    the number of updated rows.
+    Cf. __Query for information on raised exceptions.
+
+    Example usage:
+      sql.UpdateMany("foo", "id", {42: {"bar": 1}, 43: {"bar": 2, "qux": 3}})
+    """
+    affected = 0
+    items = sorted(rows.items())
+    for start in range(0, len(items), chunk_size):
+      chunk = items[start:start + chunk_size]
+      columns = sorted(set(itertools.chain(
+        *[values.keys() for (key_value, values) in chunk])))
+      assignments = []
+      args = []
+      for column in columns:
+        cases = [(key_value, values[column])
+                 for (key_value, values) in chunk if column in values]
+        assignments.append("%s = CASE %s %s ELSE %s END" % (
+          column, key, " ".join(["WHEN %s THEN %s"] * len(cases)), column))
+        args.extend(itertools.chain(*cases))
+      args.extend([key_value for (key_value, values) in chunk])
+      query = "UPDATE %s SET %s WHERE %s IN (%s)" % (
+        table, ", ".join(assignments), key, ", ".join(["%s"] * len(chunk)))
+      affected += self.Execute(query, args) or 0
+    return affected
+
   def Insert(self, table, values):
     """Inserts a new record in the @p table, using the @p values dictionary
     as data source.
     Cf. __Query for information on raised exceptions."""
     args = list(values.values());
-    query = "INSERT INTO %s SET " % table + \
-      ", ".join(["%s = %%s" % field for field in values])
+    key = ("insert", table, tuple(values))
+    query = statement_cache.Get(key)
+    if query is None:
+      query = statement_cache.Put(key, "INSERT INTO %s SET " % table + \
+        ", ".join(["%s = %%s" % field for field in values]))
     return self.Execute(query, args)
 
+  def InsertMany(self, table, rows, chunk_size=100):
+    """Inserts the @p rows dictionaries in the @p table, using multi-row INSERT
+    statements of at most @p chunk_size rows. All rows must have the same keys,
+    which are used in a consistent (sorted) column order. Returns the number of
+    inserted rows.
+    Cf. __Query for information on raised exceptions."""
+    return self.__InsertRows(table, rows, chunk_size, None)
+
+  def Upsert(self, table, values, update_columns=None):
+    """Inserts the @p values record in the @p table, or updates the existing
+    record with the same unique key. Cf. UpsertMany."""
+    return self.UpsertMany(table, [values], update_columns)
+
+  def UpsertMany(self, table, rows, update_columns=None, chunk_size=100):
+    """Inserts the @p rows dictionaries in the @p table (cf. InsertMany), using
+    INSERT ... ON DUPLICATE KEY UPDATE statements: on existing records, only
+    the @p update_columns (by default, all the columns) are updated. Returns
+    the MySQL affected rows count (1 per inserted row, 2 per updated row).
+    Cf. __Query for information on raised exceptions."""
+    if not rows:
+      return 0
+    if update_columns is None:
+      update_columns = sorted(rows[0])
+    if not update_columns:
+      raise SQLPermanentError(
+        "UpsertMany: no column to update in '%s'." % table)
+    return self.__InsertRows(table, rows, chunk_size, tuple(update_columns))
+
+  def __InsertRows(self, table, rows, chunk_size, update_columns):
+    """Implements InsertMany and UpsertMany (when @p update_columns is set)."""
+    if not rows:
+      return 0
+    columns = tuple(sorted(rows[0]))
+    for row in rows:
+      if len(row) != len(columns) or tuple(sorted(row)) != columns:
+        raise SQLPermanentError(
+          "InsertMany: rows of '%s' have different columns." % table)
+
+    affected = 0
+    for start in range(0, len(rows), chunk_size):
+      chunk = rows[start:start + chunk_size]
+      args = [row[column] for row in chunk for column in columns]
+      key = ("insert-many", table, columns, update_columns, len(chunk))
+      query = statement_cache.Get(key)
+      if query is None:
+        row_template = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        query = "INSERT INTO %s (%s) VALUES " % (table, ", ".join(columns)) + \
+          ", ".join([row_template] * len(chunk))
+        if update_columns:
+          query += " ON DUPLICATE KEY UPDATE " + ", ".join(
+            ["%s = VALUES(%s)" % (column, column) for column in update_columns])
+        query = statement_cache.Put(key, query)
+      affected += self.Execute(query, args) or 0
+    return affected
+
   def Execute(self, query, args=()):
     """Queries the SQL database using the @p query filled with @p args.
     The query returns the number of rows.
     Cf. __Query for information on raised exceptions."""
     return self.__Query(cursors.Cursor, query, args)[0]
 
-  def Query(self, query, args=()):
+  def Query(self, query, args=(), row_factory=None, lag_tolerant=False):
     """Queries the SQL database using the @p query filled with @p args.
-    The query returns a tuple of dictionaries, containing the result.
+    The query returns a tuple of dictionaries, containing the result, or of
+    rows built by the @p row_factory (eg. RecordRowFactory). Queries which are
+    @p lag_tolerant can be sent to the replica (cf. class documentation); they
+    fall back to the primary server on replica errors.
+    Cf. __Query for information on raised exceptions."""
+    server = self._GetReadServer(lag_tolerant)
+    if server is not self:
+      try:
+        return server.Query(query, args, row_factory)
+      except SQLTransientError, message:
+        logger.info("Replica query failed, using the primary: %s" % message)
+        self._replica_usable = False
+
+    if row_factory is None:
+      return self.__Query(cursors.DictCursor, query, args, fetch=True)[1]
+    return self.__Query(cursors.Cursor, query, args, fetch=True,
+                        row_factory=row_factory)[1]
+
+  def Iterate(self, query, args=(), batch_size=1000, row_factory=None,
+              lag_tolerant=False):
+    """Queries the SQL database using the @p query filled with @p args, and
+    yields the resulting rows as dictionaries (or as rows built by the @p
+    row_factory, cf. Query). Rows are streamed from the server (server-side
+    cursor), @p batch_size rows at a time, so that large tables are read with
+    bounded memory. No other query can use the connection until the iteration
+    is over. Iterations which are @p lag_tolerant can be run on the replica
+    (cf. class documentation); they fall back to the primary server on
+    replica errors, unless rows were already yielded.
     Cf. __Query for information on raised exceptions."""
-    return self.__Query(cursors.DictCursor, query, args, fetch=True)[1]
+
+    server = self._GetReadServer(lag_tolerant)
+    if server is not self:
+      rows = server.Iterate(query, args, batch_size, row_factory)
+      try:
+        first_row = next(rows)
+      except StopIteration:
+        return
+      except SQLTransientError, message:
+        logger.info("Replica query failed, using the primary: %s" % message)
+        self._replica_usable = False
+      else:
+        yield first_row
+        for row in rows:
+          yield row
+        return
+
+    for row in self.__Iterate(query, args, batch_size, row_factory):
+      yield row
+
+  def __Iterate(self, query, args, batch_size, row_factory):
+    """Implements Iterate, on the current server."""
+
+    self.Open()
+    cursor = self._connection.cursor(
+      cursors.SSDictCursor if row_factory is None else cursors.SSCursor)
+    # Only the time spent in the server calls is accounted for.
+    latency = 0.0
+    row_count = 0
+    try:
+      start = time.time()
+      try:
+        cursor.execute(query, args)
+      except MySQLdb.Warning, message:
+        logger.critical("SQL Warning: %s" % message)
+        return
+      except MySQLdb.Error, message:
+        self.__RaiseError(message)
+      finally:
+        latency += time.time() - start
+      if row_factory is not None:
+        make_row = row_factory(self.__GetColumns(cursor))
+
+      while True:
+        start = time.time()
+        try:
+          rows = cursor.fetchmany(batch_size)
+        except MySQLdb.Error, message:
+          self.__RaiseError(message)
+        finally:
+          latency += time.time() - start
+        if not rows:
+          break
+        row_count += len(rows)
+        if row_factory is not None:
+          rows = map(make_row, rows)
+        for row in rows:
+          yield row
+    finally:
+      self.__RecordStatement(query, latency, row_count)
+      # Closing the cursor consumes the rows not yet read.
+      if self._connection is not None:
+        try:
+          cursor.close()
+        except MySQLdb.Error:
+          self._Discard()
+      self._last_used = time.time()
+
+  # Transactions.
+  def InTransaction(self):
+    """Returns True iff the queries are currently run in a transaction."""
+    return self._transaction_depth > 0
+
+  def AddTransactionCallback(self, callback):
+    """Calls @p callback(committed) at the end of the current transaction, with
+    committed set to True iff the transaction was committed."""
+    self._transaction_callbacks.append(callback)
+
+  @contextlib.contextmanager
+  def Transaction(self):
+    """Runs the queries of the with-block in a single transaction, which is
+    committed at the end of the block, or rolled back if the block raises an
+    exception. Nested transactions are merged with the outermost one.
+    Cf. __Query for information on raised exceptions."""
+
+    if self._transaction_depth:
+      self._transaction_depth += 1
+      try:
+        yield self
+      finally:
+        self._transaction_depth -= 1
+      return
+
+    self.Execute("START TRANSACTION")
+    self._transaction_depth = 1
+    committed = False
+    try:
+      yield self
+      # The COMMIT is part of the transaction: it is never retried, nor sent on
+      # a new connection, where it would silently commit nothing.
+      self.Execute("COMMIT")
+      committed = True
+    except:
+      self.__Rollback()
+      raise
+    finally:
+      self._transaction_depth = 0
+      (callbacks, self._transaction_callbacks) = \
+        (self._transaction_callbacks, [])
+      for callback in callbacks:
+        callback(committed)
+
+  def __Rollback(self):
+    """Rolls back the current transaction; errors are only logged, as the
+    original exception is more relevant (and as a transaction is rolled back
+    anyway when its connection is lost)."""
+
+    if self._connection is None:
+      return
+    try:
+      self.Execute("ROLLBACK")
+    except (SQLTransientError, SQLPermanentError), message:
+      logger.info("Failed to rollback transaction: %s" % message)
+
+  def RunInTransaction(self, function, *args):
+    """Calls @p function(*args) in a Transaction, and returns its result. The
+    transaction is retried (up to mysql.deadlock-retries times) when it is
+    rolled back by a deadlock, unless it is nested in an outer transaction.
+    The @p function must thus only have side effects on the database."""
+
+    attempt = 1
+    while True:
+      try:
+        with self.Transaction():
+          return function(*args)
+      except SQLDeadlockError, message:
+        if self._transaction_depth or attempt > self._deadlock_retries:
+          raise
+        logger.info("Retrying transaction after deadlock: %s" % message)
+        attempt += 1
+
+class ConnectionPool(object):
+  """Thread-safe pool of SQL objects, for components running queries from
+  several threads (eg. the worker threads). Connections are checked out with
+  the Connection() context manager; idle connections are validated on checkout
+  (cf. SQL.Open), and replaced after mysql.pool-max-lifetime seconds. When all
+  the mysql.pool-max-size connections are in use, checkouts wait for at most
+  mysql.pool-timeout seconds, and then raise a SQLTransientError.
+
+  Example usage:
+    pool = ConnectionPool(config)
+    with pool.Connection() as sql:
+      sql.Query("SELECT * FROM foo WHERE bar = %s", (qux,))
+    pool.Close()
+  """
+
+  def __init__(self, config, max_size=None):
+    self._config = config
+    self._min_size = config.get_int("mysql.pool-min-size")
+    self._max_size = max(max_size or 0, config.get_int("mysql.pool-max-size"))
+    self._timeout = config.get_int("mysql.pool-timeout")
+    self._max_lifetime = config.get_int("mysql.pool-max-lifetime")
+
+    self._condition = threading.Condition()
+    self._idle = []
+    self._size = 0
+    self._in_use = 0
+    self._waiters = 0
+    self._checkouts = 0
+    self._wait_time = 0.0
+    self._timeouts = 0
+
+  # Checkout and checkin of connections.
+  def Acquire(self):
+    """Returns a (sql, creation date) checkout from the pool; it must be given
+    back with Release(). Raises a SQLTransientError when the pool is
+    exhausted."""
+
+    start = time.time()
+    checkout = None
+    expired = []
+    with self._condition:
+      while checkout is None:
+        while self._idle and checkout is None:
+          (sql, created) = self._idle.pop()
+          if time.time() - created < self._max_lifetime:
+            checkout = (sql, created)
+          else:
+            expired.append(sql)
+            self._size -= 1
+
+        if checkout is None and self._size < self._max_size:
+          checkout = (None, time.time())
+          self._size += 1
+
+        if checkout is None:
+          remaining = start + self._timeout - time.time()
+          if remaining <= 0:
+            self._timeouts += 1
+            raise SQLTransientError(
+              "No MySQL connection available after %d seconds (%d in use)" % \
+              (self._timeout, self._in_use))
+          self._waiters += 1
+          self._condition.wait(remaining)
+          self._waiters -= 1
+
+      self._in_use += 1
+      self._checkouts += 1
+      self._wait_time += time.time() - start
+
+    for sql in expired:
+      sql._Discard()
+
+    # New connections are opened lazily, by their first query; reused ones are
+    # validated (cf. SQL.Open, which pings connections which have been idle).
+    if checkout[0] is None:
+      return (SQL(self._config), checkout[1])
+    try:
+      checkout[0].Open()
+    except SQLTransientError:
+      self.Release(checkout, discard=True)
+      raise
+    return checkout
+
+  def Release(self, checkout, discard=False):
+    """Gives back the @p checkout obtained from Acquire() to the pool; the
+    connection is closed if @p discard is True."""
+
+    (sql, created) = checkout
+    with self._condition:
+      self._in_use -= 1
+      if discard:
+        self._size -= 1
+      else:
+        self._idle.append((sql, created))
+      self._condition.notify()
+    if discard:
+      sql._Discard()
+
+  @contextlib.contextmanager
+  def Connection(self):
+    """Context manager checking out an SQL object from the pool. Connections
+    are discarded when the block raises a transient SQL error, except for
+    deadlocks (the connection is still usable)."""
+
+    checkout = self.Acquire()
+    try:
+      yield checkout[0]
+    except SQLDeadlockError:
+      self.Release(checkout)
+      raise
+    except SQLTransientError:
+      self.Release(checkout, discard=True)
+      raise
+    except:
+      self.Release(checkout)
+      raise
+    else:
+      self.Release(checkout)
+
+  # Pool management.
+  def Prefill(self):
+    """Opens connections until the pool holds mysql.pool-min-size of them."""
+
+    while True:
+      with self._condition:
+        if self._size >= self._min_size:
+          return
+        self._size += 1
+      sql = SQL(self._config)
+      try:
+        sql.Open()
+      except SQLTransientError:
+        with self._condition:
+          self._size -= 1
+        raise
+      with self._condition:
+        self._idle.append((sql, time.time()))
+        self._condition.notify()
+
+  def Close(self):
+    """Closes the idle connections of the pool."""
+
+    with self._condition:
+      idle = self._idle
+      self._idle = []
+      self._size -= len(idle)
+    for (sql, created) in idle:
+      sql._Discard()
+
+  def Stats(self):
+    """Returns the pool metrics: connections opened, idle, and in use, current
+    waiters, checkouts, average checkout wait time (in seconds), and
+    checkout timeouts."""
+
+    with self._condition:
+      return {
+        "size": self._size,
+        "idle": len(self._idle),
+        "in_use": self._in_use,
+        "waiters": self._waiters,
+        "checkouts": self._checkouts,
+        "wait_time":
+          self._wait_time / self._checkouts if self._checkouts else 0.0,
+        "timeouts": self._timeouts,
+      }
+
+
+# Connection statistics of the process.
+connection_stats = ConnectionStats()
+
+# Statement templates of SQL.Update and SQL.Insert.
+statement_cache = StatementCache(256)
+
+# Statement statistics of the process, and SQL totals of the current thread.
+statement_stats = StatementStats()
+thread_stats = ThreadStats()
+
+# Fingerprints of the recently run queries.
+_fingerprint_cache = StatementCache(256)
 
 # Initialization: transforms MySQL warnings in errors.
 warnings.simplefilter("error", MySQLdb.Warning)
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental queue-depth tracking for the GApps daemon: keeps the number of
+runnable jobs per priority class in memory, instead of re-aggregating the whole
+queue on each scheduling round."""
+
+import heapq
+import threading
+
+class QueueDepthTracker(object):
+  """In-memory per-priority counts of runnable jobs. The tracker is fed by the
+  queue with a full recount every @p recount_interval seconds (which corrects
+  any drift, eg. jobs claimed by another daemon), with the jobs inserted since
+  the last known q_id (cf. ScanStart), and with the scheduler's own state
+  transitions (claims, releases, and deferred softfails). Jobs which are not
+  yet runnable (not-before date in the future) are kept in a heap until they
+  become due.
+
+  As jobs can be committed out of q_id order (eg. jobs created in a long
+  transaction), the last _TRAILING_WINDOW q_ids below the high-water mark can
+  be scanned again; the jobs already accounted for are then ignored.
+
+  Example usage:
+    tracker = QueueDepthTracker(["immediate", "normal", "offline"], 300)
+    if tracker.NeedsRecount(now):
+      tracker.SetCounts(counts, deferred_jobs, high_water_mark, now)
+    else:
+      # new_job_rows: jobs with a q_id above tracker.ScanStart().
+      tracker.AddNewJobs(new_job_rows, now)
+    tracker.OnClaimed("normal")
+    tracker.Counts(now)
+  """
+
+  # Number of q_ids below the high-water mark scanned again for late jobs.
+  _TRAILING_WINDOW = 100
+
+  def __init__(self, priorities, recount_interval):
+    self._priorities = priorities
+    self._recount_interval = recount_interval
+    self._lock = threading.Lock()
+
+    self._counts = dict([(priority, 0) for priority in priorities])
+    self._deferred = []
+    self._high_water_mark = None
+    self._recount_mark = None
+    self._recent_jobs = set()
+    self._last_recount = None
+    self._recounts = 0
+    self._new_jobs = 0
+
+  # Full recounts.
+  def NeedsRecount(self, now):
+    """Returns True iff the counts should be rebuilt from the database."""
+
+    with self._lock:
+      return self._last_recount is None or \
+        now - self._last_recount >= self._recount_interval
+
+  def SetCounts(self, counts, deferred_jobs, high_water_mark, now):
+    """Resets the tracker with the runnable job @p counts, the list of
+    (priority, notbefore timestamp) of @p deferred_jobs, and the highest q_id
+    present in the queue."""
+
+    with self._lock:
+      self._counts = dict([(priority, counts.get(priority, 0))
+                           for priority in self._priorities])
+      self._deferred = [(notbefore, priority)
+                        for (priority, notbefore) in deferred_jobs]
+      heapq.heapify(self._deferred)
+      self._high_water_mark = high_water_mark
+      self._recount_mark = high_water_mark
+      self._recent_jobs = set()
+      self._last_recount = now
+      self._recounts += 1
+
+  # Incremental updates.
+  def HighWaterMark(self):
+    """Returns the highest q_id known to the tracker (or None)."""
+
+    with self._lock:
+      return self._high_water_mark
+
+  def ScanStart(self, trailing=False):
+    """Returns the q_id above which new jobs are to be looked for: the
+    high-water mark, or with @p trailing, the start of the trailing window
+    below it (jobs already accounted for since the last recount)."""
+
+    with self._lock:
+      return self.__ScanStart(trailing)
+
+  def __ScanStart(self, trailing):
+    if not trailing:
+      return self._high_water_mark
+    return max(self._recount_mark,
+               self._high_water_mark - self._TRAILING_WINDOW)
+
+  def AddNewJobs(self, rows, now):
+    """Accounts for the jobs inserted since the last scan (cf. ScanStart); @p
+    rows are dictionaries with q_id, p_priority, p_status, p_admin_request and
+    p_notbefore_date (as a timestamp) keys. Returns the number of jobs which
+    were not known yet."""
+
+    unknown = 0
+    with self._lock:
+      for row in rows:
+        if row["q_id"] <= self._recount_mark or \
+           row["q_id"] in self._recent_jobs:
+          continue
+        self._recent_jobs.add(row["q_id"])
+        self._high_water_mark = max(self._high_water_mark, row["q_id"])
+        unknown += 1
+        if row["p_admin_request"] or \
+           not row["p_status"] in ("idle", "softfail") or \
+           not row["p_priority"] in self._counts:
+          continue
+        self._new_jobs += 1
+        if row["p_notbefore_date"] > now:
+          heapq.heappush(self._deferred,
+                         (row["p_notbefore_date"], row["p_priority"]))
+        else:
+          self._counts[row["p_priority"]] += 1
+
+      scan_start = self.__ScanStart(True)
+      self._recent_jobs = set([q_id for q_id in self._recent_jobs
+                               if q_id > scan_start])
+    return unknown
+
+  def OnClaimed(self, priority, count=1):
+    """Accounts for @p count jobs of @p priority claimed by the scheduler."""
+
+    with self._lock:
+      if priority in self._counts:
+        self._counts[priority] = max(self._counts[priority] - count, 0)
+
+  def OnReleased(self, priority, count=1):
+    """Accounts for @p count claimed jobs returned to the queue unprocessed."""
+
+    with self._lock:
+      if priority in self._counts:
+        self._counts[priority] += count
+
+  def OnDeferred(self, priority, notbefore):
+    """Accounts for a job returned to the queue, runnable at @p notbefore."""
+
+    with self._lock:
+      if priority in self._counts:
+        heapq.heappush(self._deferred, (notbefore, priority))
+
+  # Accessors.
+  def Counts(self, now):
+    """Returns the current per-priority counts of runnable jobs, after
+    promoting the deferred jobs which became due before @p now."""
+
+    with self._lock:
+      while self._deferred and self._deferred[0][0] <= now:
+        (notbefore, priority) = heapq.heappop(self._deferred)
+        self._counts[priority] += 1
+      return dict(self._counts)
+
+  def Stats(self):
+    """Returns the tracker statistics: number of deferred jobs, of full
+    recounts, and of jobs picked up from the high-water mark."""
+
+    with self._lock:
+      return {
+        "deferred": len(self._deferred),
+        "recounts": self._recounts,
+        "new_jobs": self._new_jobs,
+      }
@@ -25,6 +25,7 @@ import simplejson
 import sys
 
 import logger
+import writeback
 
 class JobError(Exception):
   """The mother exception of all job-related exceptions."""
@@ -64,6 +65,9 @@ class JobRegistry(object):
   def Register(self, job_type, job_class):
     self._job_types[job_type] = job_class;
 
+  def IsRegistered(self, job_type):
+    return job_type in self._job_types
+
   def Instantiate(self, job_type, *args):
     try:
       return self._job_types[job_type](*args)
@@ -162,14 +166,14 @@ class Job(object):
   @staticmethod
   def MarkFailed(sql, queue_id, message):
     """Used to mark a non-instantiable job as such. Updates the job as if it
-    was an hard failure."""
+    was an hard failure (cf. writeback.Write)."""
 
     values = {
       "p_status": Job.STATUS_HARDFAIL,
       "p_end_date": datetime.datetime.now().strftime(Job._DATE_FORMAT),
       "r_result": str(message)[0:256] if message else message,
     }
-    sql.Update("gapps_queue", values, {"q_id": queue_id})
+    writeback.Write(sql, queue_id, values)
 
   def MarkAdmin(self):
     """Marks the job as being an "admin-only" task (eg. administrator's password
@@ -181,7 +185,7 @@ class Job(object):
       "p_admin_request": True,
     }
     self._data.update(values)
-    self._sql.Update("gapps_queue", values, {"q_id": self._data['q_id']})
+    writeback.Write(self._sql, self._data['q_id'], values)
     logger.critical("Job marked as admin-only",
                     extra={"details": self.__longstr__()})
 
@@ -193,11 +197,12 @@ class Job(object):
       "p_start_date": datetime.datetime.now().strftime(self._DATE_FORMAT),
     }
     self._data.update(values)
-    self._sql.Update("gapps_queue", values, {"q_id": self._data['q_id']})
+    writeback.Write(self._sql, self._data['q_id'], values)
 
   def Update(self, status, message=""):
     """Updates the object status /in/ the queue (using the queue interface
-    to manipulate the queue)."""
+    to manipulate the queue). The update may be buffered by the status writer
+    of the queue (cf. writeback.Write)."""
 
     values = {}
     now = datetime.datetime.now().strftime(self._DATE_FORMAT)
@@ -237,7 +242,17 @@ class Job(object):
       raise JobActionError("Unknown status %s" % status)
 
     self._data.update(values)
-    self._sql.Update("gapps_queue", values, {"q_id": self._data['q_id']})
+    writeback.Write(self._sql, self._data['q_id'], values)
+
+  def Complete(self, function, *args):
+    """Runs the database writes of @p function(*args), and marks the job as
+    successful, in a single transaction (cf. SQL.RunInTransaction: the
+    @p function may be called again when the transaction is retried)."""
+
+    def CompleteTransaction():
+      function(*args)
+      self.Update(self.STATUS_SUCCESS)
+    self._sql.RunInTransaction(CompleteTransaction)
 
   # "Abstract" implementation of the Run method.
   def Run(self):
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lease subsystem of the GApps daemon. Claimed jobs hold a lease (column
+p_lease_expiry of the queue) which is renewed by a heartbeat thread while the
+job runs; only jobs with an expired lease are reclaimed by the queue (for
+instance after a crash of the daemon running them)."""
+
+import datetime
+import threading
+import traceback
+
+from . import logger
+
+class LeaseKeeper(threading.Thread):
+  """Heartbeat thread renewing the leases of the jobs claimed by this daemon.
+  Leases are identified by the claim token of the job, so that a job reclaimed
+  by another daemon cannot have its lease renewed by its previous owner.
+
+  Example usage:
+    keeper = LeaseKeeper(config, connections)
+    keeper.start()
+    keeper.Add(job_dict["q_id"], job_dict["p_claim_token"], "r_accounts")
+    ...
+    keeper.Remove(job_dict["q_id"])
+    keeper.Stop()
+  """
+
+  _DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+  def __init__(self, config, connections):
+    threading.Thread.__init__(self, name="LeaseKeeper")
+    self.daemon = True
+    self._connections = connections
+    self._default_duration = config.get_int("gappsd.lease-duration")
+    self._durations = config.get_int_dict("gappsd.lease-duration-per-type")
+    self._interval = max(min([self._default_duration] +
+                             list(self._durations.values())) / 3, 1)
+
+    self._leases = {}
+    self._lock = threading.Lock()
+    self._stop_event = threading.Event()
+
+  # Lease management.
+  def GetDuration(self, j_type):
+    """Returns the lease duration, in seconds, for jobs of type @p j_type."""
+
+    return self._durations.get(j_type, self._default_duration)
+
+  def GetExpiry(self, j_type, now=None):
+    """Returns the expiry date of a lease taken (or renewed) @p now."""
+
+    if now is None:
+      now = datetime.datetime.now()
+    return now + datetime.timedelta(0, self.GetDuration(j_type))
+
+  def Add(self, q_id, token, j_type):
+    """Starts renewing the lease of job @p q_id, claimed with @p token."""
+
+    with self._lock:
+      self._leases[q_id] = (token, self.GetDuration(j_type))
+
+  def Remove(self, q_id):
+    """Stops renewing the lease of job @p q_id."""
+
+    with self._lock:
+      self._leases.pop(q_id, None)
+
+  def Count(self):
+    with self._lock:
+      return len(self._leases)
+
+  def RenewAll(self, sql):
+    """Renews all the held leases, with one UPDATE per lease duration."""
+
+    tokens_by_duration = {}
+    with self._lock:
+      for (token, duration) in self._leases.values():
+        tokens_by_duration.setdefault(duration, []).append(token)
+
+    now = datetime.datetime.now()
+    for (duration, tokens) in sorted(tokens_by_duration.items()):
+      expiry = now + datetime.timedelta(0, duration)
+      sql_query = "UPDATE gapps_queue SET p_lease_expiry = %%s " \
+        "WHERE p_claim_token IN (%s)" % ", ".join(["%s"] * len(tokens))
+      renewed = sql.Execute(
+        sql_query, [expiry.strftime(self._DATE_FORMAT)] + tokens)
+      if renewed < len(tokens):
+        logger.warning("Lost %d job leases (jobs reclaimed by another worker)" \
+          % (len(tokens) - renewed))
+
+  # Heartbeat thread.
+  def run(self):
+    while not self._stop_event.wait(self._interval):
+      try:
+        with self._connections.Connection() as sql:
+          self.RenewAll(sql)
+      except Exception:
+        logger.info("Lease renewal failed\n" + traceback.format_exc())
+
+  def Stop(self):
+    """Stops the heartbeat thread."""
+
+    self._stop_event.set()
+    if self.is_alive():
+      self.join()
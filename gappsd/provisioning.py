@@ -69,6 +69,13 @@ class UserJob(ProvisioningJob):
     "suspended": re.compile(r"^(true|false)$", re.I),
   }
 
+  def _SynchronizeAccount(self, user_entry):
+    """Loads the SQL account of the job's user, and synchronizes it with the
+    Google @p user_entry (cf. UserSynchronizeJob.Synchronize)."""
+
+    a = account.LoadAccountFromDatabase(self._sql, self._parameters["username"])
+    UserSynchronizeJob.Synchronize(self._sql, account=a, user_entry=user_entry)
+
 
 class UserCreateJob(UserJob):
   """Implements the account creation request."""
@@ -109,10 +116,7 @@ class UserCreateJob(UserJob):
     })
 
     # Creates the account in the SQL database.
-    a = account.LoadAccountFromDatabase(self._sql, self._parameters["username"])
-    UserSynchronizeJob.Synchronize(self._sql, account=a, user_entry=user)
-
-    self.Update(self.STATUS_SUCCESS)
+    self.Complete(self._SynchronizeAccount, user)
 
 
 class UserDeleteJob(UserJob):
@@ -145,12 +149,13 @@ class UserDeleteJob(UserJob):
 
     # Removes the account from the databases.
     self._api.DeleteUser(self._parameters["username"])
+    self.Complete(self._DeleteAccount)
+
+  def _DeleteAccount(self):
     a = account.LoadAccountFromDatabase(self._sql, self._parameters["username"])
     if a:
       a.Delete(self._sql)
 
-    self.Update(self.STATUS_SUCCESS)
-
 
 class UserSynchronizeJob(UserJob):
   """Implements the account synchronization job; such a job aims at
@@ -190,7 +195,7 @@ class UserSynchronizeJob(UserJob):
     a.set('g_last_name', user_entry['name']['familyName'])
     a.set('g_status', a.STATUS_DISABLED if suspended else a.STATUS_ACTIVE)
     a.set('g_admin', admin)
-    a.Create(sql)
+    a.Upsert(sql)
 
   @staticmethod
   def SynchronizeNoGoogle(sql, account):
@@ -251,11 +256,8 @@ class UserSynchronizeJob(UserJob):
     """Loads the two version of the account (SQL and Google), and
     synchronizes them."""
 
-    a = account.LoadAccountFromDatabase(self._sql, self._parameters["username"])
     user = self._api.RetrieveUser(self._parameters["username"])
-    UserSynchronizeJob.Synchronize(self._sql, a, user)
-
-    self.Update(self.STATUS_SUCCESS)
+    self.Complete(self._SynchronizeAccount, user)
 
 
 class UserUpdateJob(UserJob):
@@ -298,10 +300,7 @@ class UserUpdateJob(UserJob):
     user = self._api.UpdateUser(self._parameters["username"], user)
 
     # Updates the SQL account.
-    a = account.LoadAccountFromDatabase(self._sql, self._parameters["username"])
-    UserSynchronizeJob.Synchronize(self._sql, account=a, user_entry=user)
-
-    self.Update(self.STATUS_SUCCESS)
+    self.Complete(self._SynchronizeAccount, user)
 
 
 class NicknameJob(ProvisioningJob):
@@ -338,13 +337,11 @@ class NicknameCreateJob(NicknameJob):
         nickname = self._parameters["nickname"])
 
     # Creates the nickname in the SQL database.
-    self._sql.Insert("gapps_nicknames", dict(
+    self.Complete(self._sql.Insert, "gapps_nicknames", dict(
       g_account_name = self._parameters["username"],
       g_nickname = self._parameters["nickname"],
     ))
 
-    self.Update(self.STATUS_SUCCESS)
-
 
 class NicknameDeleteJob(NicknameJob):
   """Implements the nickname deletion request."""
@@ -365,9 +362,9 @@ class NicknameDeleteJob(NicknameJob):
         nickname = self._parameters["nickname"])
 
     # Removes the nickname from the databases.
-    self._sql.Execute("DELETE FROM gapps_nicknames WHERE g_nickname = %s",
-                      self._parameters["nickname"])
-    self.Update(self.STATUS_SUCCESS)
+    self.Complete(self._sql.Execute,
+                  "DELETE FROM gapps_nicknames WHERE g_nickname = %s",
+                  self._parameters["nickname"])
 
 
 class NicknameResyncJob(NicknameJob):
@@ -386,43 +383,52 @@ class NicknameResyncJob(NicknameJob):
   def _GetNicknamesFromSql(self):
     """Retrieves the known list of nicknames from MySQL."""
 
-    nicknames = self._sql.Query("SELECT * FROM gapps_nicknames")
+    nicknames = self._sql.Iterate(
+      "SELECT g_nickname, g_account_name FROM gapps_nicknames")
 
     sql_nicknames = {}
     for nickname in nicknames:
        sql_nicknames[nickname["g_nickname"]] = nickname["g_account_name"]
     return sql_nicknames
 
-  def _CreateSqlNickname(self, nickname, username):
-    self._sql.Insert("gapps_nicknames",
-                     dict(g_account_name = username, g_nickname = nickname))
+  def _CreateSqlNicknames(self, nicknames):
+    """Inserts the (nickname, username) pairs of @p nicknames in bulk."""
+
+    self._sql.InsertMany("gapps_nicknames", [
+      dict(g_account_name = username, g_nickname = nickname)
+      for (nickname, username) in nicknames])
 
   def _DeleteSqlNickname(self, nickname):
     self._sql.Execute("DELETE FROM gapps_nicknames WHERE g_nickname = %s",
                       nickname)
 
+  def _UpdateSqlNicknames(self, deleted_nicknames, new_nicknames):
+    for nickname in deleted_nicknames:
+      self._DeleteSqlNickname(nickname)
+    self._CreateSqlNicknames(new_nicknames)
+
   def Run(self):
     """Compares nicknames from Google and from Sql, and update the SQL list."""
 
     google_nicknames = dict(self._GetNicknamesFromGoogle())
     sql_nicknames = self._GetNicknamesFromSql()
+    deleted_nicknames = []
+    new_nicknames = []
 
     # Check that Google nicknames are in the SQL database.
     for nickname in google_nicknames:
       if nickname not in sql_nicknames:
-        self._CreateSqlNickname(nickname, google_nicknames[nickname])
+        new_nicknames.append((nickname, google_nicknames[nickname]))
       else:
         if sql_nicknames[nickname] != google_nicknames[nickname]:
-          self._DeleteSqlNickname(nickname)
-          self._CreateSqlNickname(nickname, google_nicknames[nickname])
+          deleted_nicknames.append(nickname)
+          new_nicknames.append((nickname, google_nicknames[nickname]))
 
         del sql_nicknames[nickname]
 
-    # Invalidates SQL-only nicknames.
-    for nickname in sql_nicknames:
-      self._DeleteSqlNickname(nickname)
-
-    self.Update(self.STATUS_SUCCESS)
+    # Invalidates SQL-only nicknames, and adds the new ones.
+    deleted_nicknames.extend(sql_nicknames)
+    self.Complete(self._UpdateSqlNicknames, deleted_nicknames, new_nicknames)
 
 
 class ProvisioningApiClient(object):
@@ -17,38 +17,83 @@
 
 """The Queue module of the GApps daemon."""
 
+import collections
 import datetime
 import pprint
 import simplejson
 import sys
+import threading
 import time
+import uuid
 
-import database, job
+import api, database, depth, job, lease, worker, writeback
 from . import logger
 from .logger import PermanentError, TransientError
 
+def ValidateQueueJob(j_type, j_parameters, p_priority):
+  """Checks that a new queue job has a registered type, a valid priority, and
+  serializable parameters. Raises a job.JobError otherwise."""
+
+  if not job.job_registry.IsRegistered(j_type):
+    raise job.JobTypeError("Job '%s' is undefined." % j_type)
+  if not p_priority in Queue._PRIORITY_ORDER:
+    raise job.JobContentError("Priority '%s' is invalid." % p_priority)
+  try:
+    simplejson.dumps(j_parameters)
+  except (TypeError, ValueError), message:
+    raise job.JobContentError("Invalid job parameters: %s" % message)
+
 def CreateQueueJob(sql, j_type, j_parameters={}, p_priority="normal",
                    p_entry_date=None, p_notbefore_date=None):
   """Creates a new queue job, based on the parameters."""
 
+  sql.Insert("gapps_queue", _GetQueueJobValues(
+    j_type, j_parameters, p_priority, p_entry_date, p_notbefore_date))
+  NotifyQueueChange(sql)
+
+def CreateQueueJobs(sql, jobs, p_priority="normal", p_entry_date=None):
+  """Creates the queue jobs listed as (j_type, j_parameters) pairs in @p jobs,
+  using multi-row inserts and a single queue change notification."""
+
+  if not jobs:
+    return
+  if p_entry_date is None:
+    p_entry_date = datetime.datetime.now()
+  sql.InsertMany("gapps_queue", [
+    _GetQueueJobValues(j_type, j_parameters, p_priority, p_entry_date, None)
+    for (j_type, j_parameters) in jobs])
+  NotifyQueueChange(sql)
+
+def _GetQueueJobValues(j_type, j_parameters, p_priority, p_entry_date,
+                       p_notbefore_date):
+  """Validates the new queue job, and returns its gapps_queue values."""
+
+  ValidateQueueJob(j_type, j_parameters, p_priority)
   if p_entry_date is None:
     p_entry_date = datetime.datetime.now()
   if p_notbefore_date is None:
     p_notbefore_date = p_entry_date
 
-  values = {
+  return {
     "j_type": j_type,
     "j_parameters": simplejson.dumps(j_parameters),
     "p_priority": p_priority,
     "p_entry_date": p_entry_date.strftime("%Y-%m-%d %H:%M:%S"),
     "p_notbefore_date": p_notbefore_date.strftime("%Y-%m-%d %H:%M:%S"),
   }
-  sql.Insert("gapps_queue", values)
+
+def NotifyQueueChange(sql):
+  """Bumps the queue change marker, so as to wake up the idle queue runners
+  (cf. Queue._WaitForNextJob). Should be called after adding queue jobs."""
+
+  sql.Execute("UPDATE gapps_queue_sequence SET seq = seq + 1")
 
 class Queue(object):
   """Queue manager for the GApps daemon. It handles the complete queue
   processing: it extracts jobs in respect with the scheduling constraints,
-  it runs them, and it handles their errors.
+  it runs them, and it handles their errors. When gappsd.queue-workers is
+  positive, claimed jobs are run concurrently by a worker.WorkerPool instead
+  of being run in the queue loop.
 
   Example usage:
     queue = Queue(config, sql)
@@ -62,23 +107,49 @@ class Queue(object):
   _OVERFLOW_WARNING_DELAY = 3600
   _MAX_QUEUE_DELAY = 24 * 3600
   _STATISTICS_DELAY = 1800
+  _STATISTICS_STATEMENTS = 5
 
+  # Active jobs are only runnable once their lease has expired (jobs claimed
+  # before the introduction of leases use the former 90 seconds delay). The
+  # clauses only compare raw columns with bound dates (cf.
+  # _GetActiveJobsCondition), so that they can use the p_runnable index.
+  _LEGACY_CLAIM_DELAY = 90
   _ACTIVE_JOBS_WHERE_CLAUSE = \
+    "p_admin_request = 0 AND " \
     "p_status IN ('idle', 'active', 'softfail') AND " \
-    "p_notbefore_date <= NOW() AND " \
-    "p_admin_request IS FALSE AND " \
-    "(p_start_date IS NULL OR p_status = 'idle' OR " \
-    "DATE_ADD(p_start_date, INTERVAL 90 SECOND) <= NOW())"
+    "p_notbefore_date <= %s AND " \
+    "(p_status != 'active' OR p_lease_expiry <= %s OR " \
+    "(p_lease_expiry IS NULL AND p_start_date <= %s))"
   _ACTIVE_JOBS_WHERE_CLAUSE_ADMIN = \
+    "p_admin_request = 1 AND " \
     "p_status IN ('idle', 'active', 'softfail') AND " \
-    "p_admin_request IS TRUE AND " \
-    "(p_start_date IS NULL OR p_status = 'idle' OR " \
-    "DATE_ADD(p_start_date, INTERVAL 90 SECOND) <= NOW())"
+    "(p_status != 'active' OR p_lease_expiry <= %s OR " \
+    "(p_lease_expiry IS NULL AND p_start_date <= %s))"
+  _NEXT_WAKEUP_QUERY = \
+    "SELECT (SELECT UNIX_TIMESTAMP(MIN(p_notbefore_date)) FROM gapps_queue " \
+    "WHERE p_admin_request = 0 AND p_status IN ('idle', 'softfail') " \
+    "AND p_notbefore_date > %s) AS next_notbefore, " \
+    "(SELECT UNIX_TIMESTAMP(MIN(p_lease_expiry)) FROM gapps_queue " \
+    "WHERE p_admin_request = 0 AND p_status = 'active' " \
+    "AND p_lease_expiry > %s) AS next_lease_expiry"
+  _CHANGE_MARKER_QUERY = \
+    "SELECT (SELECT seq FROM gapps_queue_sequence) AS seq, " \
+    "(SELECT MAX(q_id) FROM gapps_queue) AS q_id"
+  _DEFERRED_JOBS_QUERY = \
+    "SELECT p_priority, UNIX_TIMESTAMP(p_notbefore_date) AS p_notbefore_date " \
+    "FROM gapps_queue WHERE p_admin_request = 0 AND " \
+    "p_status IN ('idle', 'softfail') AND p_notbefore_date > %s"
+  _NEW_JOBS_QUERY = \
+    "SELECT q_id, p_priority, p_status, p_admin_request, " \
+    "UNIX_TIMESTAMP(p_notbefore_date) AS p_notbefore_date " \
+    "FROM gapps_queue WHERE q_id > %s ORDER BY q_id"
   _JOB_SELECT_CLAUSE = \
-    "q_id, p_status, UNIX_TIMESTAMP(p_entry_date) AS p_entry_date, " \
+    "q_id, p_status, p_priority, UNIX_TIMESTAMP(p_entry_date) AS p_entry_date, " \
     "UNIX_TIMESTAMP(p_start_date) AS p_start_date, r_softfail_count, " \
     "UNIX_TIMESTAMP(r_softfail_date) AS r_softfail_date, j_type, j_parameters"
 
+  _CLAIM_ATTEMPTS = 3
+
   _TRANSIENT_ERRORS_VALIDITY = 3600
   _CREDENTIAL_ERRORS_THRESHOLD = 2
   _TRANSIENT_ERRORS_THRESHOLD = 4
@@ -88,6 +159,8 @@ class Queue(object):
     self._sql = sql
     self._deadline = deadline
     self._min_delay = config.get_int("gappsd.queue-min-delay")
+    self._max_idle = config.get_int("gappsd.queue-max-idle")
+    self._wakeup = threading.Event()
     self._overflow_warning = config.get_int("gappsd.queue-warn-overflow")
 
     self._delays = {
@@ -111,6 +184,38 @@ class Queue(object):
       self._PRIORITY_OFFLINE: 0,
     }
     self._transient_errors = []
+    self._transient_errors_lock = threading.Lock()
+
+    self._prefetch = config.get_int("gappsd.queue-prefetch")
+    self._prefetched = {
+      self._PRIORITY_IMMEDIATE: collections.deque(),
+      self._PRIORITY_NORMAL: collections.deque(),
+      self._PRIORITY_OFFLINE: collections.deque(),
+    }
+
+    self._softfail_delay = config.get_int("gappsd.job-softfail-delay")
+    self._depth = depth.QueueDepthTracker(
+      self._PRIORITY_ORDER, config.get_int("gappsd.queue-recount-interval"))
+    self._change_marker = None
+
+    # Connections of the worker threads, of the lease keeper, and of the
+    # status writer.
+    write_behind = config.get_int("gappsd.status-flush-interval") > 0
+    self._connections = database.ConnectionPool(
+      config, max_size=config.get_int("gappsd.queue-workers") + 1 +
+                       int(write_behind))
+    self._leases = lease.LeaseKeeper(config, self._connections)
+    self._status_writer = None
+    if write_behind:
+      self._status_writer = writeback.StatusWriter(config, self._connections)
+    self._pool = None
+    if config.get_int("gappsd.queue-workers") > 0:
+      self._pool = worker.WorkerPool(
+        self._connections, self._RunClaimedJob,
+        config.get_int("gappsd.queue-workers"),
+        config.get_int_dict("gappsd.queue-workers-per-priority"),
+        config.get_int_dict("gappsd.queue-workers-per-type"),
+        self.Wakeup)
 
   # Queue delay helpers.
   def _CanWarnForQueueOverflow(self, priority):
@@ -170,48 +275,307 @@ class Queue(object):
 
   def _GetNextPriorityQueue(self, job_counts):
     """Returns the name of the next queue to process an element of. This is an
-    iterator."""
+    iterator. With the worker pool, each delay slot of a queue dispatches up to
+    job_counts[queue] jobs, within the free capacity of the pool when the slot
+    opens (workers freed meanwhile wait for the next slot, so that the queue
+    delays still throttle the API calls). The caller may lower
+    job_counts[queue] when the queue runs out of claimable jobs."""
 
     delays = self._GetCurrentQueueDelays(job_counts)
     for queue in self._PRIORITY_ORDER:
-      if queue in job_counts and job_counts[queue] > 0:
+      if not queue in job_counts or job_counts[queue] <= 0:
+        continue
+      if self._pool:
+        if not self._CanProcessFromQueue(queue, delays[queue]):
+          continue
+        budget = min(job_counts[queue], self._pool.FreeCapacity(queue))
+        if budget > 0:
+          self._last_jobs[queue] = datetime.datetime.now()
+        for dispatched in range(budget):
+          if dispatched >= job_counts[queue]:
+            break
+          yield queue
+      else:
         while self._CanProcessFromQueue(queue, delays[queue]):
           self._last_jobs[queue] = datetime.datetime.now()
           yield queue
 
   # Queue processing helpers.
+  @classmethod
+  def _GetActiveJobsCondition(cls, admin=False, now=None):
+    """Returns the (clause, args) tuple selecting runnable jobs (or runnable
+    admin jobs if @p admin is True) at date @p now."""
+
+    if now is None:
+      now = datetime.datetime.now()
+    claim_cutoff = now - datetime.timedelta(0, cls._LEGACY_CLAIM_DELAY)
+    now = now.strftime(job.Job._DATE_FORMAT)
+    claim_cutoff = claim_cutoff.strftime(job.Job._DATE_FORMAT)
+
+    if admin:
+      return (cls._ACTIVE_JOBS_WHERE_CLAUSE_ADMIN, [now, claim_cutoff])
+    return (cls._ACTIVE_JOBS_WHERE_CLAUSE, [now, now, claim_cutoff])
+
   def _GetJobCounts(self):
     """Returns the number of runnable jobs in each priority queue."""
 
+    (where_clause, where_args) = self._GetActiveJobsCondition()
     sql_query = "SELECT p_priority, COUNT(q_id) AS count FROM gapps_queue " \
-      "WHERE %s GROUP BY p_priority" % (self._ACTIVE_JOBS_WHERE_CLAUSE,)
-    results = self._sql.Query(sql_query)
+      "WHERE %s GROUP BY p_priority" % (where_clause,)
+    results = self._sql.Query(sql_query, tuple(where_args),
+                              row_factory=database.RecordRowFactory)
     return dict([(row["p_priority"], row["count"]) for row in results])
 
-  def _GetJobFromQueue(self, queue):
-    """Fetches a job from the given @p priority queue, and returns the
-    corresponding job object (or None if no job was found). Also updates
-    the status field of the job."""
-
-    sql_query = "SELECT %s FROM gapps_queue WHERE %s AND p_priority = %%s " \
-      "ORDER BY q_id LIMIT 1" % (self._JOB_SELECT_CLAUSE,
-                                 self._ACTIVE_JOBS_WHERE_CLAUSE)
-    result = self._sql.Query(sql_query, (queue,))
+  def _GetDeferredJobs(self, now):
+    """Returns the (priority, notbefore timestamp) list of the jobs which are
+    not runnable yet."""
+
+    results = self._sql.Query(self._DEFERRED_JOBS_QUERY,
+                              (now.strftime(job.Job._DATE_FORMAT),),
+                              row_factory=database.RecordRowFactory)
+    return [(row["p_priority"], row["p_notbefore_date"]) for row in results]
+
+  def _GetHighWaterMark(self):
+    """Returns the highest q_id of the queue (or 0 if the queue is empty)."""
+
+    result = self._sql.Query("SELECT MAX(q_id) AS q_id FROM gapps_queue")
+    return result[0]["q_id"] or 0
+
+  def _RefreshJobCounts(self):
+    """Returns the number of runnable jobs in each priority queue, using the
+    incremental depth tracker: new jobs are picked up from the q_id high-water
+    mark, and the counts are fully recomputed every
+    gappsd.queue-recount-interval seconds.
+
+    Jobs can be committed after jobs with higher q_ids: when the queue change
+    marker moved, the trailing window below the mark is scanned again, and the
+    counts are recomputed if no new job was found (the late jobs may be older
+    than the window)."""
+
+    now = datetime.datetime.now()
+    timestamp = time.mktime(now.timetuple())
+    marker = self._GetChangeMarker()
+    recount = self._depth.NeedsRecount(timestamp)
+    if not recount:
+      moved = marker != self._change_marker
+      new_jobs = self._depth.AddNewJobs(
+        self._sql.Query(self._NEW_JOBS_QUERY, (self._depth.ScanStart(moved),),
+                        row_factory=database.RecordRowFactory),
+        timestamp)
+      recount = moved and not new_jobs
+    if recount:
+      high_water_mark = self._GetHighWaterMark()
+      self._depth.SetCounts(self._GetJobCounts(), self._GetDeferredJobs(now),
+                            high_water_mark, timestamp)
+    self._change_marker = marker
+    return self._depth.Counts(timestamp)
+
+  def _TrackProcessedJob(self, j, priority):
+    """Accounts for a processed job which went back to the queue (softfail)."""
+
+    if j.status()[0] == job.Job.STATUS_SOFTFAIL:
+      self._depth.OnDeferred(priority, time.time() + self._softfail_delay)
+
+  def _FetchJobFromQueue(self, queue, excluded_types=()):
+    """Returns the dictionary of the next runnable job of the @p queue priority
+    class (ignoring jobs of the @p excluded_types), or None."""
+
+    (where_clause, where_args) = self._GetActiveJobsCondition()
+    sql_query = "SELECT %s FROM gapps_queue WHERE %s AND p_priority = %%s " % \
+      (self._JOB_SELECT_CLAUSE, where_clause)
+    sql_args = where_args + [queue]
+    if excluded_types:
+      sql_query += "AND j_type NOT IN (%s) " % \
+        ", ".join(["%s"] * len(excluded_types))
+      sql_args.extend(excluded_types)
+    sql_query += "ORDER BY q_id LIMIT 1"
+
+    result = self._sql.Query(sql_query, tuple(sql_args),
+                             row_factory=database.RecordRowFactory)
     if not len(result):
       return None
+    return result[0]
+
+  def _InstantiateJob(self, sql, job_dict):
+    """Returns the job object for @p job_dict, or None if the job could not be
+    instantiated (in which case it is marked as failed)."""
 
     try:
-      j = job.job_registry.Instantiate(result[0]["j_type"],
-                                       self._config, self._sql, result[0])
-      j.MarkActive()
+      return job.job_registry.Instantiate(job_dict["j_type"],
+                                          self._config, sql, job_dict)
     except job.JobError, message:
-      j = None
-      job.Job.MarkFailed(self._sql, result[0]["q_id"],
+      job.Job.MarkFailed(sql, job_dict["q_id"],
                          "Job instantiation error: %s" % (message,))
       logger.info("Failed to instantiate job %d: %s" % \
-        (result[0]["q_id"], message))
+        (job_dict["q_id"], message))
+      return None
+
+  def _ClaimJob(self, job_dict):
+    """Atomically claims the job of @p job_dict: the job is only marked as
+    active (with a new claim token and lease) if it is still runnable, ie. if
+    no other daemon or worker claimed it since it was fetched. Returns the
+    updated job dictionary, or None if the claim was lost. The lease of the
+    claimed job is renewed until it is removed from self._leases."""
+
+    token = uuid.uuid4().hex
+    now = datetime.datetime.now()
+    lease_expiry = self._leases.GetExpiry(job_dict["j_type"], now)
+    (where_clause, where_args) = self._GetActiveJobsCondition(now=now)
+    sql_query = "UPDATE gapps_queue SET p_status = %%s, p_start_date = %%s, " \
+      "p_lease_expiry = %%s, p_claim_token = %%s WHERE q_id = %%s AND %s" % \
+      (where_clause,)
+    claimed = self._sql.Execute(sql_query, tuple([
+      job.Job.STATUS_ACTIVE, now.strftime(job.Job._DATE_FORMAT),
+      lease_expiry.strftime(job.Job._DATE_FORMAT), token, job_dict["q_id"]] +
+      where_args))
+    if not claimed:
+      logger.info("Job %d was claimed by another worker" % job_dict["q_id"])
+      return None
+    self._leases.Add(job_dict["q_id"], token, job_dict["j_type"])
+    self._depth.OnClaimed(job_dict.get("p_priority"))
+
+    job_dict = dict(job_dict)
+    job_dict["p_status"] = job.Job.STATUS_ACTIVE
+    job_dict["p_start_date"] = int(time.mktime(now.timetuple()))
+    job_dict["p_claim_token"] = token
+    return job_dict
+
+  def _ClaimJobFromQueue(self, queue, excluded_types=()):
+    """Fetches and claims a job from the given @p priority queue, and returns
+    its dictionary (or None if no job could be claimed)."""
+
+    for attempt in range(self._CLAIM_ATTEMPTS):
+      job_dict = self._FetchJobFromQueue(queue, excluded_types)
+      if job_dict is None:
+        return None
+      job_dict = self._ClaimJob(job_dict)
+      if job_dict is not None:
+        return job_dict
+    return None
+
+  # Prefetch buffer helpers.
+  def _PrefetchJobs(self, queue, excluded_types=()):
+    """Claims up to gappsd.queue-prefetch runnable jobs of the @p queue priority
+    class (ignoring jobs of the @p excluded_types), and appends them to the
+    prefetch buffer. The candidate jobs are selected first, then claimed with a
+    single UPDATE on their q_ids (an UPDATE with ORDER BY and LIMIT is unsafe
+    for statement-based replication); the jobs of a batch share their claim
+    token, which is used to read back the jobs actually claimed. Returns the
+    number of claimed jobs."""
+
+    now = datetime.datetime.now()
+    (where_clause, where_args) = self._GetActiveJobsCondition(now=now)
+    sql_query = "SELECT q_id, j_type FROM gapps_queue " \
+      "WHERE %s AND p_priority = %%s " % (where_clause,)
+    sql_args = where_args + [queue]
+    if excluded_types:
+      sql_query += "AND j_type NOT IN (%s) " % \
+        ", ".join(["%s"] * len(excluded_types))
+      sql_args.extend(excluded_types)
+    sql_query += "ORDER BY q_id LIMIT %d" % self._prefetch
+    candidates = self._sql.Query(sql_query, tuple(sql_args),
+                                 row_factory=database.RecordRowFactory)
+    if not candidates:
+      return 0
+
+    # The batch lease is long enough for the slowest job type of the batch.
+    token = uuid.uuid4().hex
+    lease_expiry = self._leases.GetExpiry(
+      max([candidate["j_type"] for candidate in candidates],
+          key=self._leases.GetDuration), now)
+    q_ids = [candidate["q_id"] for candidate in candidates]
+    sql_query = "UPDATE gapps_queue SET p_status = %%s, p_start_date = %%s, " \
+      "p_lease_expiry = %%s, p_claim_token = %%s " \
+      "WHERE q_id IN (%s) AND %s" % \
+      (", ".join(["%s"] * len(q_ids)), where_clause)
+    sql_args = [job.Job.STATUS_ACTIVE, now.strftime(job.Job._DATE_FORMAT),
+                lease_expiry.strftime(job.Job._DATE_FORMAT), token] + \
+               q_ids + where_args
+    if not self._sql.Execute(sql_query, tuple(sql_args)):
+      return 0
+
+    sql_query = "SELECT %s FROM gapps_queue WHERE p_claim_token = %%s " \
+      "ORDER BY q_id" % (self._JOB_SELECT_CLAUSE,)
+    results = self._sql.Query(sql_query, (token,),
+                              row_factory=database.RecordRowFactory)
+    for job_dict in results:
+      job_dict = dict(job_dict)
+      job_dict["p_claim_token"] = token
+      self._leases.Add(job_dict["q_id"], token, job_dict["j_type"])
+      self._prefetched[queue].append(job_dict)
+    self._depth.OnClaimed(queue, len(results))
+    return len(results)
+
+  def _TakePrefetchedJob(self, queue, excluded_types=()):
+    """Returns the next buffered job of the @p queue priority class which is
+    not of the @p excluded_types, refilling the buffer when needed, or None."""
+
+    for attempt in range(2):
+      for job_dict in self._prefetched[queue]:
+        if not job_dict["j_type"] in excluded_types:
+          self._prefetched[queue].remove(job_dict)
+          return job_dict
+      if attempt == 0 and not self._PrefetchJobs(queue, excluded_types):
+        return None
+    return None
+
+  def _ReleasePrefetchedJobs(self):
+    """Returns the claimed but unprocessed jobs of the prefetch buffer to the
+    queue, so that they can be run right away by another daemon."""
+
+    job_dicts = []
+    for queue in self._PRIORITY_ORDER:
+      self._depth.OnReleased(queue, len(self._prefetched[queue]))
+      job_dicts.extend(self._prefetched[queue])
+      self._prefetched[queue].clear()
+    if not job_dicts:
+      return
+
+    q_ids = [job_dict["q_id"] for job_dict in job_dicts]
+    tokens = list(set([job_dict["p_claim_token"] for job_dict in job_dicts]))
+    sql_query = "UPDATE gapps_queue SET p_status = CASE " \
+      "WHEN r_softfail_count > 0 THEN 'softfail' ELSE 'idle' END, " \
+      "p_lease_expiry = NULL, p_claim_token = NULL " \
+      "WHERE p_status = 'active' AND q_id IN (%s) AND p_claim_token IN (%s)" % \
+      (", ".join(["%s"] * len(q_ids)), ", ".join(["%s"] * len(tokens)))
+    released = self._sql.Execute(sql_query, tuple(q_ids + tokens))
+    for q_id in q_ids:
+      self._leases.Remove(q_id)
+    logger.info("Released %d prefetched jobs" % released)
+
+  def _ClaimNextJob(self, queue, excluded_types=()):
+    """Returns the dictionary of the next claimed job of the @p queue priority
+    class, from the prefetch buffer if enabled, or None."""
+
+    if self._prefetch > 0:
+      return self._TakePrefetchedJob(queue, excluded_types)
+    return self._ClaimJobFromQueue(queue, excluded_types)
+
+  def _GetJobFromQueue(self, queue):
+    """Fetches and claims a job from the given @p priority queue, and returns
+    the corresponding job object (or None if no job was found)."""
+
+    job_dict = self._ClaimNextJob(queue)
+    if job_dict is None:
+      return None
+
+    j = self._InstantiateJob(self._sql, job_dict)
+    if j is None:
+      self._leases.Remove(job_dict["q_id"])
     return j
 
+  def _RunClaimedJob(self, sql, job_dict):
+    """Instantiates and processes a claimed job; called from worker threads,
+    with the worker's own @p sql connection."""
+
+    try:
+      j = self._InstantiateJob(sql, job_dict)
+      if j:
+        self._ProcessJob(j)
+        self._TrackProcessedJob(j, job_dict.get("p_priority"))
+    finally:
+      self._leases.Remove(job_dict["q_id"])
+
   def _ProcessJob(self, j):
     """Processes the job (ie. runs it), and handles the errors.
     Note: when job returns properly, we test that either the new status is
@@ -225,6 +589,7 @@ class Queue(object):
       logger.info("Cancelled <%s>: gappsd in read-only mode." % j.__str__())
       return
 
+    database.thread_stats.Reset()
     try:
       logger.info("Starting to process <%s>" % (j.__str__(),))
       old_status = j.status()
@@ -236,35 +601,130 @@ class Queue(object):
                                j.STATUS_IDLE]:
         if new_status[1] == old_status[1]:
           j.Update(j.STATUS_SUCCESS)
-      logger.info("Processed <%s>: %s" % (j.__str__(), new_status[0]))
+      logger.info("Processed <%s>: %s [%s]" % \
+        (j.__str__(), new_status[0], self._GetSqlTotals()))
     except (TransientError, database.SQLTransientError), message:
       self._AddTransientError(j, message)
       j.Update(j.STATUS_SOFTFAIL, message)
-      logger.info("Processed <%s>: softfail (%s)" % (j.__str__(), message))
+      logger.info("Processed <%s>: softfail (%s) [%s]" % \
+        (j.__str__(), message, self._GetSqlTotals()))
     except (PermanentError, database.SQLPermanentError), message:
       j.Update(j.STATUS_HARDFAIL, message)
-      logger.info("Processed <%s>: hardfail (%s)" % (j.__str__(), message))
+      logger.info("Processed <%s>: hardfail (%s) [%s]" % \
+        (j.__str__(), message, self._GetSqlTotals()))
+
+  @staticmethod
+  def _GetSqlTotals():
+    """Returns the SQL totals of the job processed by the current thread, as
+    logged on the "Processed <job>" lines."""
+
+    return "SQL: %(queries)d queries, %(time).3f s, %(rows)d rows" % \
+      database.thread_stats.Totals()
 
   def _ProcessNextJob(self):
-    """Determines the next job to process, and process it."""
+    """Determines the next job to process, and process it. Returns the job
+    counts used for the scheduling."""
+
+    job_counts = self._RefreshJobCounts()
+    for queue in self._PRIORITY_ORDER:
+      if self._prefetched[queue]:
+        job_counts[queue] = \
+          job_counts.get(queue, 0) + len(self._prefetched[queue])
 
-    job_counts = self._GetJobCounts()
     for queue in self._GetNextPriorityQueue(job_counts):
-      job = self._GetJobFromQueue(queue)
-      if job:
-        self._ProcessJob(job)
-        self._job_counts[queue] += 1
+      if self._pool:
+        job_dict = self._ClaimNextJob(queue, self._pool.SaturatedJobTypes())
+        if job_dict:
+          self._pool.Dispatch(queue, job_dict)
+          self._job_counts[queue] += 1
+        else:
+          job_counts[queue] = 0
+      else:
+        job = self._GetJobFromQueue(queue)
+        if job:
+          try:
+            self._ProcessJob(job)
+            self._TrackProcessedJob(job, queue)
+          finally:
+            self._leases.Remove(job.id())
+          self._job_counts[queue] += 1
+    return job_counts
+
+  # Idle-time helpers.
+  def _GetChangeMarker(self):
+    """Returns the current value of the queue change marker: the sequence
+    bumped by NotifyQueueChange, and the highest q_id of the queue (so that
+    jobs inserted directly in gapps_queue, eg. by the website, are noticed as
+    well)."""
+
+    result = self._sql.Query(self._CHANGE_MARKER_QUERY)
+    return (result[0]["seq"], result[0]["q_id"])
+
+  def _GetNextWakeupDelay(self, job_counts):
+    """Returns the number of seconds until a job may become runnable: the next
+    delay slot of non-empty priority queues, the next not-before date, or the
+    next lease expiry. The delay is bounded by gappsd.queue-min-delay and
+    gappsd.queue-max-idle, and by the queue deadline. Queues waiting for a free
+    worker are woken up by the worker pool when a job is over."""
+
+    now = datetime.datetime.now()
+    wakeups = [now + datetime.timedelta(0, self._max_idle)]
+    if not self._deadline is None:
+      wakeups.append(self._deadline)
+
+    delays = self._GetCurrentQueueDelays(job_counts)
+    for queue in job_counts:
+      if job_counts[queue] > 0:
+        if self._pool and not self._pool.CanDispatch(queue):
+          continue
+        if not self._last_jobs[queue]:
+          wakeups.append(now)
+        else:
+          wakeups.append(self._last_jobs[queue] +
+                         datetime.timedelta(0, delays[queue]))
+
+    sql_now = now.strftime(job.Job._DATE_FORMAT)
+    result = self._sql.Query(self._NEXT_WAKEUP_QUERY, (sql_now, sql_now))
+    for key in ("next_notbefore", "next_lease_expiry"):
+      if result[0][key] is not None:
+        wakeups.append(datetime.datetime.fromtimestamp(result[0][key]))
+
+    delay = min(wakeups) - now
+    return max(delay.days * 86400 + delay.seconds, self._min_delay)
+
+  def _WaitForNextJob(self, delay):
+    """Sleeps for @p delay seconds, or until Wakeup() is called, or until the
+    queue change marker is bumped (the marker is checked every
+    gappsd.queue-min-delay seconds)."""
+
+    deadline = time.time() + delay
+    marker = self._GetChangeMarker()
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return
+      if self._wakeup.wait(min(remaining, self._min_delay)):
+        self._wakeup.clear()
+        return
+      if self._GetChangeMarker() != marker:
+        return
+
+  def Wakeup(self):
+    """Interrupts the current idle wait of the queue runner, if any."""
+
+    self._wakeup.set()
 
   # Error handling helpers.
   def _AddTransientError(self, j, message):
     """Adds a transient error to the queue's transient error list."""
 
-    self._transient_errors.append({
-      "date": datetime.datetime.now(),
-      "job": j.__str__(),
-      "exc_type": sys.exc_info()[0],
-      "message": message,
-    })
+    with self._transient_errors_lock:
+      self._transient_errors.append({
+        "date": datetime.datetime.now(),
+        "job": j.__str__(),
+        "exc_type": sys.exc_info()[0],
+        "message": message,
+      })
 
   def _CheckTransientErrors(self):
     """Handles TransientError exceptions. While permanent errors are bad but
@@ -280,17 +740,18 @@ class Queue(object):
 
     validity_date = datetime.datetime.now() - \
       datetime.timedelta(0, self._TRANSIENT_ERRORS_VALIDITY)
-    while self._transient_errors and \
-          self._transient_errors[0]["date"] < validity_date:
-      self._transient_errors.pop(0)
-
     transient_errors = []
     credential_errors = []
-    for error in self._transient_errors:
-      if issubclass(error["exc_type"], logger.CredentialError):
-        credential_errors.append(error)
-      else:
-        transient_errors.append(error)
+    with self._transient_errors_lock:
+      while self._transient_errors and \
+            self._transient_errors[0]["date"] < validity_date:
+        self._transient_errors.pop(0)
+
+      for error in self._transient_errors:
+        if issubclass(error["exc_type"], logger.CredentialError):
+          credential_errors.append(error)
+        else:
+          transient_errors.append(error)
 
     if len(credential_errors) >= self._CREDENTIAL_ERRORS_THRESHOLD:
       logger.critical("Credential errors count above threshold\nError list:\n" +
@@ -307,8 +768,46 @@ class Queue(object):
 
     job_stats = ["%s=%d" % (q, c) for (q, c) in list(self._job_counts.items())]
     logger.info("Queue stats - jobs handled: " + ", ".join(job_stats))
+    depth_counts = self._depth.Counts(time.time())
+    depth_stats = self._depth.Stats()
+    logger.info("Queue stats - runnable jobs: %s (deferred: %d, recounts: %d, " \
+      "new jobs: %d)" % (
+        ", ".join(["%s=%d" % (q, depth_counts[q]) for q in self._PRIORITY_ORDER]),
+        depth_stats["deferred"], depth_stats["recounts"],
+        depth_stats["new_jobs"]))
+    if self._pool:
+      logger.info("Queue stats - jobs in flight: %d" % self._pool.InFlight())
+    logger.info("Queue stats - leases held: %d" % self._leases.Count())
+    if self._prefetch > 0:
+      logger.info("Queue stats - jobs prefetched: %d" % \
+        sum([len(buffer) for buffer in self._prefetched.values()]))
+    if self._status_writer:
+      writer_stats = self._status_writer.Stats()
+      logger.info("Queue stats - status updates: %d buffered, %d written in " \
+        "%d flushes" % (writer_stats["pending"], writer_stats["rows"],
+                        writer_stats["flushes"]))
     logger.info("Queue stats - transient errors: " + \
       str(len(self._transient_errors)))
+    sql_stats = database.connection_stats.Stats()
+    logger.info("SQL stats - connects: %d (%.1f ms average), pings: %d, " \
+      "dead connections: %d, query retries: %d" % (sql_stats["connects"],
+        sql_stats["connect_latency"] * 1000, sql_stats["pings"],
+        sql_stats["dead_connections"], sql_stats["retries"]))
+    for statement in database.statement_stats.Top(self._STATISTICS_STATEMENTS):
+      logger.info("SQL stats - statement: %d runs, %.1f ms total, " \
+        "%.1f ms max, %d rows: %s" % (statement["count"],
+          statement["time"] * 1000, statement["max_time"] * 1000,
+          statement["rows"], statement["statement"]))
+    database.statement_stats.Reset()
+    pool_stats = self._connections.Stats()
+    logger.info("SQL stats - pooled connections: %d (%d in use, %d waiters), " \
+      "checkouts: %d (%.1f ms average wait), timeouts: %d" % (
+        pool_stats["size"], pool_stats["in_use"], pool_stats["waiters"],
+        pool_stats["checkouts"], pool_stats["wait_time"] * 1000,
+        pool_stats["timeouts"]))
+    api_stats = api.service_registry.Stats()
+    logger.info("API stats - services built: %d, reused: %d" % \
+      (api_stats["builds"], api_stats["reuses"]))
     for queue in self._job_counts:
       self._job_counts[queue] = 0
 
@@ -319,14 +818,37 @@ class Queue(object):
     assert(self._min_delay >= 1)
     last_stats = datetime.datetime.now()
     delta_stats = datetime.timedelta(0, self._STATISTICS_DELAY)
-    while True:
-      self._CheckTransientErrors()
-      if datetime.datetime.now() - last_stats > delta_stats:
-        self._LogStatistics()
-        last_stats = datetime.datetime.now()
-      self._ProcessNextJob()
+    self._connections.Prefill()
+    self._leases.start()
+    if self._status_writer:
+      self._status_writer.start()
+      writeback.SetWriter(self._status_writer)
+    if self._pool:
+      self._pool.Start()
+    try:
+      while True:
+        self._CheckTransientErrors()
+        if self._pool:
+          self._pool.CheckErrors()
+        if datetime.datetime.now() - last_stats > delta_stats:
+          self._LogStatistics()
+          last_stats = datetime.datetime.now()
+        job_counts = self._ProcessNextJob()
+
+        if not self._deadline is None and \
+           datetime.datetime.now() > self._deadline:
+          return
+        self._WaitForNextJob(self._GetNextWakeupDelay(job_counts))
+    finally:
+      try:
+        self._ReleasePrefetchedJobs()
+      except (database.SQLTransientError, database.SQLPermanentError), message:
+        logger.info("Failed to release the prefetched jobs: %s" % message)
+      if self._pool:
+        self._pool.Stop()
+      if self._status_writer:
+        writeback.SetWriter(None)
+        self._status_writer.Stop()
+      self._leases.Stop()
+      self._connections.Close()
       self._sql.Close()
-
-      if not self._deadline is None and datetime.datetime.now() > self._deadline:
-        return
-      time.sleep(self._min_delay)
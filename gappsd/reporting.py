@@ -22,7 +22,7 @@ import csv
 import datetime
 import pytz
 
-import account, api, job, queue
+import account, api, database, job, queue
 from . import logger
 from .logger import PermanentError, TransientError
 
@@ -141,21 +141,41 @@ class AccountsJob(job.Job):
   def __init__(self, config, sql, job_dict):
     job.Job.__init__(self, config, sql, job_dict)
     self._api = api.GetDirectoryService(config)
+    self._sync_jobs = []
+    self._updated_accounts = []
+
+  # SQL Account vs. GApps Account synchronization methods. Account updates and
+  # UserSync jobs are buffered, and written in bulk at the end of the run (cf.
+  # SaveAccounts and CreateSyncJobs).
+  def _AddSyncJob(self, username):
+    self._sync_jobs.append(('u_sync', {"username": username}))
+
+  def SaveAccounts(self):
+    """Writes the buffered account updates, using multi-row updates (accounts
+    deleted in the meantime are not re-created)."""
+
+    account.UpdateAccounts(self._sql, self._updated_accounts)
+
+  def CreateSyncJobs(self):
+    """Creates the buffered UserSync jobs."""
+
+    queue.CreateQueueJobs(self._sql, self._sync_jobs)
+
+  def _WriteChanges(self):
+    self.SaveAccounts()
+    self.CreateSyncJobs()
 
-  # SQL Account vs. GApps Account synchronization methods.
   def SynchronizeSQLAccount(self, sql):
     """Synchronizes the SQL account based on the fact the account did not
     show up in the reporting log."""
 
     if sql["g_status"] != "unprovisioned":
-      queue.CreateQueueJob(self._sql, 'u_sync',
-                           {"username": sql["g_account_name"]})
+      self._AddSyncJob(sql["g_account_name"])
 
   def SynchronizeReportingAccount(self, reporting):
     """Creates a SQL account based on the Reporting version of the account."""
 
-    queue.CreateQueueJob(self._sql, 'u_sync',
-                         {"username": reporting["account_name"]})
+    self._AddSyncJob(reporting["account_name"])
 
   def SynchronizeSQLReportingAccounts(self, sql, reporting):
     """Synchronizes the SQL version of the account with the reporting version.
@@ -171,10 +191,10 @@ class AccountsJob(job.Job):
         else:
           create_sync_job = True
 
-    a.Update(self._sql)
+    if a.GetChangedData():
+      self._updated_accounts.append(a)
     if create_sync_job:
-      queue.CreateQueueJob(self._sql, 'u_sync',
-                           {"username": a.get("g_account_name")})
+      self._AddSyncJob(a.get("g_account_name"))
 
 
   # Account list retrieval.
@@ -187,8 +207,10 @@ class AccountsJob(job.Job):
       "g_status", "g_suspension", "r_disk_usage",
       "DATE_FORMAT(r_creation, '%%Y-%%m-%%d') AS r_creation",
     ])
-    accounts = self._sql.Query("SELECT %s FROM gapps_accounts" % sql_select)
-    return dict([(account["g_account_name"], account) for account in accounts])
+    accounts = self._sql.Iterate("SELECT %s FROM gapps_accounts" % sql_select,
+                                 row_factory=database.RecordRowFactory,
+                                 lag_tolerant=True)
+    return dict((account["g_account_name"], account) for account in accounts)
 
   def FetchReportingAccounts(self):
     """Retrieves the list of all Google Apps accounts using the Directory API.
@@ -231,8 +253,8 @@ class AccountsJob(job.Job):
  
     for s_account in list(sql_accounts.values()):
       self.SynchronizeSQLAccount(s_account)
- 
-    self.Update(self.STATUS_SUCCESS)
+
+    self.Complete(self._WriteChanges)
 
 # Module initialization.
 job.job_registry.Register('r_activity', ActivityJob)
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""SQLite backend of gappsd.database.SQL (cf. the mysql.backend option), used to
+run the queue and the tools locally, without a MySQL server.
+
+Connections mimic the subset of the MySQLdb connection interface used by the SQL
+object, and translate the MySQL constructs used by gappsd on the fly: "%s"
+placeholders, INSERT ... SET, INSERT IGNORE, ON DUPLICATE KEY UPDATE, UPDATE ...
+ORDER BY ... LIMIT, START TRANSACTION, NOW(), CURDATE(), UNIX_TIMESTAMP(),
+DATE_ADD(), DATE_SUB(), DATE_FORMAT(), and the CREATE TABLE statements of
+doc/gapps.schema.sql. SQLite errors are raised as the corresponding MySQLdb
+errors (busy databases are reported as lock wait timeouts, and are retried).
+
+Other MySQL-specific statements (SHOW, information_schema tables, ALTER TABLE)
+are not supported. Note that each connection to ":memory:" opens a distinct
+database: use a file to share the database between connections.
+"""
+
+import MySQLdb
+import MySQLdb.cursors as cursors
+import re
+import sqlite3
+
+# Seconds to wait for the lock of a database written to by another connection.
+_BUSY_TIMEOUT = 5
+
+# MySQL error codes used for the translated SQLite errors (ER_DUP_ENTRY,
+# ER_BAD_NULL_ERROR, ER_LOCK_WAIT_TIMEOUT, ER_PARSE_ERROR, CR_CONNECTION_ERROR,
+# CR_SERVER_GONE_ERROR and CR_SERVER_LOST).
+_ER_DUP_ENTRY = 1062
+_ER_BAD_NULL_ERROR = 1048
+_ER_LOCK_WAIT_TIMEOUT = 1205
+_ER_PARSE_ERROR = 1064
+_CR_CONNECTION_ERROR = 2002
+_CR_SERVER_GONE_ERROR = 2006
+_CR_SERVER_LOST = 2013
+
+_CREATE_TABLE = re.compile(
+  r"^\s*CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?\s*\(", re.I)
+_INSERT_SET = re.compile(
+  r"^\s*INSERT\s+(IGNORE\s+)?INTO\s+(\S+)\s+SET\s+(.*)$", re.I | re.S)
+_UPDATE_LIMIT = re.compile(
+  r"^\s*UPDATE\s+(\S+)\s+SET\s+(.*?)\s+WHERE\s+(.*\s+LIMIT\s+\d+)\s*$",
+  re.I | re.S)
+_ON_DUPLICATE_KEY = re.compile(r"\s+ON\s+DUPLICATE\s+KEY\s+UPDATE\s+", re.I)
+_INTERVAL = re.compile(
+  r"^INTERVAL\s+(.*?)\s+(SECOND|MINUTE|HOUR|DAY|MONTH|YEAR)$", re.I | re.S)
+
+def _ParseArguments(text, start):
+  """Splits the comma-separated list starting at @p start in @p text, and
+  ending at the matching closing parenthesis. Returns the list of stripped
+  items, and the position following the closing parenthesis."""
+
+  items = []
+  depth = 0
+  quote = None
+  item_start = start
+  position = start
+  while position < len(text):
+    char = text[position]
+    if quote:
+      if char == "\\":
+        position += 1
+      elif char == quote:
+        quote = None
+    elif char in ("'", '"'):
+      quote = char
+    elif char == "(":
+      depth += 1
+    elif char == ")" and depth:
+      depth -= 1
+    elif char == ")" or (char == "," and not depth):
+      items.append(text[item_start:position].strip())
+      item_start = position + 1
+      if char == ")":
+        return ([item for item in items if item], position + 1)
+    position += 1
+  raise ValueError("Unbalanced parentheses in '%s'" % text)
+
+def _SplitList(text):
+  """Returns the items of the comma-separated @p text (commas nested in
+  parentheses or quotes are ignored)."""
+  return _ParseArguments(text + ")", 0)[0]
+
+def _RewriteCalls(query, name, rewrite):
+  """Replaces the calls to the @p name SQL function in @p query with the
+  result of @p rewrite, called with the list of arguments of the call."""
+
+  pattern = re.compile(r"\b%s\s*\(" % name, re.I)
+  match = pattern.search(query)
+  while match:
+    (arguments, end) = _ParseArguments(query, match.end())
+    query = query[:match.start()] + rewrite(arguments) + query[end:]
+    match = pattern.search(query, match.start() + 1)
+  return query
+
+def _RewriteInterval(sign):
+  """Returns the rewrite function of DATE_ADD (@p sign "+") and DATE_SUB (@p
+  sign "-") calls."""
+
+  def Rewrite(arguments):
+    (date, interval) = arguments
+    match = _INTERVAL.match(interval)
+    if not match:
+      raise ValueError("Unsupported interval '%s'" % interval)
+    function = "date" if date.startswith("date(") else "datetime"
+    return "%s(%s, '%s' || (%s) || ' %ss')" % \
+      (function, date, sign, match.group(1), match.group(2).lower())
+  return Rewrite
+
+def TranslateQuery(query, placeholders=True):
+  """Returns the SQLite version of the MySQL data @p query; "%s" placeholders
+  are only translated if @p placeholders is True (ie. if the query has
+  arguments, as with MySQLdb)."""
+
+  if placeholders:
+    query = re.sub(r"%[s%]",
+                   lambda match: "?" if match.group() == "%s" else "%", query)
+  if re.match(r"^\s*START\s+TRANSACTION\s*$", query, re.I):
+    return "BEGIN IMMEDIATE"
+
+  match = _INSERT_SET.match(query)
+  if match:
+    assignments = [item.split("=", 1) for item in _SplitList(match.group(3))]
+    query = "INSERT %sINTO %s (%s) VALUES (%s)" % (
+      match.group(1) or "", match.group(2),
+      ", ".join([column.strip() for (column, value) in assignments]),
+      ", ".join([value.strip() for (column, value) in assignments]))
+  query = re.sub(r"^(\s*)INSERT\s+IGNORE\s", r"\1INSERT OR IGNORE ", query,
+                 flags=re.I)
+
+  parts = _ON_DUPLICATE_KEY.split(query, 1)
+  if len(parts) == 2:
+    query = parts[0] + " ON CONFLICT DO UPDATE SET " + \
+      re.sub(r"\bVALUES\s*\(\s*(\w+)\s*\)", r"excluded.\1", parts[1],
+             flags=re.I)
+
+  match = _UPDATE_LIMIT.match(query)
+  if match:
+    # SQLite is usually built without support for UPDATE ... LIMIT.
+    query = "UPDATE %s SET %s WHERE rowid IN " % match.group(1, 2) + \
+      "(SELECT rowid FROM %s WHERE %s)" % match.group(1, 3)
+
+  query = re.sub(r"\bNOW\s*\(\s*\)", "datetime('now', 'localtime')", query,
+                 flags=re.I)
+  query = re.sub(r"\bCURDATE\s*\(\s*\)", "date('now', 'localtime')", query,
+                 flags=re.I)
+  query = _RewriteCalls(query, "DATE_ADD", _RewriteInterval("+"))
+  query = _RewriteCalls(query, "DATE_SUB", _RewriteInterval("-"))
+  query = _RewriteCalls(query, "DATE_FORMAT", lambda arguments:
+    "strftime(%s, %s)" % (arguments[1], arguments[0]))
+  query = _RewriteCalls(query, "UNIX_TIMESTAMP", lambda arguments:
+    "CAST(strftime('%%s', %s) AS INTEGER)" % \
+      (arguments and "%s, 'utc'" % arguments[0] or "'now'"))
+  return query
+
+def TranslateTable(query):
+  """Returns the list of SQLite statements (CREATE TABLE and CREATE INDEX)
+  equivalent to the MySQL CREATE TABLE @p query."""
+
+  query = re.sub(r"--[^\n]*", "", query)
+  match = _CREATE_TABLE.match(query)
+  table = match.group(2)
+  (clauses, end) = _ParseArguments(query, match.end())
+  auto_increment = [clause.split()[0] for clause in clauses
+                    if re.search(r"\bAUTO_INCREMENT\b", clause, re.I)]
+
+  columns = []
+  indexes = []
+  for clause in clauses:
+    index = re.match(r"^(UNIQUE\s+)?(INDEX|KEY)\s+`?(\w+)`?\s*(\(.*\))$",
+                     clause, re.I | re.S)
+    primary_key = re.match(r"^PRIMARY\s+KEY\s*\(\s*`?(\w+)`?\s*\)$", clause,
+                           re.I)
+    if index:
+      indexes.append("CREATE %sINDEX IF NOT EXISTS %s_%s ON %s%s" % (
+        index.group(1) and "UNIQUE " or "", table, index.group(3), table,
+        index.group(4)))
+    elif primary_key and primary_key.group(1) in auto_increment:
+      continue
+    elif clause.split()[0] in auto_increment:
+      columns.append("%s INTEGER PRIMARY KEY AUTOINCREMENT" % clause.split()[0])
+    else:
+      clause = re.sub(r"\s+UNSIGNED\b", "", clause, flags=re.I)
+      clause = re.sub(r"\bENUM\s*\([^)]*\)", "TEXT", clause, flags=re.I)
+      # TIMESTAMP columns are returned as datetime objects, as with MySQLdb.
+      clause = re.sub(r"\bDATETIME\b", "TIMESTAMP", clause, flags=re.I)
+      columns.append(clause)
+
+  return ["CREATE TABLE %s%s (%s)" % (match.group(1) or "", table,
+                                      ", ".join(columns))] + indexes
+
+def LoadSchema(sql, schema_file):
+  """Creates the tables of the MySQL @p schema_file (eg. doc/gapps.schema.sql)
+  using the @p sql object."""
+
+  with open(schema_file) as schema:
+    statements = re.sub(r"--[^\n]*", "", schema.read()).split(";")
+  for statement in statements:
+    if statement.strip():
+      sql.Execute(statement.strip())
+
+def _TranslateError(error):
+  """Returns the MySQLdb equivalent of the sqlite3 @p error."""
+
+  message = str(error)
+  if isinstance(error, sqlite3.IntegrityError):
+    if "NOT NULL" in message:
+      return MySQLdb.IntegrityError(_ER_BAD_NULL_ERROR, message)
+    return MySQLdb.IntegrityError(_ER_DUP_ENTRY, message)
+  if isinstance(error, sqlite3.OperationalError):
+    if "locked" in message or "busy" in message:
+      return MySQLdb.OperationalError(_ER_LOCK_WAIT_TIMEOUT, message)
+    return MySQLdb.ProgrammingError(_ER_PARSE_ERROR, message)
+  if isinstance(error, sqlite3.ProgrammingError):
+    if "closed" in message:
+      return MySQLdb.OperationalError(_CR_SERVER_GONE_ERROR, message)
+    return MySQLdb.ProgrammingError(_ER_PARSE_ERROR, message)
+  return MySQLdb.OperationalError(_CR_SERVER_LOST, message)
+
+
+class Cursor(object):
+  """SQLite cursor with the MySQLdb cursor interface; rows are returned as
+  dictionaries for the DictCursor and SSDictCursor classes, and as tuples
+  otherwise. Rows are always streamed from the database."""
+
+  def __init__(self, cursor, dict_rows):
+    self._cursor = cursor
+    self._dict_rows = dict_rows
+
+  @property
+  def description(self):
+    return self._cursor.description
+
+  def execute(self, query, args=None):
+    """Translates and runs the @p query, and returns the number of affected
+    rows."""
+
+    if _CREATE_TABLE.match(query):
+      statements = [(statement, ()) for statement in TranslateTable(query)]
+    else:
+      statements = [(TranslateQuery(query, args is not None), args or ())]
+    try:
+      for (statement, statement_args) in statements:
+        self._cursor.execute(statement, tuple(statement_args))
+    except sqlite3.Error, error:
+      raise _TranslateError(error)
+    return max(self._cursor.rowcount, 0)
+
+  def __MakeRows(self, rows):
+    if not self._dict_rows:
+      return tuple(rows)
+    columns = [column[0] for column in self._cursor.description]
+    return tuple([dict(zip(columns, row)) for row in rows])
+
+  def fetchall(self):
+    try:
+      return self.__MakeRows(self._cursor.fetchall())
+    except sqlite3.Error, error:
+      raise _TranslateError(error)
+
+  def fetchmany(self, size):
+    try:
+      return self.__MakeRows(self._cursor.fetchmany(size))
+    except sqlite3.Error, error:
+      raise _TranslateError(error)
+
+  def close(self):
+    self._cursor.close()
+
+
+class Connection(object):
+  """SQLite connection with the MySQLdb connection interface used by the SQL
+  object. Statements are autocommitted, unless they are run between START
+  TRANSACTION and COMMIT (or ROLLBACK)."""
+
+  def __init__(self, database):
+    try:
+      self._connection = sqlite3.connect(
+        database, timeout=_BUSY_TIMEOUT, isolation_level=None,
+        detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    except sqlite3.Error, error:
+      raise MySQLdb.OperationalError(_CR_CONNECTION_ERROR, str(error))
+
+  def autocommit(self, enabled):
+    # Without isolation level, the sqlite3 module never opens transactions.
+    pass
+
+  def cursor(self, cursor_class=cursors.Cursor):
+    try:
+      return Cursor(self._connection.cursor(),
+                    cursor_class in (cursors.DictCursor, cursors.SSDictCursor))
+    except sqlite3.Error, error:
+      raise _TranslateError(error)
+
+  def ping(self):
+    self.cursor().execute("SELECT 1")
+
+  def close(self):
+    self._connection.close()
+
+def Connect(database):
+  """Opens a connection to the SQLite @p database (a file name, or
+  ":memory:")."""
+  return Connection(database)
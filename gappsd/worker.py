@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Worker pool of the GApps daemon: runs claimed queue jobs concurrently in a
+bounded set of threads, with SQL connections checked out from a
+database.ConnectionPool (and, through the api.service_registry, per-thread API
+clients)."""
+
+import Queue as queue_lib
+import sys
+import threading
+
+class WorkerPool(object):
+  """Bounded pool of job-running threads. The scheduler checks the concurrency
+  caps with CanDispatch() / SaturatedJobTypes(), and hands claimed job
+  dictionaries over to the pool with Dispatch(); the @p handler is then called
+  as handler(sql, job_dict) from a worker thread, with an SQL object checked
+  out from the @p connections pool, and @p on_done() is called once the job is
+  over. Unexpected exceptions of the handler are re-raised in the scheduler
+  thread by CheckErrors().
+
+  Example usage:
+    pool = WorkerPool(connections, handler, 4, {"offline": 1},
+                      {"r_accounts": 1}, queue.Wakeup)
+    pool.Start()
+    if pool.CanDispatch("normal"):
+      pool.Dispatch("normal", job_dict)
+    pool.CheckErrors()
+    pool.Stop()  # Waits for the running jobs.
+  """
+
+  def __init__(self, connections, handler, size, priority_caps=None,
+               type_caps=None, on_done=None):
+    self._connections = connections
+    self._handler = handler
+    self._size = size
+    self._priority_caps = priority_caps or {}
+    self._type_caps = type_caps or {}
+    self._on_done = on_done
+
+    self._lock = threading.Lock()
+    self._tasks = queue_lib.Queue()
+    self._threads = []
+    self._in_flight = 0
+    self._priority_counts = {}
+    self._type_counts = {}
+    self._errors = []
+
+  # Concurrency accounting.
+  def CanDispatch(self, priority):
+    """Returns True iff a new job of the @p priority class can be dispatched
+    without exceeding the pool size or the priority cap."""
+
+    return self.FreeCapacity(priority) > 0
+
+  def FreeCapacity(self, priority):
+    """Returns the number of jobs of the @p priority class which can currently
+    be dispatched without exceeding the pool size or the priority cap."""
+
+    with self._lock:
+      capacity = self._size - self._in_flight
+      if priority in self._priority_caps:
+        capacity = min(capacity, self._priority_caps[priority] -
+                                 self._priority_counts.get(priority, 0))
+      return max(capacity, 0)
+
+  def SaturatedJobTypes(self):
+    """Returns the list of job types which reached their concurrency cap."""
+
+    with self._lock:
+      return [j_type for (j_type, cap) in self._type_caps.items()
+              if self._type_counts.get(j_type, 0) >= cap]
+
+  def InFlight(self):
+    with self._lock:
+      return self._in_flight
+
+  def CheckErrors(self):
+    """Re-raises the first unexpected exception raised in a worker thread since
+    the last call, if any (with its original traceback)."""
+
+    with self._lock:
+      (errors, self._errors) = (self._errors, [])
+    if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
+
+  def _Acquire(self, priority, j_type):
+    with self._lock:
+      self._in_flight += 1
+      self._priority_counts[priority] = \
+        self._priority_counts.get(priority, 0) + 1
+      self._type_counts[j_type] = self._type_counts.get(j_type, 0) + 1
+
+  def _Release(self, priority, j_type):
+    with self._lock:
+      self._in_flight -= 1
+      self._priority_counts[priority] -= 1
+      self._type_counts[j_type] -= 1
+
+  # Job dispatching.
+  def Dispatch(self, priority, job_dict):
+    """Queues the claimed @p job_dict for execution by the next free worker."""
+
+    self._Acquire(priority, job_dict["j_type"])
+    self._tasks.put((priority, job_dict))
+
+  def _RunWorker(self):
+    """Main loop of a worker thread: runs tasks until it gets a None task."""
+
+    while True:
+      task = self._tasks.get()
+      if task is None:
+        return
+      (priority, job_dict) = task
+      try:
+        with self._connections.Connection() as sql:
+          self._handler(sql, job_dict)
+      except Exception:
+        with self._lock:
+          self._errors.append(sys.exc_info())
+      finally:
+        self._Release(priority, job_dict["j_type"])
+        if self._on_done:
+          self._on_done()
+
+  # Pool management.
+  def Start(self):
+    """Starts the worker threads."""
+
+    for i in range(self._size):
+      thread = threading.Thread(target=self._RunWorker, name="Worker-%d" % i)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def Stop(self):
+    """Stops the worker threads, once all the dispatched jobs are done."""
+
+    for thread in self._threads:
+      self._tasks.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Write-behind of the job status updates of the GApps daemon: while the queue
+runs with a gappsd.status-flush-interval, the status transitions of the jobs
+(cf. job.Job.Update) are buffered, and written to the queue table with periodic
+multi-row UPDATE statements. Job claims are not buffered."""
+
+import threading
+import traceback
+
+from . import database, logger
+
+class StatusWriter(threading.Thread):
+  """Flusher thread of the buffered job status updates. Successive updates of
+  a job are merged, and the buffer is written every gappsd.status-flush-interval
+  seconds (at most a third of the lease duration, so that finished jobs are not
+  reclaimed meanwhile), as soon as it holds _FLUSH_SIZE jobs, and when the
+  writer is stopped.
+
+  Example usage:
+    writer = StatusWriter(config, connections)
+    writer.start()
+    SetWriter(writer)
+    Write(sql, 42, {"p_status": "success"})
+    ...
+    SetWriter(None)
+    writer.Stop()
+  """
+
+  _FLUSH_SIZE = 100
+
+  def __init__(self, config, connections):
+    threading.Thread.__init__(self, name="StatusWriter")
+    self.daemon = True
+    self._connections = connections
+    lease_durations = [config.get_int("gappsd.lease-duration")] + \
+      list(config.get_int_dict("gappsd.lease-duration-per-type").values())
+    self._interval = max(min(config.get_int("gappsd.status-flush-interval"),
+                             min(lease_durations) / 3), 1)
+
+    self._pending = {}
+    self._held = {}
+    self._lock = threading.Lock()
+    self._flush_lock = threading.Lock()
+    self._wakeup = threading.Event()
+    self._stop_event = threading.Event()
+    self._flushes = 0
+    self._rows = 0
+
+  # Buffer management.
+  def Add(self, q_id, values):
+    """Buffers the new status @p values of job @p q_id."""
+
+    with self._lock:
+      self._pending.setdefault(q_id, {}).update(values)
+      if len(self._pending) >= self._FLUSH_SIZE:
+        self._wakeup.set()
+
+  def Hold(self, q_id):
+    """Returns a copy of the buffered values of job @p q_id, which are to be
+    written right away in a transaction: they are kept in the buffer (but not
+    flushed) until the end of the transaction (cf. Release). Waits for a
+    running flush, which may still write older values of the job."""
+
+    with self._flush_lock:
+      with self._lock:
+        self._held[q_id] = self._held.get(q_id, 0) + 1
+        return dict(self._pending.get(q_id, {}))
+
+  def Release(self, q_id, buffered, committed):
+    """Ends the Hold of job @p q_id: when the transaction was @p committed, the
+    @p buffered values it wrote are dropped from the buffer (unless they were
+    updated since)."""
+
+    with self._lock:
+      self._held[q_id] -= 1
+      if not self._held[q_id]:
+        del self._held[q_id]
+      pending = self._pending.get(q_id)
+      if committed and pending is not None:
+        for (key, value) in buffered.items():
+          if key in pending and pending[key] == value:
+            del pending[key]
+        if not pending:
+          del self._pending[q_id]
+
+  def Flush(self, sql):
+    """Writes the buffered updates with the @p sql object, except those of the
+    held jobs. On errors, the updates are put back in the buffer (unless they
+    were superseded)."""
+
+    with self._flush_lock:
+      with self._lock:
+        pending = dict([(q_id, values)
+                        for (q_id, values) in self._pending.items()
+                        if not q_id in self._held])
+        for q_id in pending:
+          del self._pending[q_id]
+      if not pending:
+        return
+      try:
+        sql.UpdateMany("gapps_queue", "q_id", pending, self._FLUSH_SIZE)
+      except (database.SQLTransientError, database.SQLPermanentError):
+        with self._lock:
+          for (q_id, values) in pending.items():
+            values.update(self._pending.get(q_id, {}))
+            self._pending[q_id] = values
+        raise
+    with self._lock:
+      self._flushes += 1
+      self._rows += len(pending)
+
+  def Stats(self):
+    """Returns the number of buffered updates, of flushes, and of flushed
+    updates."""
+
+    with self._lock:
+      return {
+        "pending": len(self._pending),
+        "flushes": self._flushes,
+        "rows": self._rows,
+      }
+
+  # Flusher thread.
+  def _FlushPending(self):
+    try:
+      with self._connections.Connection() as sql:
+        self.Flush(sql)
+    except Exception:
+      logger.info("Job status flush failed\n" + traceback.format_exc())
+
+  def run(self):
+    while not self._stop_event.is_set():
+      self._wakeup.wait(self._interval)
+      self._wakeup.clear()
+      self._FlushPending()
+
+  def Stop(self):
+    """Stops the flusher thread, and writes the remaining updates."""
+
+    self._stop_event.set()
+    self._wakeup.set()
+    if self.is_alive():
+      self.join()
+    self._FlushPending()
+    pending = self.Stats()["pending"]
+    if pending:
+      logger.error("Lost %d job status updates (the jobs will be run again)" \
+        % pending)
+
+
+# Status writer of the running queue (cf. Queue.Run), or None.
+_writer = None
+
+def SetWriter(writer):
+  """Sets the status @p writer used by Write (None for synchronous writes)."""
+
+  global _writer
+  _writer = writer
+
+def Write(sql, q_id, values):
+  """Updates the status @p values of job @p q_id in the queue table: the update
+  is buffered when a status writer is set, and written right away (along with
+  the buffered values of the job) otherwise, or when the @p sql object runs a
+  transaction (cf. job.Job.Complete). In the latter case, the buffered values
+  are only dropped once the transaction is committed."""
+
+  writer = _writer
+  if writer is None:
+    sql.Update("gapps_queue", values, {"q_id": q_id})
+  elif sql.InTransaction():
+    buffered = writer.Hold(q_id)
+    sql.AddTransactionCallback(
+      lambda committed: writer.Release(q_id, buffered, committed))
+    merged = dict(buffered)
+    merged.update(values)
+    sql.Update("gapps_queue", merged, {"q_id": q_id})
+  else:
+    writer.Add(q_id, values)
@@ -325,6 +325,11 @@ def _json_encode(data):
   return json.dumps(data, separators=(',', ':'))
 
 
+# The JWT header never changes, so its encoded segment is computed only once.
+_JWT_HEADER_SEGMENT = _urlsafe_b64encode(
+    _json_encode({'typ': 'JWT', 'alg': 'RS256'}))
+
+
 def make_signed_jwt(signer, payload):
   """Make a signed JWT.
 
@@ -337,10 +342,8 @@ def make_signed_jwt(signer, payload):
   Returns:
     string, The JWT for the payload.
   """
-  header = {'typ': 'JWT', 'alg': 'RS256'}
-
   segments = [
-      _urlsafe_b64encode(_json_encode(header)),
+      _JWT_HEADER_SEGMENT,
       _urlsafe_b64encode(_json_encode(payload)),
   ]
   signing_input = '.'.join(segments)
@@ -18,14 +18,20 @@
 import logging
 import unittest
 import testing.account
+import testing.api
 import testing.config
 import testing.daemon
 import testing.database
+import testing.depth
 import testing.job
+import testing.lease
 import testing.logger
 import testing.provisioning
 import testing.queue
 import testing.reporting
+import testing.sqlite
+import testing.worker
+import testing.writeback
 
 if __name__ == '__main__':
   logging.root.setLevel(logging.CRITICAL + 1)
@@ -41,8 +41,10 @@ class TestAccount(mox.MoxTestBase):
                       'foo.bar', {'g_account_name': 'qux.quz'})
 
   def testLoadFromDatabase(self):
-    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg())
-    self.sql.Query(mox.IgnoreArg(), ('foo.bar',)).AndReturn([self._ACCOUNT_DICT])
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory)
+    self.sql.Query(mox.IgnoreArg(), ('foo.bar',),
+                   row_factory=database.RecordRowFactory).AndReturn([self._ACCOUNT_DICT])
     self.mox.ReplayAll()
 
     self.assertEquals(
@@ -62,14 +64,16 @@ class TestAccount(mox.MoxTestBase):
     self.assertEquals(self.account.get("g_last_name"), "qux")
 
   def testCreateMissingFields(self):
-    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg())
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory)
     self.mox.ReplayAll()
 
     self.assertRaises(account.AccountActionError,
                       self.account.Create, self.sql)
 
   def testCreate(self):
-    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg())
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory)
     self.sql.Insert('gapps_accounts',
                     {'g_first_name': 'foo', 'g_last_name': 'bar',
                      'g_admin': True, 'g_account_name': 'foo.bar'})
@@ -79,8 +83,8 @@ class TestAccount(mox.MoxTestBase):
     self.account.Create(self.sql)
 
   def testCreateAlreadyExists(self):
-    self.sql.Query(mox.IgnoreArg(),
-                   mox.IgnoreArg()).AndReturn([self._ACCOUNT_DICT])
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory).AndReturn([self._ACCOUNT_DICT])
     self.mox.ReplayAll()
 
     self.account.set("g_last_name", "bar")
@@ -95,6 +99,51 @@ class TestAccount(mox.MoxTestBase):
     self.account.set("g_status", account.Account.STATUS_DISABLED)
     self.account.Update(self.sql)
 
+  def testUpsert(self):
+    self.sql.UpsertMany('gapps_accounts',
+                        [{'g_account_name': 'foo.bar', 'g_first_name': 'foo',
+                          'g_last_name': 'bar', 'g_status': 'disabled'}],
+                        ('g_last_name', 'g_status'), 100)
+    self.mox.ReplayAll()
+
+    self.assertRaises(account.AccountActionError, self.account.Upsert, self.sql)
+    self.account.set("g_last_name", "bar")
+    self.account.set("g_status", account.Account.STATUS_DISABLED)
+    self.account.Upsert(self.sql)
+
+  def testUpsertAccounts(self):
+    a = account.Account("qux.quz", {"g_first_name": "qux", "g_last_name": "quz"})
+    b = account.Account("foo.bar", {"g_first_name": "foo", "g_last_name": "bar"})
+    c = account.Account("bar.foo", {"g_first_name": "bar", "g_last_name": "foo"})
+    a.set("g_status", account.Account.STATUS_ACTIVE)
+    b.set("g_status", account.Account.STATUS_DISABLED)
+
+    self.sql.UpsertMany('gapps_accounts', [
+      {'g_account_name': 'qux.quz', 'g_first_name': 'qux',
+       'g_last_name': 'quz', 'g_status': 'active'},
+      {'g_account_name': 'foo.bar', 'g_first_name': 'foo',
+       'g_last_name': 'bar', 'g_status': 'disabled'},
+    ], ('g_status',), 100)
+    self.mox.ReplayAll()
+
+    account.UpsertAccounts(self.sql, [a, b, c])
+
+  def testUpdateAccounts(self):
+    a = account.Account("qux.quz", {"g_first_name": "qux", "g_last_name": "quz"})
+    b = account.Account("foo.bar", {"g_first_name": "foo", "g_last_name": "bar"})
+    c = account.Account("bar.foo", {"g_first_name": "bar", "g_last_name": "foo"})
+    a.set("g_status", account.Account.STATUS_ACTIVE)
+    b.set("g_first_name", "baz")
+    b.set("g_status", account.Account.STATUS_DISABLED)
+
+    self.sql.UpdateMany('gapps_accounts', 'g_account_name', {
+      'qux.quz': {'g_status': 'active'},
+      'foo.bar': {'g_first_name': 'baz', 'g_status': 'disabled'},
+    }, 100)
+    self.mox.ReplayAll()
+
+    account.UpdateAccounts(self.sql, [a, b, c])
+
   def testDelete(self):
     self.sql.Execute('DELETE FROM gapps_accounts WHERE g_account_name = %s',
                      ('foo.bar',))
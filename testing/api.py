@@ -0,0 +1,294 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import gappsd.api as api
+import gappsd.config as config
+import gappsd.logger as logger
+import httplib2
+import os
+import shutil
+import tempfile
+import mox, unittest
+
+class TestServiceRegistry(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.config = self.mox.CreateMock(config.Config)
+    self.registry = api.ServiceRegistry()
+    self.mox.StubOutWithMock(api, '_BuildApiService')
+
+  def testGetBuildsOnce(self):
+    api._BuildApiService(self.config, 'directory_v1', 'scope').AndReturn('dir')
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.registry.Get(self.config, 'directory_v1', 'scope'),
+                      'dir')
+    self.assertEquals(self.registry.Get(self.config, 'directory_v1', 'scope'),
+                      'dir')
+    self.assertEquals(self.registry.Stats(), {"builds": 1, "reuses": 1})
+
+  def testGetPerScope(self):
+    api._BuildApiService(self.config, 'directory_v1', 'foo').AndReturn('foo')
+    api._BuildApiService(self.config, 'directory_v1', 'bar').AndReturn('bar')
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.registry.Get(self.config, 'directory_v1', 'foo'),
+                      'foo')
+    self.assertEquals(self.registry.Get(self.config, 'directory_v1', 'bar'),
+                      'bar')
+    self.assertEquals(self.registry.Stats(), {"builds": 2, "reuses": 0})
+
+  def testReset(self):
+    api._BuildApiService(self.config, 'reports_v1', 'scope').AndReturn('a')
+    api._BuildApiService(self.config, 'reports_v1', 'scope').AndReturn('b')
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.registry.Get(self.config, 'reports_v1', 'scope'),
+                      'a')
+    self.registry.Reset()
+    self.assertEquals(self.registry.Get(self.config, 'reports_v1', 'scope'),
+                      'b')
+
+
+class TestDiscoveryCache(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.directory = tempfile.mkdtemp()
+    self.cache = api.DiscoveryCache(self.directory, 3600)
+    self.http = self.mox.CreateMockAnything()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    mox.MoxTestBase.tearDown(self)
+
+  def _Response(self, status, etag=None):
+    response = httplib2.Response({"status": status})
+    if etag:
+      response["etag"] = etag
+    return response
+
+  def testGetFetchesAndCaches(self):
+    self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+      (self._Response(200, '"v1"'), '{"foo": 1}'))
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.cache.Get('admin', 'directory_v1', self.http),
+                      '{"foo": 1}')
+    self.assertEquals(self.cache.Get('admin', 'directory_v1', self.http),
+                      '{"foo": 1}')
+
+  def testGetRevalidatesExpiredDocument(self):
+    self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+      (self._Response(200, '"v1"'), '{"foo": 1}'))
+    self.http.request(mox.IgnoreArg(), headers={"if-none-match": '"v1"'}) \
+      .AndReturn((self._Response(304), ''))
+    self.mox.ReplayAll()
+
+    self.cache.Get('admin', 'directory_v1', self.http)
+    self.cache._ttl = -1
+    self.assertEquals(self.cache.Get('admin', 'directory_v1', self.http),
+                      '{"foo": 1}')
+
+  def testGetFallsBackToCache(self):
+    self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+      (self._Response(200), '{"foo": 1}'))
+    self.http.request(mox.IgnoreArg(), headers={}).AndRaise(
+      httplib2.HttpLib2Error)
+    self.mox.ReplayAll()
+
+    self.cache.Get('admin', 'directory_v1', self.http)
+    self.cache._ttl = -1
+    self.assertEquals(self.cache.Get('admin', 'directory_v1', self.http),
+                      '{"foo": 1}')
+
+  def testGetWithoutCacheFails(self):
+    self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+      (self._Response(503), ''))
+    self.mox.ReplayAll()
+
+    self.assertRaises(logger.TransientError,
+                      self.cache.Get, 'admin', 'directory_v1', self.http)
+
+  def testGetRejectsInvalidDocument(self):
+    self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+      (self._Response(200), '{"foo": 1}'))
+    self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+      (self._Response(200), '<html>'))
+    self.mox.ReplayAll()
+
+    self.cache.Get('admin', 'directory_v1', self.http)
+    self.cache._ttl = -1
+    self.assertEquals(self.cache.Get('admin', 'directory_v1', self.http),
+                      '{"foo": 1}')
+    self.assertEquals(
+      open(self.cache._GetPath('admin', 'directory_v1')).read(), '{"foo": 1}')
+
+  def testGetInvalidDocumentWithoutCacheFails(self):
+    self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+      (self._Response(200), '<html>'))
+    self.mox.ReplayAll()
+
+    self.assertRaises(logger.TransientError,
+                      self.cache.Get, 'admin', 'directory_v1', self.http)
+    self.assertFalse(os.path.exists(
+      self.cache._GetPath('admin', 'directory_v1')))
+
+  def testGetIgnoresInvalidMetadata(self):
+    path = self.cache._GetPath('admin', 'directory_v1')
+    for metadata in ('[]', '{}', '{"fetched": "now"}'):
+      open(path, "w").write('{"foo": 1}')
+      open(path + ".meta", "w").write(metadata)
+      self.http.request(mox.IgnoreArg(), headers={}).AndReturn(
+        (self._Response(200), '{"foo": 2}'))
+      self.mox.ReplayAll()
+
+      self.assertEquals(self.cache.Get('admin', 'directory_v1', self.http),
+                        '{"foo": 2}')
+      self.mox.VerifyAll()
+      self.mox.ResetAll()
+
+
+class TestSignerCache(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.directory = tempfile.mkdtemp()
+    self.key_file = os.path.join(self.directory, "key.pem")
+    open(self.key_file, "w").write("key-1")
+    self.mox.StubOutWithMock(api.crypt.Signer, 'from_string')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    mox.MoxTestBase.tearDown(self)
+
+  def testGetSignerParsesOnce(self):
+    api.crypt.Signer.from_string("key-1", "secret").AndReturn("signer-1")
+    self.mox.ReplayAll()
+
+    self.assertEquals(api._GetSigner(self.key_file, "secret"), "signer-1")
+    self.assertEquals(api._GetSigner(self.key_file, "secret"), "signer-1")
+
+  def testGetSignerReloadsModifiedKey(self):
+    api.crypt.Signer.from_string("key-1", "secret").AndReturn("signer-1")
+    api.crypt.Signer.from_string("key-2", "secret").AndReturn("signer-2")
+    self.mox.ReplayAll()
+
+    self.assertEquals(api._GetSigner(self.key_file, "secret"), "signer-1")
+    open(self.key_file, "w").write("key-2")
+    os.utime(self.key_file, (0, 0))
+    self.assertEquals(api._GetSigner(self.key_file, "secret"), "signer-2")
+
+
+class FakeCredentials(object):
+  """Minimal credentials object, holding only token-related fields."""
+
+  def __init__(self, scope, access_token=None, token_expiry=None):
+    self.service_account_name = "client@example.org"
+    self.kwargs = {"sub": "admin@example.org"}
+    self.scope = scope
+    self.access_token = access_token
+    self.token_expiry = token_expiry
+    self.invalid = False
+
+  def _expires_in(self):
+    if not self.token_expiry:
+      return None
+    delta = self.token_expiry - datetime.datetime.utcnow()
+    return max(delta.days * 86400 + delta.seconds, 0)
+
+
+class TestTokenStorage(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, "tokens")
+    self.expiry = datetime.datetime(2030, 1, 1, 12, 0, 0)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testGetEmpty(self):
+    storage = api.TokenStorage(self.filename, FakeCredentials("foo"))
+    self.assertEquals(storage.get(), None)
+
+  def testPutGet(self):
+    storage = api.TokenStorage(self.filename, FakeCredentials("foo"))
+    storage.put(FakeCredentials("foo", "token", self.expiry))
+
+    credentials = api.TokenStorage(self.filename, FakeCredentials("foo")).get()
+    self.assertEquals(credentials.access_token, "token")
+    self.assertEquals(credentials.token_expiry, self.expiry)
+    self.assertEquals(os.stat(self.filename).st_mode & 0777, 0600)
+
+  def testPutPerScope(self):
+    api.TokenStorage(self.filename, FakeCredentials("foo")).put(
+      FakeCredentials("foo", "foo-token", self.expiry))
+    api.TokenStorage(self.filename, FakeCredentials("bar")).put(
+      FakeCredentials("bar", "bar-token", self.expiry))
+
+    storage = api.TokenStorage(self.filename, FakeCredentials("foo"))
+    self.assertEquals(storage.get().access_token, "foo-token")
+    storage.delete()
+    self.assertEquals(storage.get(), None)
+    storage = api.TokenStorage(self.filename, FakeCredentials("bar"))
+    self.assertEquals(storage.get().access_token, "bar-token")
+
+  def testPutInvalid(self):
+    storage = api.TokenStorage(self.filename, FakeCredentials("foo"))
+    storage.put(FakeCredentials("foo", "token", self.expiry))
+    credentials = FakeCredentials("foo", "token", self.expiry)
+    credentials.invalid = True
+    storage.put(credentials)
+    self.assertEquals(storage.get(), None)
+
+
+class TestTokenRefresher(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.refresher = api.TokenRefresher(300)
+
+  def testNeedsRefresh(self):
+    now = datetime.datetime.utcnow()
+    self.assertTrue(self.refresher.NeedsRefresh(FakeCredentials("foo")))
+    self.assertTrue(self.refresher.NeedsRefresh(FakeCredentials(
+      "foo", "token", now + datetime.timedelta(0, 60))))
+    self.assertFalse(self.refresher.NeedsRefresh(FakeCredentials(
+      "foo", "token", now + datetime.timedelta(0, 3600))))
+
+  def testRefreshAll(self):
+    now = datetime.datetime.utcnow()
+    expiring = self.mox.CreateMockAnything()
+    valid = FakeCredentials("bar", "token", now + datetime.timedelta(0, 3600))
+    self.refresher.Watch(expiring)
+    self.refresher.Watch(valid)
+
+    self.mox.StubOutWithMock(self.refresher, 'NeedsRefresh')
+    self.refresher.NeedsRefresh(expiring).AndReturn(True)
+    expiring.refresh(mox.IsA(httplib2.Http)).AndRaise(Exception("failure"))
+    self.refresher.NeedsRefresh(valid).AndReturn(False)
+    self.mox.ReplayAll()
+
+    self.refresher.RefreshAll()
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Dropped credentials are no longer watched.
+    del valid
+    self.refresher.NeedsRefresh(expiring).AndReturn(False)
+    self.mox.ReplayAll()
+
+    self.refresher.RefreshAll()
+    self.assertEquals(len(self.refresher._credentials), 1)
@@ -59,3 +59,11 @@ class TestConfig(unittest.TestCase):
     self.assertEquals(self.config.get_string("a"), "b")
     self.config.set("a", "42")
     self.assertEquals(self.config.get_int("a"), 42)
+
+  def testGetIntDict(self):
+    self.config.set("a", "")
+    self.assertEquals(self.config.get_int_dict("a"), {})
+    self.config.set("a", "foo:1, bar: 2")
+    self.assertEquals(self.config.get_int_dict("a"), {"foo": 1, "bar": 2})
+    self.config.set("a", "foo")
+    self.assertRaises(ValueError, self.config.get_int_dict, "a")
@@ -15,7 +15,64 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""TODO"""
-
 import gappsd.daemon as daemon
-import unittest
+import gappsd.database as database
+import gappsd.logger as logger
+import gappsd.queue as queue
+import gappsd.provisioning
+import testing.config
+import os, tempfile
+import mox, unittest
+
+class TestSubmissionServer(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.directory = tempfile.mkdtemp()
+    self.config = testing.config.MockConfig()
+    self.config.set("gappsd.submit-socket",
+                    os.path.join(self.directory, "submit.sock"))
+    self.sql = self.mox.CreateMock(database.SQL)
+    self.submissions = []
+    self.server = daemon.SubmissionServer(
+      self.config, lambda: self.submissions.append(True), self.sql)
+
+  def tearDown(self):
+    self.server.Stop()
+    os.rmdir(self.directory)
+    mox.MoxTestBase.tearDown(self)
+
+  def testHandleRequest(self):
+    self.mox.StubOutWithMock(queue, "CreateQueueJob")
+    queue.CreateQueueJob(self.sql, "u_update", {"username": "foo"}, "immediate")
+    queue.CreateQueueJob(self.sql, "u_foo", {}, "normal").AndRaise(
+      queue.job.JobTypeError("Job 'u_foo' is undefined."))
+    queue.CreateQueueJob(self.sql, "u_sync", {}, "normal").AndRaise(
+      database.SQLPermanentError("DataError: invalid p_priority"))
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.server.HandleRequest(
+      '{"j_type": "u_update", "j_parameters": {"username": "foo"}, '
+      '"p_priority": "immediate"}'), {"status": "ok"})
+    self.assertEquals(len(self.submissions), 1)
+    self.assertEquals(self.server.HandleRequest('{"j_type": "u_foo"}'),
+      {"status": "error", "message": "Job 'u_foo' is undefined."})
+    self.assertEquals(self.server.HandleRequest('{"j_type": "u_sync"}'),
+      {"status": "error", "message": "DataError: invalid p_priority"})
+    self.assertEquals(len(self.submissions), 1)
+
+  def testSubmitJob(self):
+    self.sql.Insert("gapps_queue", mox.ContainsKeyValue("j_type", "u_sync"))
+    self.sql.Execute("UPDATE gapps_queue_sequence SET seq = seq + 1")
+    self.sql.Close()
+    self.mox.ReplayAll()
+
+    self.server.Listen()
+    self.server.start()
+    socket_path = self.config.get_string("gappsd.submit-socket")
+    socket_mode = self.config.get_string("gappsd.submit-socket-mode")
+    self.assertEquals(os.stat(socket_path).st_mode & 0777, int(socket_mode, 8))
+    daemon.SubmitJob(socket_path, "u_sync", {"username": "foo"})
+    self.assertRaises(logger.PermanentError,
+                      daemon.SubmitJob, socket_path, "u_sync", [], "urgent")
+    self.assertEquals(len(self.submissions), 1)
+    self.server.Stop()
@@ -66,13 +66,59 @@ class TestSQL(mox.MoxTestBase):
 
     self.sql.Close()
 
+  def testOpenChecksConnection(self):
+    # Recently used connections are reused as is.
+    self.mox.ReplayAll()
+    self.sql.Open()
+    self.mox.ResetAll()
+
+    # Connections idle for a while are pinged.
+    self.connection.ping()
+    self.mox.ReplayAll()
+    self.sql._last_used -= 60
+    self.sql.Open()
+    self.mox.ResetAll()
+
+    # Dead connections are reopened.
+    self.mox.StubOutWithMock(MySQLdb, 'connect')
+    self.connection.ping().AndRaise(MySQLdb.OperationalError)
+    self.connection.close()
+    MySQLdb.connect(charset='utf8',
+                    db=mox.IgnoreArg(),
+                    host=mox.IgnoreArg(),
+                    passwd=mox.IgnoreArg(),
+                    use_unicode=True,
+                    user=mox.IgnoreArg()).AndReturn(self.connection)
+    self.connection.autocommit(True)
+    self.mox.ReplayAll()
+    self.sql._last_used -= 60
+    connects = database.connection_stats.Stats()["connects"]
+    self.sql.Open()
+    self.assertEquals(database.connection_stats.Stats()["connects"],
+                      connects + 1)
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Connections idle for too long are reopened without ping.
+    self.connection.close()
+    MySQLdb.connect(charset='utf8',
+                    db=mox.IgnoreArg(),
+                    host=mox.IgnoreArg(),
+                    passwd=mox.IgnoreArg(),
+                    use_unicode=True,
+                    user=mox.IgnoreArg()).AndReturn(self.connection)
+    self.connection.autocommit(True)
+    self.mox.ReplayAll()
+    self.sql._last_used -= 3600
+    self.sql.Open()
+
   def testQueryCallsOpen(self):
     self.mox.UnsetStubs()
     self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
     self.mock_cursor.execute(mox.IgnoreArg(), mox.IgnoreArg())
     self.mox.ReplayAll()
 
-    self.sql._SQL__Query(True, True, (), False)
+    self.sql._SQL__Query(True, 'query', (), False)
 
   def testQueryFetchesResults(self):
     self.mox.UnsetStubs()
@@ -81,7 +127,7 @@ class TestSQL(mox.MoxTestBase):
     self.mock_cursor.fetchall().AndReturn('bar')
     self.mox.ReplayAll()
 
-    self.assertEquals(self.sql._SQL__Query(True, True, (), True),
+    self.assertEquals(self.sql._SQL__Query(True, 'query', (), True),
                       ('foo', 'bar'))
 
   def testQueryErrors(self):
@@ -92,7 +138,7 @@ class TestSQL(mox.MoxTestBase):
       MySQLdb.DataError)
     self.mox.ReplayAll()
     self.assertRaises(database.SQLPermanentError,
-                      self.sql._SQL__Query, True, True, (), False)
+                      self.sql._SQL__Query, True, 'query', (), False)
     self.mox.ResetAll()
 
     self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
@@ -100,7 +146,7 @@ class TestSQL(mox.MoxTestBase):
       MySQLdb.IntegrityError)
     self.mox.ReplayAll()
     self.assertRaises(database.SQLPermanentError,
-                      self.sql._SQL__Query, True, True, (), False)
+                      self.sql._SQL__Query, True, 'query', (), False)
     self.mox.ResetAll()
 
     self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
@@ -108,25 +154,294 @@ class TestSQL(mox.MoxTestBase):
       MySQLdb.ProgrammingError)
     self.mox.ReplayAll()
     self.assertRaises(database.SQLPermanentError,
-                      self.sql._SQL__Query, True, True, (), False)
+                      self.sql._SQL__Query, True, 'query', (), False)
     self.mox.ResetAll()
 
     self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
     self.mock_cursor.execute(mox.IgnoreArg(), mox.IgnoreArg()).AndRaise(
       MySQLdb.Error)
+    self.connection.close()
     self.mox.ReplayAll()
     self.assertRaises(database.SQLTransientError,
-                      self.sql._SQL__Query, True, True, (), False)
+                      self.sql._SQL__Query, True, 'query', (), False)
+    self.assertEquals(self.sql._connection, None)
     self.mox.ResetAll()
+    self.sql._connection = self.connection
 
     self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
     self.mock_cursor.execute(mox.IgnoreArg(), mox.IgnoreArg()).AndRaise(
       MySQLdb.Warning)
     self.mox.ReplayAll()
     self.assertEquals((False, None),
-                      self.sql._SQL__Query(True, True, (), False))
+                      self.sql._SQL__Query(True, 'query', (), False))
+    self.mox.ResetAll()
+
+  def testIterate(self):
+    self.mox.UnsetStubs()
+    self.connection.cursor(MySQLdb.cursors.SSDictCursor).AndReturn(
+      self.mock_cursor)
+    self.mock_cursor.execute('query', ('args',))
+    self.mock_cursor.fetchmany(2).AndReturn(({'a': 1}, {'a': 2}))
+    self.mock_cursor.fetchmany(2).AndReturn(({'a': 3},))
+    self.mock_cursor.fetchmany(2).AndReturn(())
+    self.mock_cursor.close()
+    self.mox.ReplayAll()
+
+    self.assertEquals(list(self.sql.Iterate('query', ('args',), 2)),
+                      [{'a': 1}, {'a': 2}, {'a': 3}])
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Connection errors are transient, and discard the connection.
+    self.connection.cursor(MySQLdb.cursors.SSDictCursor).AndReturn(
+      self.mock_cursor)
+    self.mock_cursor.execute('query', ())
+    self.mock_cursor.fetchmany(1000).AndRaise(MySQLdb.OperationalError)
+    self.connection.close()
+    self.mox.ReplayAll()
+
+    self.assertRaises(database.SQLTransientError, list,
+                      self.sql.Iterate('query'))
+    self.assertEquals(self.sql._connection, None)
+
+  def testQueryRowFactory(self):
+    self.mox.UnsetStubs()
+    self.connection.cursor(MySQLdb.cursors.Cursor).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute('query', ()).AndReturn(2)
+    self.mock_cursor.fetchall().AndReturn(((1, 'a'), (2, 'b')))
+    self.mock_cursor.description = (('foo', 3), ('bar', 253))
+    self.mox.ReplayAll()
+
+    rows = self.sql.Query('query', row_factory=database.RecordRowFactory)
+    self.assertEquals(len(rows), 2)
+    self.assertEquals(rows[1]["foo"], 2)
+    self.assertEquals(rows[1].bar, 'b')
+    self.assertEquals(dict(rows[0]), {'foo': 1, 'bar': 'a'})
+
+  def testRecordRowFactory(self):
+    make_record = database.RecordRowFactory(('foo', 'COUNT(*)'))
+    record = make_record((42, 69))
+    make_other_record = database.RecordRowFactory(('foo', 'COUNT(*)'))
+    self.assertTrue(type(record) is type(make_other_record((1, 2))))
+    self.assertEquals(record, (42, 69))
+    self.assertEquals(record["foo"], 42)
+    self.assertEquals(record["COUNT(*)"], 69)
+    self.assertEquals(record[1], 69)
+    self.assertTrue("foo" in record)
+    self.assertFalse(42 in record)
+    self.assertEquals(record.get("bar", 0), 0)
+    self.assertEquals(record.keys(), ['foo', 'COUNT(*)'])
+    self.assertRaises(KeyError, lambda: record["bar"])
+    self.assertRaises(AttributeError, setattr, record, "foo", 1)
+
+  def testDeadlockErrors(self):
+    self.mox.UnsetStubs()
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute(mox.IgnoreArg(), mox.IgnoreArg()).AndRaise(
+      MySQLdb.OperationalError(1213, "Deadlock found"))
+    self.mox.ReplayAll()
+
+    self.sql._transaction_depth = 1
+    self.assertRaises(database.SQLDeadlockError,
+                      self.sql._SQL__Query, True, 'query', (), False)
+    self.assertEquals(self.sql._connection, self.connection)
+
+  def testQueryRetries(self):
+    self.mox.UnsetStubs()
+    self.mox.StubOutWithMock(self.sql, 'Open')
+    self.mox.StubOutWithMock(database.time, 'sleep')
+    def Reconnect():
+      self.sql._connection = self.connection
+
+    # Lost connections are reopened, and the query is retried.
+    self.sql.Open()
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute('UPDATE foo', ()).AndRaise(
+      MySQLdb.OperationalError(2006, "MySQL server has gone away"))
+    self.connection.close()
+    database.time.sleep(1)
+    self.sql.Open().WithSideEffects(Reconnect)
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute('UPDATE foo', ()).AndReturn(1)
+    self.mox.ReplayAll()
+    self.assertEquals(self.sql.Execute('UPDATE foo'), 1)
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Writes are not retried when the connection was lost while running them,
+    # reads are.
+    self.sql.Open()
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute('UPDATE foo', ()).AndRaise(
+      MySQLdb.OperationalError(2013, "Lost connection to MySQL server"))
+    self.connection.close()
+    self.sql.Open().WithSideEffects(Reconnect)
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute(' SELECT foo', ()).AndRaise(
+      MySQLdb.OperationalError(2013, "Lost connection to MySQL server"))
+    self.connection.close()
+    database.time.sleep(1)
+    self.sql.Open().WithSideEffects(Reconnect)
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute(' SELECT foo', ()).AndReturn(1)
+    self.mock_cursor.fetchall().AndReturn(({'foo': 1},))
+    self.mox.ReplayAll()
+    self.assertRaises(database.SQLTransientError,
+                      self.sql.Execute, 'UPDATE foo')
+    self.assertEquals(self.sql.Query(' SELECT foo'), ({'foo': 1},))
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Retries are bounded, with an exponential backoff.
+    for delay in (None, 1, 2):
+      if delay:
+        database.time.sleep(delay)
+      self.sql.Open()
+      self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+      self.mock_cursor.execute('UPDATE foo', ()).AndRaise(
+        MySQLdb.OperationalError(1213, "Deadlock found"))
+    self.mox.ReplayAll()
+    self.assertRaises(database.SQLDeadlockError, self.sql.Execute, 'UPDATE foo')
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Queries are not retried in transactions.
+    self.sql.Open()
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute('UPDATE foo', ()).AndRaise(
+      MySQLdb.OperationalError(1213, "Deadlock found"))
+    self.mox.ReplayAll()
+    self.sql._transaction_depth = 1
+    self.assertRaises(database.SQLDeadlockError, self.sql.Execute, 'UPDATE foo')
+
+  def testFingerprint(self):
+    self.assertEquals(
+      database.Fingerprint("SELECT *  FROM foo\n WHERE a = 'b' AND c = \"d\" "
+                           "AND e IN (%s, %s, 3) LIMIT 10"),
+      "SELECT * FROM foo WHERE a = ? AND c = ? AND e IN (?+) LIMIT ?")
+    self.assertEquals(
+      database.Fingerprint("INSERT INTO foo_2 (a, b) VALUES (%s, %s), "
+                           "(%s, %s)"),
+      "INSERT INTO foo_2 (a, b) VALUES (?+)")
+
+  def testStatementStats(self):
+    self.mox.UnsetStubs()
+    self.mox.StubOutWithMock(self.sql, 'Open')
+    self.mox.StubOutWithMock(database.time, 'time')
+    self.mox.StubOutWithMock(database.logger, 'warning')
+    database.statement_stats.Reset()
+    database.thread_stats.Reset()
+
+    database.time.time().AndReturn(100.0)
+    self.sql.Open()
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute('SELECT foo FROM bar WHERE id = %s', (1,))
+    self.mock_cursor.fetchall().AndReturn(({'foo': 1}, {'foo': 2}))
+    database.time.time().AndReturn(100.5)
+
+    # Statements slower than mysql.slow-query-threshold are logged.
+    database.time.time().AndReturn(200.0)
+    self.sql.Open()
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute('SELECT foo FROM bar WHERE id = %s', (2,))
+    self.mock_cursor.fetchall().AndReturn(())
+    database.time.time().AndReturn(202.0)
+    database.logger.warning(mox.StrContains("SELECT foo FROM bar WHERE id = ?"))
+    self.mox.ReplayAll()
+
+    self.sql.Query('SELECT foo FROM bar WHERE id = %s', (1,))
+    self.sql.Query('SELECT foo FROM bar WHERE id = %s', (2,))
+    self.assertEquals(database.statement_stats.Top(5), [{
+      "statement": "SELECT foo FROM bar WHERE id = ?",
+      "count": 2,
+      "time": 2.5,
+      "max_time": 2.0,
+      "rows": 2,
+    }])
+    self.assertEquals(database.thread_stats.Totals(),
+                      {"queries": 2, "time": 2.5, "rows": 2})
+
+  def testTransaction(self):
+    self.mox.StubOutWithMock(self.sql, 'Execute')
+    self.sql.Execute("START TRANSACTION")
+    self.sql.Execute("UPDATE foo")
+    self.sql.Execute("UPDATE bar")
+    self.sql.Execute("COMMIT")
+    self.mox.ReplayAll()
+
+    callbacks = []
+    with self.sql.Transaction():
+      self.sql.Execute("UPDATE foo")
+      with self.sql.Transaction():
+        self.sql.AddTransactionCallback(callbacks.append)
+        self.sql.Execute("UPDATE bar")
+      self.assertEquals(callbacks, [])
+    self.assertEquals(self.sql._transaction_depth, 0)
+    self.assertEquals(callbacks, [True])
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Errors roll the transaction back.
+    self.sql.Execute("START TRANSACTION")
+    self.sql.Execute("UPDATE foo").AndRaise(database.SQLPermanentError)
+    self.sql.Execute("ROLLBACK")
+    self.mox.ReplayAll()
+
+    def Transaction():
+      with self.sql.Transaction():
+        self.sql.AddTransactionCallback(callbacks.append)
+        self.sql.Execute("UPDATE foo")
+    self.assertRaises(database.SQLPermanentError, Transaction)
+    self.assertEquals(self.sql._transaction_depth, 0)
+    self.assertEquals(callbacks, [True, False])
+
+  def testTransactionLostCommit(self):
+    self.mox.UnsetStubs()
+    self.mox.StubOutWithMock(self.sql, 'Open')
+    for query in ("START TRANSACTION", "UPDATE foo"):
+      self.sql.Open()
+      self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+      self.mock_cursor.execute(query, ()).AndReturn(1)
+
+    # A COMMIT which lost its connection is neither retried nor rolled back.
+    self.sql.Open()
+    self.connection.cursor(mox.IgnoreArg()).AndReturn(self.mock_cursor)
+    self.mock_cursor.execute("COMMIT", ()).AndRaise(
+      MySQLdb.OperationalError(2006, "MySQL server has gone away"))
+    self.connection.close()
+    self.mox.ReplayAll()
+
+    def Transaction():
+      with self.sql.Transaction():
+        self.sql.Execute("UPDATE foo")
+    self.assertRaises(database.SQLTransientError, Transaction)
+    self.assertEquals(self.sql._transaction_depth, 0)
+    self.assertEquals(self.sql._connection, None)
+
+  def testRunInTransaction(self):
+    self.mox.StubOutWithMock(self.sql, 'Execute')
+    for attempt in range(4):
+      self.sql.Execute("START TRANSACTION")
+      self.sql.Execute("UPDATE foo").AndRaise(database.SQLDeadlockError)
+      self.sql.Execute("ROLLBACK")
+    self.mox.ReplayAll()
+
+    self.assertRaises(database.SQLDeadlockError, self.sql.RunInTransaction,
+                      self.sql.Execute, "UPDATE foo")
+    self.mox.VerifyAll()
     self.mox.ResetAll()
 
+    self.sql.Execute("START TRANSACTION")
+    self.sql.Execute("UPDATE foo").AndRaise(database.SQLDeadlockError)
+    self.sql.Execute("ROLLBACK")
+    self.sql.Execute("START TRANSACTION")
+    self.sql.Execute("UPDATE foo").AndReturn(1)
+    self.sql.Execute("COMMIT")
+    self.mox.ReplayAll()
+
+    self.assertEquals(
+      self.sql.RunInTransaction(self.sql.Execute, "UPDATE foo"), 1)
+
   def testUpdate(self):
     self.mox.StubOutWithMock(self.sql, 'Execute')
     self.sql.Execute('UPDATE foo SET bar = %s WHERE coin = %s',
@@ -135,6 +450,23 @@ class TestSQL(mox.MoxTestBase):
 
     self.sql.Update('foo', {'bar': 42}, {'coin': 'coin'})
 
+  def testUpdateMany(self):
+    self.mox.StubOutWithMock(self.sql, 'Execute')
+    self.sql.Execute(
+      "UPDATE foo SET bar = CASE id WHEN %s THEN %s WHEN %s THEN %s "
+      "ELSE bar END, qux = CASE id WHEN %s THEN %s ELSE qux END "
+      "WHERE id IN (%s, %s)", [1, "a", 2, "b", 2, "c", 1, 2]).AndReturn(2)
+    self.sql.Execute(
+      "UPDATE foo SET bar = CASE id WHEN %s THEN %s ELSE bar END "
+      "WHERE id IN (%s)", [3, "d", 3]).AndReturn(1)
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.sql.UpdateMany("foo", "id", {
+      2: {"bar": "b", "qux": "c"},
+      1: {"bar": "a"},
+      3: {"bar": "d"},
+    }, chunk_size=2), 3)
+
   def testInsert(self):
     self.mox.StubOutWithMock(self.sql, 'Execute')
     self.sql.Execute('INSERT INTO foo SET bar = %s', ['pan'])
@@ -142,6 +474,63 @@ class TestSQL(mox.MoxTestBase):
 
     self.sql.Insert('foo', {'bar': 'pan'})
 
+  def testInsertMany(self):
+    self.mox.StubOutWithMock(self.sql, 'Execute')
+    self.sql.Execute('INSERT INTO foo (bar, qux) VALUES (%s, %s), (%s, %s)',
+                     [1, 'a', 2, 'b']).AndReturn(2)
+    self.sql.Execute('INSERT INTO foo (bar, qux) VALUES (%s, %s)',
+                     [3, 'c']).AndReturn(1)
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.sql.InsertMany('foo', []), 0)
+    self.assertEquals(self.sql.InsertMany('foo', [
+      {'bar': 1, 'qux': 'a'},
+      {'qux': 'b', 'bar': 2},
+      {'bar': 3, 'qux': 'c'},
+    ], chunk_size=2), 3)
+    self.assertRaises(database.SQLPermanentError, self.sql.InsertMany,
+                      'foo', [{'bar': 1}, {'qux': 'b'}])
+
+  def testUpsertMany(self):
+    self.mox.StubOutWithMock(self.sql, 'Execute')
+    self.sql.Execute('INSERT INTO foo (bar, qux) VALUES (%s, %s), (%s, %s) '
+                     'ON DUPLICATE KEY UPDATE qux = VALUES(qux)',
+                     [1, 'a', 2, 'b']).AndReturn(3)
+    self.sql.Execute('INSERT INTO foo (bar, qux) VALUES (%s, %s) '
+                     'ON DUPLICATE KEY UPDATE bar = VALUES(bar), '
+                     'qux = VALUES(qux)', [3, 'c']).AndReturn(1)
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.sql.UpsertMany('foo', [
+      {'bar': 1, 'qux': 'a'},
+      {'bar': 2, 'qux': 'b'},
+    ], ['qux']), 3)
+    self.assertEquals(self.sql.Upsert('foo', {'bar': 3, 'qux': 'c'}), 1)
+    self.assertRaises(database.SQLPermanentError, self.sql.UpsertMany,
+                      'foo', [{'bar': 1}], [])
+
+  def testStatementCache(self):
+    self.mox.StubOutWithMock(self.sql, 'Execute')
+    self.sql.Execute('INSERT INTO foo SET bar = %s', ['pan']).MultipleTimes()
+    self.sql.Execute('UPDATE foo SET bar = %s WHERE coin = %s', [42, 'coin'])
+    self.mox.ReplayAll()
+
+    database.statement_cache.Clear()
+    self.sql.Insert('foo', {'bar': 'pan'})
+    self.sql.Insert('foo', {'bar': 'pan'})
+    self.sql.Update('foo', {'bar': 42}, {'coin': 'coin'})
+    self.assertEquals(database.statement_cache.Stats(),
+                      {"size": 2, "hits": 1, "misses": 2})
+
+    cache = database.StatementCache(2)
+    self.assertEquals(cache.Put("a", "A"), "A")
+    cache.Put("b", "B")
+    self.assertEquals(cache.Get("a"), "A")
+    cache.Put("c", "C")
+    self.assertEquals(cache.Get("a"), "A")
+    self.assertEquals(cache.Get("b"), None)
+    self.assertEquals(cache.Get("c"), "C")
+
   def testExecute(self):
     self.sql._SQL__Query(mox.IgnoreArg(),
                          'query', ('args',)).AndReturn((1, 2))
@@ -155,3 +544,160 @@ class TestSQL(mox.MoxTestBase):
     self.mox.ReplayAll()
 
     self.assertEquals(self.sql.Query('query', ('args', )), 2)
+
+class TestReplica(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.config = testing.config.MockConfig()
+    self.config.set("mysql.replica-hostname", "replica")
+    self.sql = database.SQL(self.config)
+    self.replica = self.sql._replica
+
+    self.mox.StubOutWithMock(self.sql, '_SQL__Query')
+    self.mox.StubOutWithMock(self.replica, 'Query')
+
+  def testInit(self):
+    self.assertEquals(self.replica._host, "replica")
+    self.assertEquals(self.replica._replica, None)
+    self.assertEquals(database.SQL(testing.config.MockConfig())._replica, None)
+
+  def testGetReplicationLag(self):
+    self.replica.Query("SHOW SLAVE STATUS").AndReturn(())
+    self.replica.Query("SHOW SLAVE STATUS").AndReturn(
+      ({"Seconds_Behind_Master": 42},))
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.replica.GetReplicationLag(), None)
+    self.assertEquals(self.replica.GetReplicationLag(), 42)
+
+  def testQueryRouting(self):
+    self.mox.StubOutWithMock(self.replica, 'GetReplicationLag')
+
+    # Lag-tolerant reads go to the replica, other queries to the primary.
+    self.replica.GetReplicationLag().AndReturn(5)
+    self.replica.Query('query', (), None).AndReturn(({'foo': 1},))
+    self.sql._SQL__Query(mox.IgnoreArg(), 'query', (),
+                         fetch=True).AndReturn((1, ({'foo': 2},)))
+    self.mox.ReplayAll()
+    self.assertEquals(self.sql.Query('query', lag_tolerant=True), ({'foo': 1},))
+    self.assertEquals(self.sql.Query('query'), ({'foo': 2},))
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Replica errors send the reads back to the primary.
+    self.replica.Query('query', (), None).AndRaise(database.SQLTransientError)
+    self.sql._SQL__Query(mox.IgnoreArg(), 'query', (),
+                         fetch=True).AndReturn((1, ({'foo': 2},)))
+    self.mox.ReplayAll()
+    self.assertEquals(self.sql.Query('query', lag_tolerant=True), ({'foo': 2},))
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # So do the replica errors of iterations, before the first row.
+    self.sql._replica_usable = True
+    self.mox.StubOutWithMock(self.sql, '_SQL__Iterate')
+    self.mox.StubOutWithMock(self.replica, 'Iterate')
+    def FailedIteration():
+      raise database.SQLTransientError
+      yield
+    self.replica.Iterate('query', (), 1000, None).AndReturn(iter([{'foo': 1}]))
+    self.replica.Iterate('query', (), 1000, None).AndReturn(FailedIteration())
+    self.sql._SQL__Iterate('query', (), 1000, None).AndReturn(
+      iter([{'foo': 2}]))
+    self.mox.ReplayAll()
+    self.assertEquals(list(self.sql.Iterate('query', lag_tolerant=True)),
+                      [{'foo': 1}])
+    self.assertEquals(list(self.sql.Iterate('query', lag_tolerant=True)),
+                      [{'foo': 2}])
+    self.assertFalse(self.sql._replica_usable)
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Lagging replicas are not used.
+    self.replica.GetReplicationLag().AndReturn(60)
+    self.sql._SQL__Query(mox.IgnoreArg(), 'query', (),
+                         fetch=True).AndReturn((1, ({'foo': 2},)))
+    self.mox.ReplayAll()
+    self.sql._replica_checked -= 10
+    self.assertEquals(self.sql.Query('query', lag_tolerant=True), ({'foo': 2},))
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Nor are the replicas of transactions.
+    self.sql._replica_usable = True
+    self.assertEquals(self.sql._GetReadServer(True), self.replica)
+    self.sql._transaction_depth = 1
+    self.assertEquals(self.sql._GetReadServer(True), self.sql)
+
+
+class TestConnectionPool(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.config = testing.config.MockConfig()
+    self.config.set("mysql.pool-max-size", "2")
+    self.config.set("mysql.pool-timeout", "0")
+    self.pool = database.ConnectionPool(self.config)
+    self.mox.StubOutWithMock(database, 'SQL')
+
+  def testConnection(self):
+    sql = self.mox.CreateMock(database.SQL)
+    sql._connection = None
+    database.SQL(self.config).AndReturn(sql)
+    sql.Open()
+    self.mox.ReplayAll()
+
+    with self.pool.Connection() as first_sql:
+      self.assertEquals(first_sql, sql)
+      self.assertEquals(self.pool.Stats()["in_use"], 1)
+    with self.pool.Connection() as second_sql:
+      self.assertEquals(second_sql, sql)
+
+    stats = self.pool.Stats()
+    self.assertEquals((stats["size"], stats["idle"], stats["in_use"]),
+                      (1, 1, 0))
+    self.assertEquals(stats["checkouts"], 2)
+
+  def testExhaustedPool(self):
+    database.SQL(self.config).AndReturn(self.mox.CreateMock(database.SQL))
+    database.SQL(self.config).AndReturn(self.mox.CreateMock(database.SQL))
+    self.mox.ReplayAll()
+
+    checkouts = [self.pool.Acquire(), self.pool.Acquire()]
+    self.assertRaises(database.SQLTransientError, self.pool.Acquire)
+    self.assertEquals(self.pool.Stats()["timeouts"], 1)
+
+  def testDiscardedConnections(self):
+    sql = self.mox.CreateMock(database.SQL)
+    database.SQL(self.config).AndReturn(sql)
+    sql._Discard()
+    self.mox.ReplayAll()
+
+    def _FailingQuery():
+      with self.pool.Connection() as sql:
+        raise database.SQLTransientError("connection lost")
+    self.assertRaises(database.SQLTransientError, _FailingQuery)
+    self.assertEquals(self.pool.Stats()["size"], 0)
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Deadlocks don't break the connection, which is kept in the pool.
+    database.SQL(self.config).AndReturn(sql)
+    self.mox.ReplayAll()
+
+    def _DeadlockedQuery():
+      with self.pool.Connection() as sql:
+        raise database.SQLDeadlockError("deadlock")
+    self.assertRaises(database.SQLDeadlockError, _DeadlockedQuery)
+    self.assertEquals(self.pool.Stats()["size"], 1)
+
+  def testMaxLifetime(self):
+    old_sql = self.mox.CreateMock(database.SQL)
+    new_sql = self.mox.CreateMock(database.SQL)
+    database.SQL(self.config).AndReturn(old_sql)
+    old_sql._Discard()
+    database.SQL(self.config).AndReturn(new_sql)
+    self.mox.ReplayAll()
+
+    self.pool.Release(self.pool.Acquire())
+    self.pool._idle[0] = (old_sql, self.pool._idle[0][1] - 7200)
+    self.assertEquals(self.pool.Acquire()[0], new_sql)
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gappsd.depth as depth
+import unittest
+
+class TestQueueDepthTracker(unittest.TestCase):
+  def setUp(self):
+    self.tracker = depth.QueueDepthTracker(["immediate", "normal"], 300)
+
+  def testNeedsRecount(self):
+    self.assertTrue(self.tracker.NeedsRecount(1000))
+    self.tracker.SetCounts({}, [], 0, 1000)
+    self.assertFalse(self.tracker.NeedsRecount(1299))
+    self.assertTrue(self.tracker.NeedsRecount(1300))
+
+  def testAddNewJobs(self):
+    self.tracker.SetCounts({"normal": 3}, [("immediate", 1100)], 10, 1000)
+    self.tracker.AddNewJobs([
+      {"q_id": 11, "p_priority": "normal", "p_status": "idle",
+       "p_admin_request": 0, "p_notbefore_date": 1000},
+      {"q_id": 12, "p_priority": "normal", "p_status": "idle",
+       "p_admin_request": 1, "p_notbefore_date": 1000},
+      {"q_id": 13, "p_priority": "immediate", "p_status": "idle",
+       "p_admin_request": 0, "p_notbefore_date": 1050},
+      {"q_id": 14, "p_priority": "normal", "p_status": "active",
+       "p_admin_request": 0, "p_notbefore_date": 1000},
+    ], 1000)
+    self.assertEquals(self.tracker.HighWaterMark(), 14)
+    self.assertEquals(self.tracker.Counts(1000), {"immediate": 0, "normal": 4})
+    self.assertEquals(self.tracker.Counts(1050), {"immediate": 1, "normal": 4})
+    self.assertEquals(self.tracker.Counts(1100), {"immediate": 2, "normal": 4})
+    self.assertEquals(self.tracker.Stats(),
+                      {"deferred": 0, "recounts": 1, "new_jobs": 2})
+
+  def testTrailingWindow(self):
+    self.tracker.SetCounts({}, [], 10, 1000)
+    job = {"p_priority": "normal", "p_status": "idle", "p_admin_request": 0,
+           "p_notbefore_date": 1000}
+    self.assertEquals(self.tracker.AddNewJobs(
+      [dict(job, q_id=11), dict(job, q_id=13)], 1000), 2)
+    self.assertEquals(self.tracker.ScanStart(), 13)
+    self.assertEquals(self.tracker.ScanStart(True), 10)
+
+    # Jobs already accounted for are ignored on the next scans.
+    self.assertEquals(self.tracker.AddNewJobs(
+      [dict(job, q_id=11), dict(job, q_id=12), dict(job, q_id=13)], 1000), 1)
+    self.assertEquals(self.tracker.Counts(1000)["normal"], 3)
+
+    self.tracker.AddNewJobs([dict(job, q_id=200)], 1000)
+    self.assertEquals(self.tracker.ScanStart(True), 100)
+    self.assertEquals(self.tracker._recent_jobs, set([200]))
+
+  def testTransitions(self):
+    self.tracker.SetCounts({"normal": 2}, [], 10, 1000)
+    self.tracker.OnClaimed("normal")
+    self.tracker.OnClaimed("normal", 5)
+    self.assertEquals(self.tracker.Counts(1000)["normal"], 0)
+    self.tracker.OnReleased("normal", 2)
+    self.tracker.OnDeferred("normal", 1200)
+    self.tracker.OnClaimed(None)
+    self.assertEquals(self.tracker.Counts(1000)["normal"], 2)
+    self.assertEquals(self.tracker.Counts(1200)["normal"], 3)
@@ -174,6 +174,20 @@ class TestJob(mox.MoxTestBase):
     self.assertEquals(j_fail._data["p_status"], job.Job.STATUS_HARDFAIL)
     self.mox.ResetAll()
 
+  def testComplete(self):
+    j = job.Job(self.config, self.sql, self._VALID_DICT)
+    writes = []
+
+    self.sql.RunInTransaction(mox.IgnoreArg()).WithSideEffects(
+      lambda function: function())
+    self.sql.Update('gapps_queue',
+                    mox.ContainsKeyValue('p_status', job.Job.STATUS_SUCCESS),
+                    {"q_id": 42})
+    self.mox.ReplayAll()
+
+    j.Complete(writes.append, "foo")
+    self.assertEquals(writes, ["foo"])
+
   def testStatusOther(self):
     j = job.Job(self.config, self.sql, self._VALID_DICT)
     self.assertRaises(job.JobActionError, j.Update, "invalid status")
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import gappsd.database as database
+import gappsd.lease as lease
+import testing.config
+import mox, unittest
+
+class TestLeaseKeeper(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.config = testing.config.MockConfig()
+    self.config.set("gappsd.lease-duration-per-type", "r_accounts:600")
+    self.keeper = lease.LeaseKeeper(self.config, None)
+    self.sql = self.mox.CreateMock(database.SQL)
+
+  def testGetDuration(self):
+    self.assertEquals(self.keeper.GetDuration("u_sync"), 90)
+    self.assertEquals(self.keeper.GetDuration("r_accounts"), 600)
+    self.assertEquals(self.keeper._interval, 30)
+
+    now = datetime.datetime(2015, 1, 1, 12, 0, 0)
+    self.assertEquals(self.keeper.GetExpiry("r_accounts", now),
+                      datetime.datetime(2015, 1, 1, 12, 10, 0))
+
+  def testAddRemove(self):
+    self.keeper.Add(1, "token-1", "u_sync")
+    self.keeper.Add(2, "token-2", "r_accounts")
+    self.assertEquals(self.keeper.Count(), 2)
+    self.keeper.Remove(1)
+    self.keeper.Remove(3)
+    self.assertEquals(self.keeper.Count(), 1)
+
+  def testRenewAll(self):
+    self.keeper.Add(1, "token-1", "u_sync")
+    self.keeper.Add(2, "token-2", "u_update")
+    self.keeper.Add(3, "token-3", "r_accounts")
+    self.sql.Execute(
+      mox.StrContains("p_claim_token IN (%s, %s)"),
+      mox.And(mox.In("token-1"), mox.In("token-2"))).AndReturn(2)
+    self.sql.Execute(
+      mox.StrContains("p_claim_token IN (%s)"),
+      mox.In("token-3")).AndReturn(0)
+    self.mox.ReplayAll()
+
+    self.keeper.RenewAll(self.sql)
@@ -19,7 +19,9 @@ import datetime
 import gappsd.database as database
 import gappsd.job as job
 import gappsd.logger as logger
+import gappsd.provisioning
 import gappsd.queue as queue
+import gappsd.worker as worker
 import testing.config
 import time
 import mox, unittest
@@ -37,11 +39,50 @@ class TestCreateQueueJob(mox.MoxTestBase):
       "p_entry_date": "2007-01-01 01:00:00",
       "p_notbefore_date": "2007-01-01 01:00:00",
     })
+    self.sql.Execute("UPDATE gapps_queue_sequence SET seq = seq + 1")
     self.mox.ReplayAll()
 
     queue.CreateQueueJob(self.sql, 'u_sync', [{}, {"blih": 1}],
                          p_entry_date=datetime.datetime(2007, 1, 1, 1))
 
+  def testCreateQueueJobs(self):
+    self.sql.InsertMany('gapps_queue', [{
+      "j_type": "u_sync",
+      "j_parameters": "{\"username\": \"foo\"}",
+      "p_priority": "offline",
+      "p_entry_date": "2007-01-01 01:00:00",
+      "p_notbefore_date": "2007-01-01 01:00:00",
+    }, {
+      "j_type": "u_sync",
+      "j_parameters": "{\"username\": \"bar\"}",
+      "p_priority": "offline",
+      "p_entry_date": "2007-01-01 01:00:00",
+      "p_notbefore_date": "2007-01-01 01:00:00",
+    }])
+    self.sql.Execute("UPDATE gapps_queue_sequence SET seq = seq + 1")
+    self.mox.ReplayAll()
+
+    queue.CreateQueueJobs(self.sql, [], p_priority="offline")
+    queue.CreateQueueJobs(self.sql, [
+      ('u_sync', {"username": "foo"}),
+      ('u_sync', {"username": "bar"}),
+    ], p_priority="offline", p_entry_date=datetime.datetime(2007, 1, 1, 1))
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    self.mox.ReplayAll()
+    self.assertRaises(job.JobTypeError, queue.CreateQueueJobs, self.sql,
+                      [('u_sync', {}), ('no_such_job', {})])
+
+  def testValidateQueueJob(self):
+    queue.ValidateQueueJob('u_sync', {"username": "foo"}, 'immediate')
+    self.assertRaises(job.JobTypeError,
+                      queue.ValidateQueueJob, 'u_foo', {}, 'normal')
+    self.assertRaises(job.JobContentError,
+                      queue.ValidateQueueJob, 'u_sync', {}, 'urgent')
+    self.assertRaises(job.JobContentError,
+                      queue.ValidateQueueJob, 'u_sync', {"a": object()}, 'normal')
+
 class TestQueue(mox.MoxTestBase):
   _VALID_JOB_DICT = {
     "q_id": 1, "p_status": "idle", "p_entry_date": 42, "p_start_date": 42,
@@ -100,8 +141,21 @@ class TestQueue(mox.MoxTestBase):
     queues = [q for q in self.queue._GetNextPriorityQueue(job_counts)]
     self.assertEquals(queues, [])
 
+  def testGetActiveJobsCondition(self):
+    now = datetime.datetime(2015, 1, 1, 12, 0, 0)
+    (clause, args) = queue.Queue._GetActiveJobsCondition(now=now)
+    self.assertFalse("NOW()" in clause)
+    self.assertEquals(clause.count("%s"), len(args))
+    self.assertEquals(args, ["2015-01-01 12:00:00", "2015-01-01 12:00:00",
+                             "2015-01-01 11:58:30"])
+
+    (clause, args) = queue.Queue._GetActiveJobsCondition(admin=True, now=now)
+    self.assertTrue("p_admin_request = 1" in clause)
+    self.assertEquals(clause.count("%s"), len(args))
+
   def testGetJobCounts(self):
-    self.sql.Query(mox.IgnoreArg()).AndReturn([
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory).AndReturn([
       {"p_priority": "immediate", "count": 42},
       {"p_priority": "normal", "count": 69},
       {"p_priority": "offline", "count": 666},
@@ -111,19 +165,65 @@ class TestQueue(mox.MoxTestBase):
     self.assertEquals(self.queue._GetJobCounts(),
                       {"immediate": 42, "normal": 69, "offline": 666})
 
+  def testRefreshJobCounts(self):
+    self.mox.StubOutWithMock(self.queue, "_GetJobCounts")
+    self.mox.StubOutWithMock(self.queue, "_GetChangeMarker")
+    def Recount(high_water_mark, counts):
+      self.sql.Query("SELECT MAX(q_id) AS q_id FROM gapps_queue").AndReturn(
+        [{"q_id": high_water_mark}])
+      self.queue._GetJobCounts().AndReturn(counts)
+      self.sql.Query(self.queue._DEFERRED_JOBS_QUERY, mox.IgnoreArg(),
+                     row_factory=database.RecordRowFactory).AndReturn(
+        [{"p_priority": "offline", "p_notbefore_date": time.time() + 3600}])
+
+    self.queue._GetChangeMarker().AndReturn(1)
+    Recount(10, {"normal": 2})
+    self.queue._GetChangeMarker().AndReturn(1)
+    self.sql.Query(self.queue._NEW_JOBS_QUERY, (10,),
+                   row_factory=database.RecordRowFactory).AndReturn([
+      {"q_id": 11, "p_priority": "immediate", "p_status": "idle",
+       "p_admin_request": 0, "p_notbefore_date": time.time() - 1},
+    ])
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.queue._RefreshJobCounts(),
+                      {"immediate": 0, "normal": 2, "offline": 0})
+    self.assertEquals(self.queue._RefreshJobCounts(),
+                      {"immediate": 1, "normal": 2, "offline": 0})
+    self.assertEquals(self.queue._depth.HighWaterMark(), 11)
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # When the change marker moved, the jobs committed below the high-water
+    # mark are picked up from the trailing window, or with a full recount.
+    self.queue._GetChangeMarker().AndReturn(2)
+    self.sql.Query(self.queue._NEW_JOBS_QUERY, (10,),
+                   row_factory=database.RecordRowFactory).AndReturn([
+      {"q_id": 11, "p_priority": "immediate", "p_status": "idle",
+       "p_admin_request": 0, "p_notbefore_date": time.time() - 1},
+    ])
+    Recount(11, {"normal": 3})
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.queue._RefreshJobCounts(),
+                      {"immediate": 0, "normal": 3, "offline": 0})
+
   def testGetJobFromQueue(self):
     kTestJob = self.mox.CreateMock(job.Job)
     testing.job.RegisterMockedJob(kTestJob)
 
     # Tests a failed Job Retrieval.
-    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(())
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory).AndReturn(())
     self.mox.ReplayAll()
     self.assertEquals(self.queue._GetJobFromQueue('offline'), None)
     self.mox.ResetAll()
 
     # Tests an invalid job retrieval.
     self._VALID_JOB_DICT['j_type'] = 'foo'
-    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn([self._VALID_JOB_DICT])
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory).AndReturn([self._VALID_JOB_DICT])
+    self.sql.Execute(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(1)
     self.sql.Update(mox.IgnoreArg(),
                     mox.And(mox.ContainsKeyValue('p_status', 'hardfail'),
                             mox.ContainsKeyValue('r_result', "Job instantiation error: Job 'foo' is undefined.")),
@@ -134,10 +234,31 @@ class TestQueue(mox.MoxTestBase):
 
     # Tests a successful job retrieval.
     self._VALID_JOB_DICT['j_type'] = 'mock'
-    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn([self._VALID_JOB_DICT])
-    kTestJob.MarkActive()
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory).AndReturn([self._VALID_JOB_DICT])
+    self.sql.Execute(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(1)
+    self.mox.ReplayAll()
+    self.assertEquals(self.queue._GetJobFromQueue('offline'), kTestJob)
+    self.mox.ResetAll()
+
+  def testClaimJob(self):
+    job_dict = dict(self._VALID_JOB_DICT, j_type="u_sync")
+
+    # Tests a successful claim.
+    self.sql.Execute(mox.StrContains("WHERE q_id = %s AND p_admin_request = 0"),
+                     mox.Func(lambda args: args[4] == 1)).AndReturn(1)
+    self.mox.ReplayAll()
+    claimed_dict = self.queue._ClaimJob(job_dict)
+    self.assertEquals(claimed_dict["p_status"], "active")
+    self.assertEquals(len(claimed_dict["p_claim_token"]), 32)
+    self.assertEquals(job_dict["p_status"], "idle")
+    self.assertEquals(self.queue._leases.Count(), 1)
+    self.mox.ResetAll()
+
+    # Tests a claim lost to another worker.
+    self.sql.Execute(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn(0)
     self.mox.ReplayAll()
-    j = self.queue._GetJobFromQueue('offline')
+    self.assertEquals(self.queue._ClaimJob(job_dict), None)
     self.mox.ResetAll()
 
   def testProcessJob(self):
@@ -192,19 +313,202 @@ class TestQueue(mox.MoxTestBase):
     self.mox.ResetAll()
 
   def testProcessNextJob(self):
-    self.mox.StubOutWithMock(self.queue, "_GetJobCounts")
+    self.mox.StubOutWithMock(self.queue, "_RefreshJobCounts")
     self.mox.StubOutWithMock(self.queue, "_GetJobFromQueue")
     self.mox.StubOutWithMock(self.queue, "_ProcessJob")
-    self.queue._GetJobCounts().AndReturn({
+    self.queue._RefreshJobCounts().AndReturn({
       "immediate": 1, "normal": 0, "offline": 1})
-    self.queue._GetJobFromQueue('immediate').AndReturn('immediate_job')
-    self.queue._ProcessJob('immediate_job')
-    self.queue._GetJobFromQueue('offline').AndReturn('offline_job')
-    self.queue._ProcessJob('offline_job')
+    immediate_job = self.mox.CreateMock(job.Job)
+    offline_job = self.mox.CreateMock(job.Job)
+    self.queue._GetJobFromQueue('immediate').AndReturn(immediate_job)
+    self.queue._ProcessJob(immediate_job)
+    immediate_job.status().AndReturn((job.Job.STATUS_SUCCESS, 0))
+    immediate_job.id().AndReturn(1)
+    self.queue._GetJobFromQueue('offline').AndReturn(offline_job)
+    self.queue._ProcessJob(offline_job)
+    offline_job.status().AndReturn((job.Job.STATUS_SOFTFAIL, 1))
+    offline_job.id().AndReturn(2)
     self.mox.ReplayAll()
 
     self.queue._ProcessNextJob()
     self.assertEquals(self.queue._job_counts["immediate"], 1)
+    self.assertEquals(self.queue._depth.Stats()["deferred"], 1)
+
+  def testProcessNextJobWithPool(self):
+    self.queue._pool = self.mox.CreateMock(worker.WorkerPool)
+    self.mox.StubOutWithMock(self.queue, "_RefreshJobCounts")
+    self.mox.StubOutWithMock(self.queue, "_ClaimJobFromQueue")
+    self.queue._RefreshJobCounts().AndReturn({
+      "immediate": 3, "normal": 1, "offline": 1})
+
+    # Each delay slot dispatches jobs up to the free capacity of the pool.
+    self.queue._pool.FreeCapacity('immediate').AndReturn(2)
+    for q_id in (1, 2):
+      self.queue._pool.SaturatedJobTypes().AndReturn([])
+      self.queue._ClaimJobFromQueue('immediate', []).AndReturn({"q_id": q_id})
+      self.queue._pool.Dispatch('immediate', {"q_id": q_id})
+
+    # Queues without claimable jobs are left until the next round.
+    self.queue._pool.FreeCapacity('normal').AndReturn(2)
+    self.queue._pool.SaturatedJobTypes().AndReturn(['u_sync'])
+    self.queue._ClaimJobFromQueue('normal', ['u_sync']).AndReturn(None)
+    self.queue._pool.FreeCapacity('offline').AndReturn(0)
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.queue._ProcessNextJob(),
+                      {"immediate": 3, "normal": 0, "offline": 1})
+    self.assertEquals(self.queue._job_counts["immediate"], 2)
+    self.assertEquals(self.queue._job_counts["normal"], 0)
+    self.assertEquals(self.queue._last_jobs["offline"], None)
+
+  def testProcessNextJobBudget(self):
+    self.queue._pool = worker.WorkerPool(None, None, 2)
+    self.mox.StubOutWithMock(self.queue, "_RefreshJobCounts")
+    self.mox.StubOutWithMock(self.queue, "_ClaimJobFromQueue")
+    self.mox.StubOutWithMock(self.queue._pool, "Dispatch")
+    self.queue._RefreshJobCounts().AndReturn({"normal": 10})
+    for q_id in (1, 2):
+      self.queue._ClaimJobFromQueue('normal', []).AndReturn({"q_id": q_id})
+      self.queue._pool.Dispatch('normal', {"q_id": q_id})
+    self.mox.ReplayAll()
+
+    # Workers freed during the dispatch loop (here, jobs are over as soon as
+    # they are dispatched) are not used before the next delay slot.
+    self.queue._ProcessNextJob()
+    self.assertEquals(self.queue._job_counts["normal"], 2)
+    self.assertEquals(list(self.queue._GetNextPriorityQueue({"normal": 10})),
+                      [])
+
+  def testClaimJobFromQueue(self):
+    self.mox.StubOutWithMock(self.queue, "_ClaimJob")
+    self.sql.Query(mox.StrContains("j_type NOT IN (%s)"),
+                   mox.Func(lambda args: args[-2:] == ('normal', 'r_accounts')),
+                   row_factory=database.RecordRowFactory).AndReturn([{"q_id": 1}])
+    self.queue._ClaimJob({"q_id": 1}).AndReturn(None)
+    self.sql.Query(mox.StrContains("j_type NOT IN (%s)"),
+                   mox.Func(lambda args: args[-2:] == ('normal', 'r_accounts')),
+                   row_factory=database.RecordRowFactory).AndReturn([{"q_id": 2}])
+    self.queue._ClaimJob({"q_id": 2}).AndReturn({"q_id": 2})
+    self.mox.ReplayAll()
+
+    self.assertEquals(
+      self.queue._ClaimJobFromQueue('normal', ['r_accounts']), {"q_id": 2})
+
+  def testGetNextWakeupDelay(self):
+    now = datetime.datetime.now()
+    self.queue._deadline = None
+    self.sql.Query(self.queue._NEXT_WAKEUP_QUERY, mox.IgnoreArg()).AndReturn([{
+      "next_notbefore": None, "next_lease_expiry": None}])
+    self.sql.Query(self.queue._NEXT_WAKEUP_QUERY, mox.IgnoreArg()).AndReturn([{
+      "next_notbefore": time.mktime(now.timetuple()) + 30,
+      "next_lease_expiry": None}])
+    self.sql.Query(self.queue._NEXT_WAKEUP_QUERY, mox.IgnoreArg()).AndReturn([{
+      "next_notbefore": None, "next_lease_expiry": None}])
+    self.mox.ReplayAll()
+
+    # Idle queue: waits for the maximal idle delay.
+    job_counts = {"immediate": 0, "normal": 0, "offline": 0}
+    self.assertEquals(self.queue._GetNextWakeupDelay(job_counts), 60)
+
+    # Idle queue with a delayed job.
+    delay = self.queue._GetNextWakeupDelay(job_counts)
+    self.assertTrue(delay >= 29 and delay <= 30)
+
+    # Non-empty queue: waits for the next slot, at least the minimal delay.
+    job_counts["normal"] = 1
+    self.queue._last_jobs["normal"] = now - datetime.timedelta(0, 3600)
+    self.assertEquals(self.queue._GetNextWakeupDelay(job_counts), 4)
+    self.mox.VerifyAll()
+    self.mox.ResetAll()
+
+    # Queues waiting for a free worker are woken up by the pool instead.
+    self.queue._pool = self.mox.CreateMock(worker.WorkerPool)
+    self.queue._pool.CanDispatch("normal").AndReturn(False)
+    self.sql.Query(self.queue._NEXT_WAKEUP_QUERY, mox.IgnoreArg()).AndReturn([{
+      "next_notbefore": None, "next_lease_expiry": None}])
+    self.mox.ReplayAll()
+    self.assertEquals(self.queue._GetNextWakeupDelay(job_counts), 60)
+
+  def testWaitForNextJob(self):
+    for marker in ((1, 10), (1, 10), (2, 10), (2, 10), (2, 11), (2, 11)):
+      self.sql.Query(self.queue._CHANGE_MARKER_QUERY).AndReturn(
+        [{"seq": marker[0], "q_id": marker[1]}])
+    self.mox.ReplayAll()
+
+    # Waits until the change marker is bumped, or until new jobs are inserted.
+    self.queue._min_delay = 0.01
+    self.queue._WaitForNextJob(60)
+    self.queue._WaitForNextJob(60)
+
+    # Returns immediately after a Wakeup() call.
+    self.queue.Wakeup()
+    self.queue._WaitForNextJob(60)
+    self.assertFalse(self.queue._wakeup.is_set())
+
+  def testPrefetchJobs(self):
+    self.queue._prefetch = 2
+    self.queue._leases._durations = {"u_update": 600}
+    self.sql.Query(mox.StrContains("ORDER BY q_id LIMIT 2"),
+                   mox.Func(lambda args: args[-2:] == ('normal', 'r_accounts')),
+                   row_factory=database.RecordRowFactory).AndReturn([
+      {"q_id": 1, "j_type": "u_sync"},
+      {"q_id": 2, "j_type": "u_update"},
+      {"q_id": 3, "j_type": "u_sync"},
+    ])
+
+    # Candidates are claimed by q_id, with the longest lease of the batch.
+    def CheckClaim(args):
+      lease = datetime.datetime.strptime(args[2], job.Job._DATE_FORMAT) - \
+        datetime.datetime.strptime(args[1], job.Job._DATE_FORMAT)
+      return lease.seconds == 600 and args[4:7] == (1, 2, 3)
+    self.sql.Execute(mox.StrContains("WHERE q_id IN (%s, %s, %s) AND"),
+                     mox.Func(CheckClaim)).AndReturn(2)
+    self.sql.Query(mox.StrContains("WHERE p_claim_token = %s"),
+                   mox.IgnoreArg(), row_factory=database.RecordRowFactory).AndReturn([
+      {"q_id": 1, "j_type": "u_sync"},
+      {"q_id": 2, "j_type": "u_update"},
+    ])
+    self.sql.Query(mox.IgnoreArg(), mox.IgnoreArg(),
+                   row_factory=database.RecordRowFactory).AndReturn([])
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.queue._PrefetchJobs('normal', ['r_accounts']), 2)
+    self.assertEquals(len(self.queue._prefetched['normal']), 2)
+    self.assertEquals(self.queue._leases.Count(), 2)
+    self.assertEquals(self.queue._prefetched['normal'][0]["p_claim_token"],
+                      self.queue._prefetched['normal'][1]["p_claim_token"])
+    self.assertEquals(self.queue._PrefetchJobs('offline'), 0)
+
+  def testTakePrefetchedJob(self):
+    self.queue._prefetch = 2
+    self.mox.StubOutWithMock(self.queue, "_PrefetchJobs")
+    self.queue._prefetched['normal'].extend([
+      {"q_id": 1, "j_type": "r_accounts"},
+      {"q_id": 2, "j_type": "u_sync"},
+    ])
+    self.queue._PrefetchJobs('normal', ['u_sync']).AndReturn(0)
+    self.mox.ReplayAll()
+
+    self.assertEquals(self.queue._ClaimNextJob('normal', ['r_accounts']),
+                      {"q_id": 2, "j_type": "u_sync"})
+    self.assertEquals(self.queue._ClaimNextJob('normal', ['u_sync']),
+                      {"q_id": 1, "j_type": "r_accounts"})
+    self.assertEquals(self.queue._ClaimNextJob('normal', ['u_sync']), None)
+
+  def testReleasePrefetchedJobs(self):
+    self.queue._prefetched['normal'].append(
+      {"q_id": 1, "j_type": "u_sync", "p_claim_token": "token"})
+    self.queue._prefetched['offline'].append(
+      {"q_id": 2, "j_type": "r_accounts", "p_claim_token": "token"})
+    self.queue._leases.Add(1, "token", "u_sync")
+    self.queue._leases.Add(2, "token", "r_accounts")
+    self.sql.Execute(mox.StrContains("WHEN r_softfail_count > 0"),
+                     (1, 2, "token")).AndReturn(2)
+    self.mox.ReplayAll()
+
+    self.queue._ReleasePrefetchedJobs()
+    self.assertEquals(len(self.queue._prefetched['normal']), 0)
+    self.assertEquals(self.queue._leases.Count(), 0)
 
   def testAddTransientError(self):
     # Raises an exception to make sure sys.exc_info returns something.
@@ -271,12 +575,18 @@ class TestQueue(mox.MoxTestBase):
   def testRun(self):
     self.mox.StubOutWithMock(self.queue, '_CheckTransientErrors')
     self.mox.StubOutWithMock(self.queue, '_ProcessNextJob')
-    self.mox.StubOutWithMock(time, 'sleep')
+    self.mox.StubOutWithMock(self.queue._leases, 'start')
+    self.mox.StubOutWithMock(self.queue._leases, 'Stop')
+    self.mox.StubOutWithMock(self.queue, '_GetNextWakeupDelay')
+    self.mox.StubOutWithMock(self.queue, '_WaitForNextJob')
 
+    self.queue._leases.start()
     self.queue._CheckTransientErrors()
-    self.queue._ProcessNextJob()
+    self.queue._ProcessNextJob().AndReturn({"normal": 0})
+    self.queue._GetNextWakeupDelay({"normal": 0}).AndReturn(60)
+    self.queue._WaitForNextJob(60).AndRaise(Exception("out-of-loop"))
+    self.queue._leases.Stop()
     self.sql.Close()
-    time.sleep(4).AndRaise(Exception("out-of-loop"))
     self.mox.ReplayAll()
 
     self.assertRaises(Exception, self.queue.Run)
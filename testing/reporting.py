@@ -19,6 +19,7 @@ import datetime
 import gappsd.database as database
 import gappsd.job as job
 import gappsd.logger as logger
+import gappsd.provisioning
 import gappsd.reporting as reporting
 import google.reporting
 import testing.config
@@ -140,58 +141,69 @@ class TestAccountsReport(mox.MoxTestBase):
       reporting.AccountsJob(self.config, self.sql, self._ACCOUNTS_JOB_DATA)
 
   def testSynchronizeSQLAccount(self):
-    self.sql.Insert('gapps_queue',
-                    mox.ContainsKeyValue('j_parameters',
-                                         '{"username": "foo.bar"}'))
     self.mox.ReplayAll()
     self.accounts.SynchronizeSQLAccount({
       "g_account_name": "foo.bar",
       "g_status": "active",
     })
-    self.mox.ResetAll()
-
-    self.mox.ReplayAll()
     self.accounts.SynchronizeSQLAccount({
       "g_account_name": "qux.quz",
       "g_status": "unprovisioned",
     })
+    self.assertEquals(self.accounts._sync_jobs,
+                      [('u_sync', {"username": "foo.bar"})])
 
   def testSynchronizeReportingAccount(self):
-    self.sql.Insert('gapps_queue',
-                    mox.ContainsKeyValue('j_parameters',
-                                         '{"username": "foo.bar"}'))
     self.mox.ReplayAll()
-
     self.accounts.SynchronizeReportingAccount({
       "account_name": "foo.bar",
       "creation_date": "20070101",
     })
+    self.assertEquals(self.accounts._sync_jobs,
+                      [('u_sync', {"username": "foo.bar"})])
+
+  def testCreateSyncJobs(self):
+    self.sql.InsertMany('gapps_queue', mox.Func(lambda rows: len(rows) == 2))
+    self.sql.Execute("UPDATE gapps_queue_sequence SET seq = seq + 1")
+    self.mox.ReplayAll()
+
+    self.accounts.SynchronizeReportingAccount({"account_name": "foo.bar"})
+    self.accounts.SynchronizeReportingAccount({"account_name": "qux.quz"})
+    self.accounts.CreateSyncJobs()
 
   def testSynchronizeSQLReportingAccounts(self):
     # Test the synchronization of reporting-owned values.
-    self.sql.Update('gapps_accounts',
-                    mox.ContainsKeyValue('r_disk_usage', 69),
-                    mox.IgnoreArg())
-    self.sql.Insert('gapps_accounts', None)
     self.mox.ReplayAll()
     self.accounts.SynchronizeSQLReportingAccounts(self._ACCOUNT_DICT,
-      {"usage_in_bytes": 69, "last_login_date": "20070101"})
+      {"creation_date": "20070102"})
+    self.assertEquals(self.accounts._sync_jobs, [])
+    self.assertEquals(self.accounts._updated_accounts[0].get("r_creation"),
+                      "20070102")
     self.mox.ResetAll()
 
     # Test the synchronization of values owned by the provisioning API.
-    self.sql.Update('gapps_accounts',
-                    mox.ContainsKeyValue('r_last_webmail', '20070102'),
-                    mox.IgnoreArg())
-    self.sql.Insert('gapps_queue',
-                    mox.ContainsKeyValue('j_parameters',
-                                         '{"username": "foo.bar"}'))
     self.mox.ReplayAll()
     self.accounts.SynchronizeSQLReportingAccounts(self._ACCOUNT_DICT,
-      {"surname": "qux", "last_web_mail_date": "20070102"})
+      {"surname": "qux"})
+    self.assertEquals(self.accounts._sync_jobs,
+                      [('u_sync', {"username": "foo.bar"})])
+    self.assertEquals(len(self.accounts._updated_accounts), 1)
     self.mox.ResetAll()
 
+  def testSaveAccounts(self):
+    self.sql.UpdateMany('gapps_accounts', 'g_account_name',
+                        {'foo.bar': {'r_creation': '20070102'}}, 100)
+    self.mox.ReplayAll()
+
+    self.accounts.SynchronizeSQLReportingAccounts(self._ACCOUNT_DICT,
+      {"creation_date": "20070102"})
+    self.accounts.SaveAccounts()
+
   def testFetchSQLAccounts(self):
-    self.sql.Query(mox.IgnoreArg()).AndReturn([{"g_account_name": "foo.bar"}])
+    self.sql.Iterate(mox.IgnoreArg(),
+                     row_factory=database.RecordRowFactory,
+                     lag_tolerant=True).AndReturn(
+      iter([{"g_account_name": "foo.bar"}]))
     self.mox.ReplayAll()
 
     a = self.accounts.FetchSQLAccounts()
@@ -208,10 +220,13 @@ class TestAccountsReport(mox.MoxTestBase):
     self.mox.StubOutWithMock(self.accounts, 'SynchronizeSQLAccount')
     self.mox.StubOutWithMock(self.accounts, 'SynchronizeReportingAccount')
     self.mox.StubOutWithMock(self.accounts, 'SynchronizeSQLReportingAccounts')
-    self.mox.StubOutWithMock(self.accounts, 'Update')
+    self.mox.StubOutWithMock(self.accounts, 'Complete')
 
     # Account which requires a SQL <-> Reporting synchronization.
-    self.sql.Query(mox.IgnoreArg()).AndReturn([{"g_account_name": "foo.bar"}])
+    self.sql.Iterate(mox.IgnoreArg(),
+                     row_factory=database.RecordRowFactory,
+                     lag_tolerant=True).AndReturn(
+      [{"g_account_name": "foo.bar"}])
     self.client.GetLatestReportDate().AndReturn(datetime.date(2007, 1, 1))
     self.client.GetReport(datetime.date(2007, 1, 1), 'accounts').AndReturn([{
       "account_name": "foo.bar@a.b",
@@ -219,23 +234,28 @@ class TestAccountsReport(mox.MoxTestBase):
       "given_name": "bar",
     }])
     self.accounts.SynchronizeSQLReportingAccounts(mox.IgnoreArg(), mox.IgnoreArg())
-    self.accounts.Update(job.Job.STATUS_SUCCESS)
+    self.accounts.Complete(self.accounts._WriteChanges)
     self.mox.ReplayAll()
     self.accounts.Run()
     self.mox.ResetAll()
 
     # Account which requires a SQL <- Reporting synchronization.
-    self.sql.Query(mox.IgnoreArg()).AndReturn([{"g_account_name": "qux.quz"}])
+    self.sql.Iterate(mox.IgnoreArg(),
+                     row_factory=database.RecordRowFactory,
+                     lag_tolerant=True).AndReturn(
+      [{"g_account_name": "qux.quz"}])
     self.client.GetLatestReportDate().AndReturn(datetime.date(2007, 1, 1))
     self.client.GetReport(datetime.date(2007, 1, 1), 'accounts').AndReturn([])
     self.accounts.SynchronizeSQLAccount(mox.IgnoreArg())
-    self.accounts.Update(job.Job.STATUS_SUCCESS)
+    self.accounts.Complete(self.accounts._WriteChanges)
     self.mox.ReplayAll()
     self.accounts.Run()
     self.mox.ResetAll()
 
     # Account which requires a SQL -> Reporting synchronization.
-    self.sql.Query(mox.IgnoreArg()).AndReturn([])
+    self.sql.Iterate(mox.IgnoreArg(),
+                     row_factory=database.RecordRowFactory,
+                     lag_tolerant=True).AndReturn([])
     self.client.GetLatestReportDate().AndReturn(datetime.date(2007, 1, 1))
     self.client.GetReport(datetime.date(2007, 1, 1), 'accounts').AndReturn([{
       "account_name": "foo.bar@a.b",
@@ -243,14 +263,17 @@ class TestAccountsReport(mox.MoxTestBase):
       "given_name": "bar",
     }])
     self.accounts.SynchronizeReportingAccount(mox.IgnoreArg())
-    self.accounts.Update(job.Job.STATUS_SUCCESS)
+    self.accounts.Complete(self.accounts._WriteChanges)
     self.mox.ReplayAll()
     self.accounts.Run()
     self.mox.ResetAll()
 
     # Account which requires a SQL <-> Reporting synchronization, with an over
     # long suspension reason.
-    self.sql.Query(mox.IgnoreArg()).AndReturn([{"g_account_name": "foo.bar"}])
+    self.sql.Iterate(mox.IgnoreArg(),
+                     row_factory=database.RecordRowFactory,
+                     lag_tolerant=True).AndReturn(
+      [{"g_account_name": "foo.bar"}])
     self.client.GetLatestReportDate().AndReturn(datetime.date(2007, 1, 1))
     self.client.GetReport(datetime.date(2007, 1, 1), 'accounts').AndReturn([{
       "account_name": "foo.bar@a.b",
@@ -261,7 +284,7 @@ class TestAccountsReport(mox.MoxTestBase):
     self.accounts.SynchronizeSQLReportingAccounts(
       mox.IgnoreArg(),
       mox.ContainsKeyValue("suspension_reason", "a" * 256))
-    self.accounts.Update(job.Job.STATUS_SUCCESS)
+    self.accounts.Complete(self.accounts._WriteChanges)
     self.mox.ReplayAll()
     self.accounts.Run()
     self.mox.ResetAll()
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gappsd.database as database
+import gappsd.job as job
+import gappsd.queue as queue
+import gappsd.sqlite as sqlite
+import testing.config
+import datetime, time, unittest
+
+class TestTranslation(unittest.TestCase):
+  def testPlaceholders(self):
+    self.assertEquals(
+      sqlite.TranslateQuery("SELECT * FROM t WHERE a = %s AND b LIKE 'c%%'"),
+      "SELECT * FROM t WHERE a = ? AND b LIKE 'c%'")
+    self.assertEquals(
+      sqlite.TranslateQuery("SELECT 'c%%'", placeholders=False),
+      "SELECT 'c%%'")
+
+  def testInserts(self):
+    self.assertEquals(
+      sqlite.TranslateQuery("INSERT INTO t SET a = %s, b = CONCAT(%s, 'x')"),
+      "INSERT INTO t (a, b) VALUES (?, CONCAT(?, 'x'))")
+    self.assertEquals(
+      sqlite.TranslateQuery("INSERT IGNORE INTO t (a) VALUES (1)"),
+      "INSERT OR IGNORE INTO t (a) VALUES (1)")
+    self.assertEquals(
+      sqlite.TranslateQuery("INSERT INTO t (a, b) VALUES (%s, %s) "
+                            "ON DUPLICATE KEY UPDATE b = VALUES(b)"),
+      "INSERT INTO t (a, b) VALUES (?, ?) "
+      "ON CONFLICT DO UPDATE SET b = excluded.b")
+
+  def testUpdateLimit(self):
+    self.assertEquals(
+      sqlite.TranslateQuery("UPDATE t SET a = %s WHERE b = %s "
+                            "ORDER BY c LIMIT 5"),
+      "UPDATE t SET a = ? WHERE rowid IN "
+      "(SELECT rowid FROM t WHERE b = ? ORDER BY c LIMIT 5)")
+    self.assertEquals(
+      sqlite.TranslateQuery("UPDATE t SET a = %s WHERE b = %s"),
+      "UPDATE t SET a = ? WHERE b = ?")
+
+  def testDateFunctions(self):
+    self.assertEquals(
+      sqlite.TranslateQuery("SELECT UNIX_TIMESTAMP(MIN(a)) FROM t"),
+      "SELECT CAST(strftime('%s', MIN(a), 'utc') AS INTEGER) FROM t")
+    self.assertEquals(
+      sqlite.TranslateQuery("SELECT DATE_FORMAT(a, '%%Y-%%m') FROM t"),
+      "SELECT strftime('%Y-%m', a) FROM t")
+    self.assertEquals(
+      sqlite.TranslateQuery("DELETE FROM t WHERE a < "
+                            "DATE_SUB(NOW(), INTERVAL %s DAY)"),
+      "DELETE FROM t WHERE a < "
+      "datetime(datetime('now', 'localtime'), '-' || (?) || ' days')")
+    self.assertEquals(
+      sqlite.TranslateQuery("SELECT DATE_ADD(CURDATE(), INTERVAL 2 MONTH)"),
+      "SELECT date(date('now', 'localtime'), '+' || (2) || ' months')")
+    self.assertRaises(ValueError, sqlite.TranslateQuery,
+                      "SELECT DATE_ADD(NOW(), INTERVAL 2 WEEK)")
+
+  def testTransactions(self):
+    self.assertEquals(sqlite.TranslateQuery("START TRANSACTION"),
+                      "BEGIN IMMEDIATE")
+    self.assertEquals(sqlite.TranslateQuery("COMMIT"), "COMMIT")
+
+  def testTranslateTable(self):
+    self.assertEquals(sqlite.TranslateTable(
+      """CREATE TABLE IF NOT EXISTS `t` (
+           -- Fields.
+           id INT NOT NULL AUTO_INCREMENT,
+           a SMALLINT UNSIGNED DEFAULT NULL,
+           b ENUM('x', 'y') DEFAULT 'x' NOT NULL,
+           c DATETIME NOT NULL,
+           PRIMARY KEY(id),
+           INDEX a(a),
+           UNIQUE KEY bc(b, c)
+         ) CHARSET=utf8"""), [
+      "CREATE TABLE IF NOT EXISTS t (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+      "a SMALLINT DEFAULT NULL, b TEXT DEFAULT 'x' NOT NULL, "
+      "c TIMESTAMP NOT NULL)",
+      "CREATE INDEX IF NOT EXISTS t_a ON t(a)",
+      "CREATE UNIQUE INDEX IF NOT EXISTS t_bc ON t(b, c)",
+    ])
+
+
+class TestSQLiteBackend(unittest.TestCase):
+  def setUp(self):
+    self.config = testing.config.MockConfig()
+    self.config.set("mysql.backend", "sqlite")
+    self.config.set("mysql.database", ":memory:")
+    self.sql = database.SQL(self.config)
+    sqlite.LoadSchema(self.sql, "doc/gapps.schema.sql")
+
+  def tearDown(self):
+    self.sql.Close()
+
+  def testQueue(self):
+    job.job_registry.Register("t_sqlite", job.Job)
+    queue.CreateQueueJobs(self.sql, [("t_sqlite", {"a": 1})] * 3)
+    self.assertEquals(
+      self.sql.Query("SELECT seq FROM gapps_queue_sequence")[0]["seq"], 1)
+
+    self.assertEquals(self.sql.Execute(
+      "UPDATE gapps_queue SET p_status = %s WHERE p_status = %s "
+      "ORDER BY q_id LIMIT 2", ("active", "idle")), 2)
+    rows = self.sql.Query(
+      "SELECT q_id, p_status, p_entry_date, "
+      "UNIX_TIMESTAMP(p_entry_date) AS timestamp FROM gapps_queue "
+      "ORDER BY q_id", row_factory=database.RecordRowFactory)
+    self.assertEquals([row["p_status"] for row in rows],
+                      ["active", "active", "idle"])
+    self.assertTrue(isinstance(rows[0]["p_entry_date"], datetime.datetime))
+    self.assertEquals(rows[0]["timestamp"],
+                      int(time.mktime(rows[0]["p_entry_date"].timetuple())))
+
+  def testChangeMarker(self):
+    q = queue.Queue(self.config, self.sql, None)
+    marker = q._GetChangeMarker()
+    self.assertEquals(marker, (0, None))
+    self.sql.Insert("gapps_queue", {
+      "j_type": "u_sync", "p_priority": "immediate",
+      "p_entry_date": "2015-01-01 00:00:00",
+      "p_notbefore_date": "2015-01-01 00:00:00"})
+    self.assertEquals(q._GetChangeMarker(), (0, 1))
+    q._connections.Close()
+
+  def testIterate(self):
+    self.sql.InsertMany("gapps_accounts", [
+      {"g_account_name": name, "g_first_name": "f", "g_last_name": "l"}
+      for name in ("a", "b", "c")])
+    self.assertEquals(
+      [row["g_account_name"] for row in self.sql.Iterate(
+        "SELECT g_account_name FROM gapps_accounts ORDER BY g_account_name",
+        batch_size=2)],
+      ["a", "b", "c"])
+
+  def testUpsert(self):
+    values = {"g_account_name": "a", "g_first_name": "f", "g_last_name": "l"}
+    self.sql.Upsert("gapps_accounts", values)
+    values["g_first_name"] = "g"
+    self.sql.Upsert("gapps_accounts", values, ["g_first_name"])
+    self.assertEquals(
+      self.sql.Query("SELECT g_first_name FROM gapps_accounts"),
+      ({"g_first_name": "g"},))
+
+  def testTransaction(self):
+    self.sql.Insert("gapps_queue_sequence", {"id": 2, "seq": 0})
+    try:
+      with self.sql.Transaction():
+        self.sql.Execute("DELETE FROM gapps_queue_sequence")
+        raise ValueError
+    except ValueError:
+      pass
+    self.assertEquals(
+      self.sql.Query("SELECT COUNT(*) AS count FROM gapps_queue_sequence"),
+      ({"count": 2},))
+
+  def testErrors(self):
+    self.assertRaises(database.SQLPermanentError, self.sql.Insert,
+                      "gapps_queue_sequence", {"id": 1, "seq": 0})
+    self.assertRaises(database.SQLPermanentError, self.sql.Query,
+                      "SELECT * FROM unknown_table")
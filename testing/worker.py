@@ -0,0 +1,97 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gappsd.worker as worker
+import contextlib
+import mox, unittest
+
+class FakeConnectionPool(object):
+  """Connection pool handing out a placeholder SQL object."""
+
+  def __init__(self):
+    self.checkouts = 0
+
+  @contextlib.contextmanager
+  def Connection(self):
+    self.checkouts += 1
+    yield "sql"
+
+class TestWorkerPool(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.connections = FakeConnectionPool()
+    self.handled = []
+    self.pool = worker.WorkerPool(self.connections, self._Handler, 2,
+                                  {"offline": 1}, {"r_accounts": 1})
+
+  def _Handler(self, sql, job_dict):
+    self.assertEquals(sql, "sql")
+    if job_dict["j_type"] == "u_fail":
+      raise ValueError("unexpected error")
+    self.handled.append(job_dict["q_id"])
+
+  def testCanDispatch(self):
+    self.assertTrue(self.pool.CanDispatch("offline"))
+    self.pool._Acquire("offline", "u_sync")
+    self.assertFalse(self.pool.CanDispatch("offline"))
+    self.assertTrue(self.pool.CanDispatch("normal"))
+    self.pool._Acquire("normal", "u_sync")
+    self.assertFalse(self.pool.CanDispatch("normal"))
+
+    self.pool._Release("offline", "u_sync")
+    self.assertTrue(self.pool.CanDispatch("normal"))
+    self.assertEquals(self.pool.InFlight(), 1)
+
+  def testFreeCapacity(self):
+    self.assertEquals(self.pool.FreeCapacity("normal"), 2)
+    self.assertEquals(self.pool.FreeCapacity("offline"), 1)
+    self.pool._Acquire("offline", "u_sync")
+    self.assertEquals(self.pool.FreeCapacity("normal"), 1)
+    self.assertEquals(self.pool.FreeCapacity("offline"), 0)
+    self.pool._Acquire("normal", "u_sync")
+    self.assertEquals(self.pool.FreeCapacity("normal"), 0)
+
+  def testSaturatedJobTypes(self):
+    self.assertEquals(self.pool.SaturatedJobTypes(), [])
+    self.pool._Acquire("offline", "r_accounts")
+    self.assertEquals(self.pool.SaturatedJobTypes(), ["r_accounts"])
+    self.pool._Release("offline", "r_accounts")
+    self.assertEquals(self.pool.SaturatedJobTypes(), [])
+
+  def testDispatch(self):
+    self.pool.Start()
+    self.pool.Dispatch("normal", {"q_id": 1, "j_type": "u_sync"})
+    self.pool.Dispatch("offline", {"q_id": 2, "j_type": "r_accounts"})
+    self.pool.Stop()
+
+    self.assertEquals(sorted(self.handled), [1, 2])
+    self.assertEquals(self.pool.InFlight(), 0)
+    self.assertEquals(self.connections.checkouts, 2)
+
+  def testErrors(self):
+    done = []
+    self.pool._on_done = lambda: done.append(True)
+    self.pool.Start()
+    self.pool.Dispatch("normal", {"q_id": 1, "j_type": "u_fail"})
+    self.pool.Dispatch("normal", {"q_id": 2, "j_type": "u_sync"})
+    self.pool.Stop()
+
+    # Unexpected errors are passed back to the scheduler thread.
+    self.assertEquals(self.handled, [2])
+    self.assertEquals(len(done), 2)
+    self.assertRaises(ValueError, self.pool.CheckErrors)
+    self.pool.CheckErrors()
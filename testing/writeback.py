@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gappsd.database as database
+import gappsd.writeback as writeback
+import testing.config
+import mox, unittest
+
+class TestStatusWriter(mox.MoxTestBase):
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.config = testing.config.MockConfig()
+    self.config.set("gappsd.status-flush-interval", 5)
+    self.writer = writeback.StatusWriter(self.config, None)
+    self.sql = self.mox.CreateMock(database.SQL)
+
+  def tearDown(self):
+    writeback.SetWriter(None)
+    mox.MoxTestBase.tearDown(self)
+
+  def testInterval(self):
+    self.assertEquals(self.writer._interval, 5)
+    self.config.set("gappsd.lease-duration-per-type", "u_sync:6")
+    self.assertEquals(
+      writeback.StatusWriter(self.config, None)._interval, 2)
+
+  def testSynchronousWrite(self):
+    self.sql.Update("gapps_queue", {"p_status": "success"}, {"q_id": 42})
+    self.mox.ReplayAll()
+
+    writeback.Write(self.sql, 42, {"p_status": "success"})
+
+  def testBufferedWrite(self):
+    self.sql.InTransaction().AndReturn(False)
+    self.sql.InTransaction().AndReturn(False)
+    self.sql.InTransaction().AndReturn(False)
+    self.sql.UpdateMany("gapps_queue", "q_id", {
+      42: {"p_status": "success", "r_result": "bar"},
+      43: {"p_status": "hardfail"},
+    }, 100)
+    self.mox.ReplayAll()
+
+    writeback.SetWriter(self.writer)
+    writeback.Write(self.sql, 42, {"p_status": "softfail", "r_result": "foo"})
+    writeback.Write(self.sql, 43, {"p_status": "hardfail"})
+    writeback.Write(self.sql, 42, {"p_status": "success", "r_result": "bar"})
+    self.assertEquals(self.writer.Stats()["pending"], 2)
+
+    self.writer.Flush(self.sql)
+    self.assertEquals(self.writer.Stats(),
+                      {"pending": 0, "flushes": 1, "rows": 2})
+
+  def testWriteInTransaction(self):
+    callbacks = []
+    self.sql.InTransaction().AndReturn(False)
+    self.sql.InTransaction().AndReturn(True)
+    self.sql.AddTransactionCallback(mox.IgnoreArg()) \
+      .WithSideEffects(callbacks.append)
+    self.sql.Update("gapps_queue", {"p_status": "success", "r_result": "foo"},
+                    {"q_id": 42})
+    self.sql.InTransaction().AndReturn(True)
+    self.sql.AddTransactionCallback(mox.IgnoreArg()) \
+      .WithSideEffects(callbacks.append)
+    self.sql.Update("gapps_queue", {"p_status": "success", "r_result": "foo"},
+                    {"q_id": 42})
+    self.mox.ReplayAll()
+
+    # Buffered values are written along with the transaction, but are only
+    # dropped from the buffer once it is committed.
+    writeback.SetWriter(self.writer)
+    writeback.Write(self.sql, 42, {"p_status": "active", "r_result": "foo"})
+    writeback.Write(self.sql, 42, {"p_status": "success"})
+    callbacks.pop()(False)
+    self.assertEquals(self.writer.Stats()["pending"], 1)
+    writeback.Write(self.sql, 42, {"p_status": "success"})
+    callbacks.pop()(True)
+    self.assertEquals(self.writer.Stats()["pending"], 0)
+
+  def testFlushHeldJobs(self):
+    self.writer.Add(42, {"p_status": "active", "r_result": "foo"})
+    self.writer.Add(43, {"p_status": "success"})
+    self.sql.UpdateMany("gapps_queue", "q_id",
+                        {43: {"p_status": "success"}}, 100)
+    self.mox.ReplayAll()
+
+    # Jobs written in a running transaction are not flushed meanwhile.
+    buffered = self.writer.Hold(42)
+    self.assertEquals(buffered, {"p_status": "active", "r_result": "foo"})
+    self.writer.Flush(self.sql)
+    self.writer.Add(42, {"r_result": "bar"})
+    self.writer.Release(42, buffered, True)
+    self.assertEquals(self.writer._pending, {42: {"r_result": "bar"}})
+
+  def testFlushErrors(self):
+    self.writer.Add(42, {"p_status": "softfail", "r_result": "foo"})
+    self.sql.UpdateMany("gapps_queue", "q_id", mox.IgnoreArg(), 100) \
+      .WithSideEffects(lambda *args: self.writer.Add(42, {"r_result": "bar"})) \
+      .AndRaise(database.SQLTransientError)
+    self.mox.ReplayAll()
+
+    # Failed updates are buffered again, unless they were superseded.
+    self.assertRaises(database.SQLTransientError, self.writer.Flush, self.sql)
+    self.assertEquals(self.writer._pending,
+                      {42: {"p_status": "softfail", "r_result": "bar"}})
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the per-assertion cost of the OAuth JWT signing, with the signer
+parsed for every assertion (previous behaviour of the credentials), and with
+the signer cache of gappsd.api.
+
+Usage:
+  benchmark-jwt-signing.py [--key-file /path/to/key.pem] [--iterations 200]
+
+When no key file is given, a temporary 2048 bits RSA key is generated.
+"""
+
+# Sets up the python path for 'gappsd' modules inclusion.
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import gappsd.api
+import optparse
+import tempfile
+import time
+from google.oauth2client import crypt
+from OpenSSL import crypto
+
+_PAYLOAD = {
+  'aud': 'https://accounts.google.com/o/oauth2/token',
+  'scope': 'https://www.googleapis.com/auth/admin.directory.user',
+  'iss': 'client@developer.gserviceaccount.com',
+  'sub': 'admin@example.org',
+}
+
+def CreateTemporaryKey():
+  """Generates a temporary PEM private key, and returns its filename."""
+
+  key = crypto.PKey()
+  key.generate_key(crypto.TYPE_RSA, 2048)
+  (fd, filename) = tempfile.mkstemp(suffix=".pem")
+  os.write(fd, crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+  os.close(fd)
+  return filename
+
+def SignUncached(key_file, iterations):
+  for i in xrange(iterations):
+    private_key = open(key_file, "rb").read()
+    signer = crypt.Signer.from_string(private_key, 'notasecret')
+    crypt.make_signed_jwt(signer, dict(_PAYLOAD, iat=i, exp=i + 3600))
+
+def SignCached(key_file, iterations):
+  for i in xrange(iterations):
+    signer = gappsd.api._GetSigner(key_file, 'notasecret')
+    crypt.make_signed_jwt(signer, dict(_PAYLOAD, iat=i, exp=i + 3600))
+
+def Measure(name, function, key_file, iterations):
+  start = time.time()
+  function(key_file, iterations)
+  duration = time.time() - start
+  print("%-10s %8.3f ms/assertion" % (name, 1000 * duration / iterations))
+  return duration
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser()
+  parser.add_option("-k", "--key-file", action="store", dest="key_file")
+  parser.add_option("-n", "--iterations", action="store", type="int",
+                    dest="iterations", default=200)
+  (options, args) = parser.parse_args()
+
+  key_file = options.key_file or CreateTemporaryKey()
+  try:
+    uncached = Measure("uncached", SignUncached, key_file, options.iterations)
+    cached = Measure("cached", SignCached, key_file, options.iterations)
+    print("speedup    %8.2fx" % (uncached / cached))
+  finally:
+    if not options.key_file:
+      os.unlink(key_file)
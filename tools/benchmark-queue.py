@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the queue processing throughput of gappsd.queue (job counts, claim,
+instantiation, and status update of no-op jobs), with the jobs claimed one at a
+time, with the prefetch buffer, and with the prefetch buffer and the buffered
+status updates (cf. gappsd.writeback). The queue runs on a temporary SQLite
+database (cf. gappsd.sqlite), so no MySQL server is needed.
+
+Usage:
+  benchmark-queue.py [--jobs 2000] [--prefetch 20]
+"""
+
+# Sets up the python path for 'gappsd' modules inclusion.
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import gappsd.config, gappsd.database, gappsd.job, gappsd.queue, gappsd.sqlite
+import gappsd.writeback
+import logging
+import optparse
+import shutil
+import tempfile
+import time
+
+_SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "..", "doc",
+                            "gapps.schema.sql")
+
+_CONFIG = """
+[mysql]
+backend=sqlite
+hostname=
+username=
+database=%(database)s
+
+[gapps]
+customer=benchmark
+domain=benchmark
+oauth2-client=benchmark
+oauth2-secret=benchmark
+oauth2-user=benchmark
+admin-email=benchmark
+
+[gappsd]
+queue-prefetch=%(prefetch)d
+status-flush-interval=%(flush_interval)d
+"""
+
+class NoopJob(gappsd.job.Job):
+  """Job completing immediately, without API calls."""
+
+  PROP__SIDE_EFFECTS = False
+
+  def Run(self):
+    self.Update(self.STATUS_SUCCESS)
+
+gappsd.job.job_registry.Register("b_noop", NoopJob)
+
+def CreateConfig(directory, name, prefetch, flush_interval=0):
+  config_file = os.path.join(directory, "%s.conf" % name)
+  with open(config_file, "w") as config:
+    config.write(_CONFIG % {
+      "database": os.path.join(directory, "%s.db" % name),
+      "prefetch": prefetch,
+      "flush_interval": flush_interval,
+    })
+  return gappsd.config.Config(config_file)
+
+def Measure(name, config, jobs):
+  sql = gappsd.database.SQL(config)
+  gappsd.sqlite.LoadSchema(sql, _SCHEMA_FILE)
+  gappsd.queue.CreateQueueJobs(sql, [("b_noop", {})] * jobs)
+  queue = gappsd.queue.Queue(config, sql, None)
+  writer = queue._status_writer
+
+  start = time.time()
+  if writer:
+    writer.start()
+    gappsd.writeback.SetWriter(writer)
+  processed = 0
+  while True:
+    queue._RefreshJobCounts()
+    j = queue._GetJobFromQueue("normal")
+    if j is None:
+      break
+    queue._ProcessJob(j)
+    queue._leases.Remove(j.id())
+    processed += 1
+  if writer:
+    gappsd.writeback.SetWriter(None)
+    writer.Stop()
+  duration = time.time() - start
+
+  succeeded = sql.Query("SELECT COUNT(*) AS count FROM gapps_queue "
+                        "WHERE p_status = 'success'")[0]["count"]
+  queue._connections.Close()
+  sql.Close()
+  assert processed == jobs and succeeded == jobs
+  print("%-10s %8.1f jobs/s" % (name, processed / duration))
+  return duration
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser()
+  parser.add_option("-j", "--jobs", action="store", type="int",
+                    dest="jobs", default=2000)
+  parser.add_option("-p", "--prefetch", action="store", type="int",
+                    dest="prefetch", default=20)
+  (options, args) = parser.parse_args()
+  logging.root.setLevel(logging.WARNING)
+
+  directory = tempfile.mkdtemp()
+  try:
+    single = Measure("single", CreateConfig(directory, "single", 0),
+                     options.jobs)
+    prefetch = Measure(
+      "prefetch", CreateConfig(directory, "prefetch", options.prefetch),
+      options.jobs)
+    buffered = Measure(
+      "buffered", CreateConfig(directory, "buffered", options.prefetch, 5),
+      options.jobs)
+    print("speedup    %8.2fx (prefetch)" % (single / prefetch))
+    print("speedup    %8.2fx (buffered)" % (single / buffered))
+  finally:
+    shutil.rmtree(directory)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the memory used by the rows of a synthetic gapps_accounts table, as
+returned by SQL.Query: dictionaries (DictCursor, the default), and records
+(row_factory=gappsd.database.RecordRowFactory). Rows are generated locally, as
+tuples of values as returned by MySQLdb; no query is sent to MySQL. Only the
+row containers are measured, as the values are shared by both versions.
+
+Usage:
+  benchmark-row-memory.py [--accounts 100000]
+"""
+
+# Sets up the python path for 'gappsd' modules inclusion.
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import datetime
+import gappsd.database
+import optparse
+import time
+
+# Columns of the account list of the r_accounts job.
+_COLUMNS = ("g_account_id", "g_account_name", "g_first_name", "g_last_name",
+            "g_status", "g_suspension", "r_disk_usage", "r_creation")
+
+def GenerateAccounts(count):
+  creation = datetime.date(2007, 1, 1)
+  for i in xrange(count):
+    yield ("%016d" % i, u"first.last.%d" % i, u"First", u"Last", u"active",
+           None, 1024 * i, creation)
+
+def BuildDicts(rows):
+  return tuple([dict(zip(_COLUMNS, row)) for row in rows])
+
+def BuildRecords(rows):
+  return tuple(map(gappsd.database.RecordRowFactory(_COLUMNS), rows))
+
+def Measure(name, function, rows):
+  start = time.time()
+  result = function(rows)
+  duration = time.time() - start
+  size = sys.getsizeof(result) + sum([sys.getsizeof(row) for row in result])
+  print("%-10s %8.1f MB %8.3f s" % (name, size / 1048576.0, duration))
+  return size
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser()
+  parser.add_option("-n", "--accounts", action="store", type="int",
+                    dest="accounts", default=100000)
+  (options, args) = parser.parse_args()
+
+  rows = list(GenerateAccounts(options.accounts))
+  dicts = Measure("dict", BuildDicts, rows)
+  records = Measure("record", BuildRecords, rows)
+  print("saving     %8.2fx" % (float(dicts) / records))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the statement-building overhead of SQL.Update and SQL.Insert, with
+the query strings rebuilt on every call (previous behaviour), and with the
+statement template cache of gappsd.database. No query is sent to MySQL.
+
+Usage:
+  benchmark-sql-statements.py [--iterations 100000]
+"""
+
+# Sets up the python path for 'gappsd' modules inclusion.
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import gappsd.database
+import optparse
+import time
+
+# Typical job status update (cf. gappsd.job.Job.Update).
+_VALUES = {
+  "p_status": "softfail",
+  "p_notbefore_date": "2015-01-01 00:00:00",
+  "r_softfail_date": "2015-01-01 00:00:00",
+  "r_softfail_count": 1,
+  "r_result": "Transient error",
+}
+_WHERE = {"q_id": 42}
+
+class DryRunSQL(gappsd.database.SQL):
+  """SQL object which doesn't execute the queries."""
+
+  def __init__(self):
+    pass
+
+  def Execute(self, query, args=()):
+    return 1
+
+class UncachedSQL(DryRunSQL):
+  """SQL object building the statements on every call (previous behaviour)."""
+
+  def Update(self, table, values, where):
+    args = list(values.values()) + list(where.values())
+    query = "UPDATE %s SET " % table + \
+      ", ".join(["%s = %%s" % field for field in values]) + " WHERE " + \
+      " AND ".join(["%s = %%s" % field for field in where])
+    return self.Execute(query, args)
+
+  def Insert(self, table, values):
+    args = list(values.values());
+    query = "INSERT INTO %s SET " % table + \
+      ", ".join(["%s = %%s" % field for field in values])
+    return self.Execute(query, args)
+
+def Measure(name, sql, iterations):
+  start = time.time()
+  for i in xrange(iterations):
+    sql.Update("gapps_queue", _VALUES, _WHERE)
+    sql.Insert("gapps_queue", _VALUES)
+  duration = time.time() - start
+  print("%-10s %8.3f us/statement" % (name, 1e6 * duration / (2 * iterations)))
+  return duration
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser()
+  parser.add_option("-n", "--iterations", action="store", type="int",
+                    dest="iterations", default=100000)
+  (options, args) = parser.parse_args()
+
+  uncached = Measure("uncached", UncachedSQL(), options.iterations)
+  cached = Measure("cached", DryRunSQL(), options.iterations)
+  print("speedup    %8.2fx" % (uncached / cached))
@@ -64,7 +64,7 @@ class ChartCreator(object):
     Actually returns the (daylist, data) tuple."""
 
     # Retrieves data from the database.
-    sql_data = self._sql.Query(sql_query, sql_args)
+    sql_data = self._sql.Query(sql_query, sql_args, lag_tolerant=True)
 
     # Determines current mode.
     week_aggregation = (interval > 61)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 Polytechnique.org
+# Author: Vincent Zanotti (vincent.zanotti@polytechnique.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Upgrades the gappsd SQL tables of an existing installation to the schema of
+doc/gapps.schema.sql. Migrations are versioned (applied versions are recorded in
+the gapps_schema_version table), and each step checks the current state of the
+schema before altering it, so that the tool can safely be run several times, or
+against a database created from an up-to-date schema file.
+
+Usage:
+  migrate-schema --config-file /path/to/config/file [--dry-run]
+"""
+
+# Sets up the python path for 'gappsd' modules inclusion.
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import gappsd.config, gappsd.database
+import optparse
+
+# List of (version, description, steps) migrations, in application order. Steps
+# are ("table", name, definition), ("column", table, name, definition),
+# ("index", table, name, columns), or ("sql", query) for idempotent queries.
+MIGRATIONS = [
+  (1, "Add the claim token of queue jobs", [
+    ("column", "gapps_queue", "p_claim_token", "CHAR(32) DEFAULT NULL"),
+    ("index", "gapps_queue", "p_claim_token", "p_claim_token"),
+  ]),
+  (2, "Add the lease expiry of queue jobs", [
+    ("column", "gapps_queue", "p_lease_expiry", "DATETIME DEFAULT NULL"),
+  ]),
+  (3, "Add the queue change marker", [
+    ("table", "gapps_queue_sequence",
+     "id TINYINT UNSIGNED NOT NULL, "
+     "seq BIGINT UNSIGNED DEFAULT 0 NOT NULL, "
+     "PRIMARY KEY(id)"),
+    ("sql", "INSERT IGNORE INTO gapps_queue_sequence (id, seq) VALUES (1, 0)"),
+  ]),
+  (4, "Add the runnable jobs index of the queue", [
+    ("index", "gapps_queue", "p_runnable",
+     "p_admin_request, p_status, p_priority, p_notbefore_date, q_id"),
+  ]),
+]
+
+class SchemaMigrator(object):
+  def __init__(self, config_file, dry_run=False):
+    self._config = gappsd.config.Config(config_file)
+    self._sql = gappsd.database.SQL(self._config)
+    self._dry_run = dry_run
+
+  def _Count(self, sql_query, args):
+    return self._sql.Query(sql_query, args)[0]["count"]
+
+  def HasTable(self, table):
+    return self._Count(
+        """SELECT COUNT(*) AS count
+             FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (table,))
+
+  def HasColumn(self, table, column):
+    return self._Count(
+        """SELECT COUNT(*) AS count
+             FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND
+                  COLUMN_NAME = %s""", (table, column))
+
+  def HasIndex(self, table, index):
+    return self._Count(
+        """SELECT COUNT(*) AS count
+             FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND
+                  INDEX_NAME = %s""", (table, index))
+
+  def _Execute(self, sql_query):
+    print("  %s" % sql_query)
+    if not self._dry_run:
+      self._sql.Execute(sql_query)
+
+  def _ApplyStep(self, step):
+    """Applies the migration @p step, unless the schema already contains it."""
+
+    if step[0] == "table":
+      (kind, table, definition) = step
+      if not self.HasTable(table):
+        self._Execute("CREATE TABLE %s (%s) CHARSET=utf8" % (table, definition))
+    elif step[0] == "column":
+      (kind, table, column, definition) = step
+      if not self.HasColumn(table, column):
+        self._Execute("ALTER TABLE %s ADD COLUMN %s %s" % \
+          (table, column, definition))
+    elif step[0] == "index":
+      (kind, table, index, columns) = step
+      if not self.HasIndex(table, index):
+        self._Execute("ALTER TABLE %s ADD INDEX %s(%s)" % \
+          (table, index, columns))
+    elif step[0] == "sql":
+      self._Execute(step[1])
+    else:
+      raise ValueError("Unknown migration step '%s'" % step[0])
+
+  def AppliedVersions(self):
+    """Returns the set of already applied migration versions."""
+
+    if not self.HasTable("gapps_schema_version"):
+      self._Execute(
+          "CREATE TABLE gapps_schema_version ("
+          "version SMALLINT UNSIGNED NOT NULL, "
+          "description VARCHAR(256) NOT NULL, "
+          "applied_date DATETIME NOT NULL, "
+          "PRIMARY KEY(version)) CHARSET=utf8")
+      return set()
+    return set([row["version"] for row in
+                self._sql.Query("SELECT version FROM gapps_schema_version")])
+
+  def Migrate(self):
+    """Applies the pending migrations, in version order."""
+
+    applied = self.AppliedVersions()
+    for (version, description, steps) in MIGRATIONS:
+      if version in applied:
+        continue
+      print("Migration %d: %s" % (version, description))
+      for step in steps:
+        self._ApplyStep(step)
+      if not self._dry_run:
+        self._sql.Execute(
+            """INSERT INTO gapps_schema_version
+                       SET version = %s, description = %s,
+                           applied_date = NOW()""", (version, description))
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser()
+  parser.add_option("-c", "--config-file", action="store", dest="config_file")
+  parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run")
+  (options, args) = parser.parse_args()
+
+  if options.config_file is None:
+    print("Error: options --config-file is mandatory.")
+    sys.exit(1)
+
+  migrator = SchemaMigrator(options.config_file, options.dry_run or False)
+  migrator.Migrate()